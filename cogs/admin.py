@@ -1,7 +1,21 @@
+import datetime
+import json
+
 import discord
 from discord import app_commands
 from discord.ext import commands
 from main import DiscordLevelBot
+from utils.exp_rules import (
+    RULE_CHANNEL,
+    RULE_ROLE,
+    RULE_TIMEZONE,
+    format_minute,
+    format_weekdays,
+    parse_datetime,
+    parse_minute,
+    parse_weekdays,
+)
+from utils.role_sync import RoleConfig
 
 
 class EXPResetConfirm(discord.ui.View):
@@ -36,10 +50,50 @@ class AdminSettingCommand(
 ):
     role_group = app_commands.Group(name="role", description="ロール設定コマンド")
     exp_group = app_commands.Group(name="exp", description="経験値設定コマンド")
+    rule_group = app_commands.Group(
+        name="rule", description="経験値倍率ルール設定コマンド"
+    )
+    backfill_group = app_commands.Group(
+        name="backfill", description="過去のメッセージからの経験値の取り込みコマンド"
+    )
 
     def __init__(self, bot: DiscordLevelBot):
         self.bot = bot
 
+    async def invalidate_guild(self, guild_id: int) -> None:
+        # 全プロセスのLevelingに設定キャッシュの破棄を通知する
+        await self.bot.shared.publish(
+            "leveling", json.dumps({"scope": "guild", "guild_id": guild_id})
+        )
+
+    async def flush_levels(self) -> None:
+        # バッファされたEXPを先に書き込んでから直接DBを更新する
+        leveling = self.bot.get_cog("Leveling")
+        if leveling is not None:
+            await leveling.flush()
+
+    async def invalidate_member(
+        self, guild_id: int, user_id: int | None = None
+    ) -> None:
+        await self.bot.shared.publish(
+            "leveling",
+            json.dumps({"scope": "member", "guild_id": guild_id, "user_id": user_id}),
+        )
+
+    async def role_config(self, guild_id: int) -> RoleConfig:
+        level_roles = await self.bot.db.get_guild_level_roles(guild_id)
+        _, _, stack_level_roles = await self.bot.db.get_guild_setting(guild_id)
+        return RoleConfig([tuple(r) for r in level_roles], bool(stack_level_roles))
+
+    async def sync_level_roles(self, guild_id: int, previous: RoleConfig) -> bool:
+        # 設定変更を既存のメンバーにバックグラウンドで反映する
+        current = await self.role_config(guild_id)
+        if current == previous:
+            return False
+        await self.flush_levels()
+        await self.bot.role_sync.schedule(guild_id, previous, current)
+        return True
+
     @role_group.command(name="add", description="レベルロールを追加します")
     @app_commands.describe(role="追加するロール")
     @app_commands.describe(level="追加するレベル")
@@ -50,12 +104,18 @@ class AdminSettingCommand(
         if level < 1:
             await interaction.followup.send("レベルは1以上で指定してください")
             return
-        check = await self.bot.db.get_guild_level_role(interaction.guild.id, role.id)
-        if check:
+        previous = await self.role_config(interaction.guild.id)
+        created = await self.bot.db.create_guild_level_role(
+            interaction.guild.id, role.id, level
+        )
+        if not created:
             await interaction.followup.send("すでに追加されているロールです")
             return
-        await self.bot.db.create_guild_level_role(interaction.guild.id, role.id, level)
-        await interaction.followup.send("レベルロールを追加しました")
+        await self.invalidate_guild(interaction.guild.id)
+        await self.sync_level_roles(interaction.guild.id, previous)
+        await interaction.followup.send(
+            "レベルロールを追加しました\n既存のメンバーへの反映を開始しました"
+        )
 
     @role_group.command(name="remove", description="レベルロールを削除します")
     @app_commands.describe(role="削除するロール")
@@ -63,17 +123,26 @@ class AdminSettingCommand(
         self, interaction: discord.Interaction, role: discord.Role
     ):
         await interaction.response.defer()
-        check = await self.bot.db.get_guild_level_role(interaction.guild.id, role.id)
-        if not check:
+        previous = await self.role_config(interaction.guild.id)
+        deleted = await self.bot.db.delete_guild_level_role(
+            interaction.guild.id, role.id
+        )
+        if not deleted:
             await interaction.followup.send("追加されていないロールです")
             return
-        await self.bot.db.delete_guild_level_role(interaction.guild.id, role.id)
-        await interaction.followup.send("レベルロールを削除しました")
+        await self.invalidate_guild(interaction.guild.id)
+        await self.sync_level_roles(interaction.guild.id, previous)
+        await interaction.followup.send(
+            "レベルロールを削除しました\n既存のメンバーへの反映を開始しました"
+        )
 
     @role_group.command(name="clear", description="レベルロールを全て削除します")
     async def level_role_remove(self, interaction: discord.Interaction):
         await interaction.response.defer()
+        previous = await self.role_config(interaction.guild.id)
         await self.bot.db.delete_all_guild_level_roles(interaction.guild.id)
+        await self.invalidate_guild(interaction.guild.id)
+        await self.sync_level_roles(interaction.guild.id, previous)
         await interaction.followup.send("レベルロールを全て削除しました")
 
     @role_group.command(
@@ -84,13 +153,25 @@ class AdminSettingCommand(
         self, interaction: discord.Interaction, value: bool
     ):
         await interaction.response.defer()
-        guild_settings = await self.bot.db.get_guild_setting(interaction.guild.id)
-        min_exp, max_exp, _ = guild_settings
-        await self.bot.db.update_guild_setting(
-            interaction.guild.id, min_exp, max_exp, value
-        )
+        previous = await self.role_config(interaction.guild.id)
+        await self.bot.db.set_guild_stack_level_roles(interaction.guild.id, value)
+        await self.invalidate_guild(interaction.guild.id)
+        await self.sync_level_roles(interaction.guild.id, previous)
         await interaction.followup.send("レベルロールの複数保持設定をしました")
 
+    @role_group.command(
+        name="status", description="レベルロールの既存メンバーへの反映状況を表示します"
+    )
+    async def level_role_status(self, interaction: discord.Interaction):
+        job = self.bot.role_sync.jobs.get(interaction.guild.id)
+        if job is None:
+            await interaction.response.send_message("反映中の設定変更はありません")
+            return
+        await interaction.response.send_message(
+            f"反映中: {job.processed}/{job.total}人\n"
+            f"変更: {job.changed}件 (失敗 {job.failed}件)"
+        )
+
     @exp_group.command(name="min", description="最小獲得経験値を設定します")
     @app_commands.describe(value="設定する値")
     async def set_min_exp(self, interaction: discord.Interaction, value: int):
@@ -98,11 +179,8 @@ class AdminSettingCommand(
         if value < 0:
             await interaction.followup.send("0以上で指定してください")
             return
-        guild_settings = await self.bot.db.get_guild_setting(interaction.guild.id)
-        _, max_exp, stack_level_roles = guild_settings
-        await self.bot.db.update_guild_setting(
-            interaction.guild.id, value, max_exp, stack_level_roles
-        )
+        await self.bot.db.set_guild_min_exp(interaction.guild.id, value)
+        await self.invalidate_guild(interaction.guild.id)
         await interaction.followup.send("最小獲得経験値を設定しました")
 
     @exp_group.command(name="max", description="最大獲得経験値を設定します")
@@ -112,11 +190,8 @@ class AdminSettingCommand(
         if value < 0:
             await interaction.followup.send("0以上で指定してください")
             return
-        guild_settings = await self.bot.db.get_guild_setting(interaction.guild.id)
-        min_exp, _, stack_level_roles = guild_settings
-        await self.bot.db.update_guild_setting(
-            interaction.guild.id, min_exp, value, stack_level_roles
-        )
+        await self.bot.db.set_guild_max_exp(interaction.guild.id, value)
+        await self.invalidate_guild(interaction.guild.id)
         await interaction.followup.send("最大獲得経験値を設定しました")
 
     @exp_group.command(name="reset", description="経験値をリセットします")
@@ -132,13 +207,19 @@ class AdminSettingCommand(
         await view.wait()
 
         if view.value:
+            await self.flush_levels()
             if user:
                 await self.bot.db.delete_user_level_total(user.id, interaction.guild.id)
+                await self.invalidate_member(interaction.guild.id, user.id)
                 await interaction.followup.send(
                     f"{user.display_name}の経験値をリセットしました"
                 )
             else:
+                # 取り込み済みの経験値も消えるので、もう一度取り込めるようにする
+                self.bot.backfill.stop(interaction.guild.id)
+                await self.bot.db.delete_backfill_checkpoints(interaction.guild.id)
                 await self.bot.db.delete_all_user_levels(interaction.guild.id)
+                await self.invalidate_member(interaction.guild.id)
                 await interaction.followup.send("全員の経験値をリセットしました")
 
     @exp_group.command(name="add", description="経験値を追加します")
@@ -159,6 +240,7 @@ class AdminSettingCommand(
         await self.bot.db.add_user_level(
             user.id, interaction.guild.id, channel.id, value
         )
+        await self.invalidate_member(interaction.guild.id, user.id)
         await interaction.followup.send(
             f"{user.display_name}に{value}経験値追加しました"
         )
@@ -178,22 +260,262 @@ class AdminSettingCommand(
         if value < 1:
             await interaction.followup.send("1以上で指定してください")
             return
-        exp = await self.bot.db.get_user_level(
-            user.id, interaction.guild.id, channel.id
-        )
-        if exp < value:
-            value = exp
-        await self.bot.db.remove_user_level_exp(
-            user.id, interaction.guild.id, interaction.channel.id, value
+        await self.flush_levels()
+        value = await self.bot.db.remove_user_level_exp(
+            user.id, interaction.guild.id, channel.id, value
         )
+        await self.invalidate_member(interaction.guild.id, user.id)
         await interaction.followup.send(
             f"{user.display_name}から{value}経験値減らしました"
         )
 
+    @rule_group.command(
+        name="channel", description="チャンネルの経験値倍率を設定します"
+    )
+    @app_commands.describe(channel="設定するチャンネルまたはカテゴリ")
+    @app_commands.describe(multiplier="倍率、0で経験値を付与しません")
+    async def rule_channel(
+        self,
+        interaction: discord.Interaction,
+        channel: discord.abc.GuildChannel,
+        multiplier: app_commands.Range[float, 0, 100],
+    ):
+        await interaction.response.defer()
+        await self.bot.db.set_exp_target_rule(
+            interaction.guild.id, RULE_CHANNEL, channel.id, multiplier
+        )
+        await self.invalidate_guild(interaction.guild.id)
+        await interaction.followup.send(
+            f"{channel.mention}の経験値倍率を{multiplier}倍に設定しました"
+        )
+
+    @rule_group.command(name="role", description="ロールの経験値倍率を設定します")
+    @app_commands.describe(role="設定するロール")
+    @app_commands.describe(
+        multiplier="倍率、複数のロールを持つ場合は最も大きい倍率を使います"
+    )
+    async def rule_role(
+        self,
+        interaction: discord.Interaction,
+        role: discord.Role,
+        multiplier: app_commands.Range[float, 0, 100],
+    ):
+        await interaction.response.defer()
+        await self.bot.db.set_exp_target_rule(
+            interaction.guild.id, RULE_ROLE, role.id, multiplier
+        )
+        await self.invalidate_guild(interaction.guild.id)
+        await interaction.followup.send(
+            f"{role.mention}の経験値倍率を{multiplier}倍に設定しました",
+            allowed_mentions=discord.AllowedMentions.none(),
+        )
+
+    @rule_group.command(name="time", description="曜日や時間帯の経験値倍率を追加します")
+    @app_commands.describe(multiplier="倍率")
+    @app_commands.describe(weekdays="曜日 (例: 土日)、指定しない場合毎日")
+    @app_commands.describe(start="開始時刻 (例: 20:00)、指定しない場合終日")
+    @app_commands.describe(end="終了時刻 (例: 23:00)、開始時刻と一緒に指定します")
+    @app_commands.describe(since="有効期間の開始日時 (例: 2025-01-01 00:00)")
+    @app_commands.describe(until="有効期間の終了日時 (例: 2025-01-04 00:00)")
+    async def rule_time(
+        self,
+        interaction: discord.Interaction,
+        multiplier: app_commands.Range[float, 0, 100],
+        weekdays: str = None,
+        start: str = None,
+        end: str = None,
+        since: str = None,
+        until: str = None,
+    ):
+        await interaction.response.defer()
+        if bool(start) != bool(end):
+            # 片方だけだと終日のルールとして登録されてしまう
+            await interaction.followup.send("開始時刻と終了時刻は両方指定してください")
+            return
+        try:
+            weekday_mask = parse_weekdays(weekdays)
+            start_minute = parse_minute(start) if start else 0
+            end_minute = parse_minute(end) if end else 0
+            # DBにはUTCで保存する
+            starts_at, ends_at = (
+                parse_datetime(value)
+                .astimezone(datetime.timezone.utc)
+                .replace(tzinfo=None)
+                if value
+                else None
+                for value in (since, until)
+            )
+        except ValueError:
+            await interaction.followup.send("曜日または日時の形式が正しくありません")
+            return
+        if starts_at and ends_at and starts_at >= ends_at:
+            await interaction.followup.send("終了日時は開始日時より後にしてください")
+            return
+
+        rule_id = await self.bot.db.create_exp_time_rule(
+            interaction.guild.id,
+            multiplier,
+            weekday_mask,
+            start_minute % (24 * 60),
+            end_minute % (24 * 60),
+            starts_at,
+            ends_at,
+        )
+        await self.invalidate_guild(interaction.guild.id)
+        await interaction.followup.send(
+            f"経験値倍率ルールを追加しました (ID: {rule_id})"
+        )
+
+    @rule_group.command(name="remove", description="経験値倍率ルールを削除します")
+    @app_commands.describe(rule_id="削除するルールのID")
+    async def rule_remove(self, interaction: discord.Interaction, rule_id: int):
+        await interaction.response.defer()
+        deleted = await self.bot.db.delete_exp_rule(interaction.guild.id, rule_id)
+        if not deleted:
+            await interaction.followup.send("存在しないルールです")
+            return
+        await self.invalidate_guild(interaction.guild.id)
+        await interaction.followup.send("経験値倍率ルールを削除しました")
+
+    @rule_group.command(name="clear", description="経験値倍率ルールを全て削除します")
+    async def rule_clear(self, interaction: discord.Interaction):
+        await interaction.response.defer()
+        await self.bot.db.delete_all_exp_rules(interaction.guild.id)
+        await self.invalidate_guild(interaction.guild.id)
+        await interaction.followup.send("経験値倍率ルールを全て削除しました")
+
+    @rule_group.command(name="list", description="経験値倍率ルールを表示します")
+    async def rule_list(self, interaction: discord.Interaction):
+        await interaction.response.defer()
+        rules = await self.bot.db.get_exp_rules(interaction.guild.id)
+        if len(rules) == 0:
+            await interaction.followup.send("No Data")
+            return
+
+        embed = discord.Embed(title="経験値倍率ルール")
+        for (
+            rule_id,
+            kind,
+            target_id,
+            multiplier,
+            weekdays,
+            start_minute,
+            end_minute,
+            starts_at,
+            ends_at,
+        ) in rules[:25]:
+            if kind == RULE_CHANNEL:
+                value = f"<#{target_id}>"
+            elif kind == RULE_ROLE:
+                value = f"<@&{target_id}>"
+            else:
+                value = format_weekdays(weekdays)
+                if start_minute != end_minute:
+                    value += (
+                        f" {format_minute(start_minute)}-{format_minute(end_minute)}"
+                    )
+                if starts_at or ends_at:
+                    period = [
+                        f"<t:{int(at.replace(tzinfo=datetime.timezone.utc).timestamp())}:f>"
+                        if at
+                        else ""
+                        for at in (starts_at, ends_at)
+                    ]
+                    value += f"\n{period[0]} ~ {period[1]}"
+            embed.add_field(
+                name=f"ID: {rule_id} ({multiplier}倍)", value=value, inline=False
+            )
+        embed.set_footer(text=f"時間帯: {RULE_TIMEZONE.key}")
+        await interaction.followup.send(embed=embed)
+
+    @backfill_group.command(
+        name="start", description="過去のメッセージから経験値を取り込みます"
+    )
+    @app_commands.describe(days="取り込む日数、指定しない場合全て")
+    async def backfill_start(
+        self,
+        interaction: discord.Interaction,
+        days: app_commands.Range[int, 1, 3650] | None = None,
+    ):
+        await interaction.response.defer()
+        if self.bot.backfill.running(interaction.guild.id):
+            await interaction.followup.send("すでに取り込み中です")
+            return
+        started = await self.bot.backfill.schedule(interaction.guild.id, days)
+        if not started:
+            await interaction.followup.send(
+                "取り込み済みか、取り込めるチャンネルがありません"
+            )
+            return
+        await interaction.followup.send(
+            "過去のメッセージの取り込みを開始しました\n"
+            "進捗は`/settings backfill status`で確認できます"
+        )
+
+    @backfill_group.command(name="stop", description="経験値の取り込みを中断します")
+    async def backfill_stop(self, interaction: discord.Interaction):
+        await interaction.response.defer()
+        if not self.bot.backfill.running(interaction.guild.id):
+            await interaction.followup.send("取り込み中ではありません")
+            return
+        self.bot.backfill.stop(interaction.guild.id)
+        await interaction.followup.send(
+            "取り込みを中断しました、`/settings backfill start`で続きから再開します"
+        )
+
+    @backfill_group.command(
+        name="status", description="経験値の取り込みの進捗を表示します"
+    )
+    async def backfill_status(self, interaction: discord.Interaction):
+        await interaction.response.defer()
+        checkpoints = await self.bot.db.get_backfill_checkpoints(interaction.guild.id)
+        if not checkpoints:
+            await interaction.followup.send("No Data")
+            return
+        done = sum(1 for *_, finished in checkpoints if finished)
+        messages = sum(checkpoint[4] for checkpoint in checkpoints)
+        progress = self.bot.backfill.progress.get(interaction.guild.id)
+        if progress is not None and self.bot.backfill.running(interaction.guild.id):
+            # 実行中は書き込み前の分も含めて表示する
+            done, messages = progress.done_channels, progress.messages
+        if self.bot.backfill.running(interaction.guild.id):
+            state = "取り込み中"
+        elif done < len(checkpoints):
+            state = "中断"
+        else:
+            state = "完了"
+        await interaction.followup.send(
+            f"{state}: {done}/{len(checkpoints)}チャンネル、{messages}メッセージ"
+        )
+
+    @app_commands.command(
+        name="rankmode", description="/rankで表示する順位の計算方法を設定します"
+    )
+    @app_commands.describe(
+        approximate="上位以外のメンバーの順位を概算で表示するか",
+        exact_top="正確な順位を表示する上位の人数",
+    )
+    async def rank_mode(
+        self,
+        interaction: discord.Interaction,
+        approximate: bool,
+        exact_top: app_commands.Range[int, 0, 10000] = 100,
+    ):
+        await interaction.response.defer()
+        if approximate:
+            await self.bot.db.set_guild_rank_mode(interaction.guild.id, exact_top)
+            message = f"上位{exact_top}位より下のメンバーの順位を概算で表示します"
+        else:
+            await self.bot.db.delete_guild_rank_mode(interaction.guild.id)
+            message = "全てのメンバーの順位を正確に表示します"
+        await self.invalidate_guild(interaction.guild.id)
+        await interaction.followup.send(message)
+
     @app_commands.command(name="reset", description="サーバーの設定をリセットします")
     async def reset(self, interaction: discord.Interaction):
         await interaction.response.defer()
         await self.bot.db.delete_guild_setting(interaction.guild.id)
+        await self.invalidate_guild(interaction.guild.id)
         await interaction.followup.send("サーバーの設定をリセットしました")
 
     @app_commands.command(name="show", description="サーバーの設定を表示します")
@@ -204,8 +526,10 @@ class AdminSettingCommand(
             await interaction.followup.send("No Data")
             return
         min_exp, max_exp, stack_level_roles = guild_settings
+        exact_top = await self.bot.db.get_guild_rank_mode(interaction.guild.id)
+        rank_mode = "正確" if exact_top is None else f"概算 (上位{exact_top}位まで正確)"
         await interaction.followup.send(
-            f"最小経験値: {min_exp}\n最大経験値: {max_exp}\nレベルロールの複数保持: {'はい' if stack_level_roles else 'いいえ'}"
+            f"最小経験値: {min_exp}\n最大経験値: {max_exp}\nレベルロールの複数保持: {'はい' if stack_level_roles else 'いいえ'}\n順位の表示: {rank_mode}"
         )
 
 
@@ -1,9 +1,13 @@
-import os
+import asyncio
+import io
+import threading
+import time
 
 import discord
 from discord import app_commands
 from discord.ext import commands
 from main import DiscordLevelBot
+from utils.profiler import SamplingProfiler, dump_tasks
 from utils.util import is_bot_admin
 
 
@@ -16,23 +20,127 @@ class DebugCommand(
         self.bot = bot
 
     @app_commands.command(name="reload", description="Cogをリロードします")
-    @app_commands.describe(resync="コマンドを再同期します")
+    @app_commands.describe(resync="コマンドに変更があれば再同期します")
+    @app_commands.describe(force="変更がなくても再同期します")
     @is_bot_admin()
-    async def reload(self, interaction: discord.Interaction, resync: bool = False):
+    async def reload(
+        self,
+        interaction: discord.Interaction,
+        resync: bool = False,
+        force: bool = False,
+    ):
         await interaction.response.defer(ephemeral=True)
 
         for extension in self.bot.initial_extensions:
             await self.bot.reload_extension(extension)
 
-        if resync:
-            self.bot.tree.copy_global_to(
-                guild=discord.Object(id=os.environ.get("GUILD_ID"))
+        synced = False
+        if resync or force:
+            synced = await self.bot.sync_commands(force=force)
+        await interaction.followup.send(
+            f"Reloaded {'and Resync Command' if synced else ''}"
+        )
+
+    @app_commands.command(name="stats", description="XP処理の負荷状況を表示します")
+    @is_bot_admin()
+    async def stats(self, interaction: discord.Interaction):
+        leveling = self.bot.get_cog("Leveling")
+        if leveling is None:
+            await interaction.response.send_message("No Data", ephemeral=True)
+            return
+        stats = leveling.admission.stats()
+        dispatcher = leveling.dispatcher.stats()
+        await interaction.response.send_message(
+            f"処理中/待機中: {stats['pending']}\n"
+            f"受付: {stats['admitted']}\n"
+            f"制限超過: {stats['shed']}\n"
+            f"後回し: {stats['deferred']} (未処理 {len(leveling._deferred)})\n"
+            f"レベルアップ処理: 未完了 {dispatcher['pending']} "
+            f"({dispatcher['members']}人) / 失敗 {dispatcher['failed']}",
+            ephemeral=True,
+        )
+
+    @app_commands.command(
+        name="profile", description="サンプリングプロファイラを実行します"
+    )
+    @app_commands.describe(seconds="計測する秒数")
+    @app_commands.describe(interval="サンプリング間隔 (ミリ秒)")
+    @is_bot_admin()
+    async def profile(
+        self,
+        interaction: discord.Interaction,
+        seconds: app_commands.Range[int, 1, 120] = 10,
+        interval: app_commands.Range[int, 1, 100] = 5,
+    ):
+        await interaction.response.defer(ephemeral=True)
+
+        # イベントループのスレッドを別スレッドからサンプリングする
+        profiler = SamplingProfiler(threading.get_ident(), interval / 1000)
+        collapsed = await asyncio.to_thread(profiler.run, seconds)
+        await interaction.followup.send(
+            f"{profiler.sample_count} samples, {len(profiler.samples)} stacks",
+            file=discord.File(
+                io.BytesIO(collapsed.encode()),
+                filename=f"profile-{int(time.time())}.folded",
+            ),
+            ephemeral=True,
+        )
+
+    @app_commands.command(name="tasks", description="実行中のタスクを一覧表示します")
+    @is_bot_admin()
+    async def tasks(self, interaction: discord.Interaction):
+        dump = dump_tasks(asyncio.get_running_loop())
+        await interaction.response.send_message(
+            file=discord.File(
+                io.BytesIO(dump.encode()), filename=f"tasks-{int(time.time())}.txt"
+            ),
+            ephemeral=True,
+        )
+
+    @app_commands.command(
+        name="lag", description="イベントループの遅延の記録を表示します"
+    )
+    @is_bot_admin()
+    async def lag(self, interaction: discord.Interaction):
+        monitor = self.bot.lag_monitor
+        stats = monitor.stats()
+        header = [
+            f"閾値: {stats['threshold_ms']:.0f}ms",
+            f"最大遅延: {stats['max_lag_ms']:.0f}ms",
+            f"記録: {stats['spikes']}件",
+        ]
+        spikes = list(monitor.spikes)
+        lines = []
+        for spike in spikes[-10:]:
+            handlers = " > ".join(spike.handlers) or "unknown"
+            # ハンドラが多いと2000文字を超えるので、全体は添付ファイルに入れる
+            if len(handlers) > 150:
+                handlers = handlers[:149] + "…"
+            lines.append(
+                f"<t:{int(spike.timestamp)}:T> {spike.lag * 1000:.0f}ms `{handlers}`"
             )
-            await self.bot.tree.sync(
-                guild=discord.Object(id=os.environ.get("GUILD_ID"))
+        # 収まらない場合は古い記録から省く
+        while lines and len("\n".join(header + lines)) > 2000:
+            lines.pop(0)
+
+        files = []
+        if spikes:
+            detail = "".join(
+                f"{spike.timestamp:.3f} {spike.lag * 1000:.0f}ms "
+                f"{' > '.join(spike.handlers) or 'unknown'}\n"
+                for spike in spikes
             )
-        await interaction.followup.send(
-            f"Reloaded {'and Resync Command' if resync else ''}"
+            files.append(
+                discord.File(io.BytesIO(detail.encode()), filename="lag-spikes.txt")
+            )
+        # スタックは長いのでファイルで添付する
+        stacks = "".join(f"{spike.stack} 1\n" for spike in spikes if spike.stack)
+        if stacks:
+            files.append(
+                discord.File(io.BytesIO(stacks.encode()), filename="lag-stacks.folded")
+            )
+        await interaction.response.send_message(
+            "\n".join(header + lines), ephemeral=True, files=files
         )
 
     @app_commands.command(name="ping", description="Botのレイテンシを表示します")
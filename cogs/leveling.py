@@ -1,285 +1,972 @@
 import asyncio
+import datetime
+import io
+import json
+import logging
+import os
 import random
+import re
+import time
 
 import discord
 from discord import app_commands
-from discord.ext import commands
+from discord.ext import commands, tasks
 from main import DiscordLevelBot
-from utils.util import calculation_level, calculation_next_level_exp
+from utils.admission import AdmissionController
+from utils.card_renderer import LeaderboardRow, LeaderboardSpec, RankCardSpec
+from utils.exp_buffer import ExpBuffer
+from utils.exp_rules import ExpRules, compile_exp_rules
+from utils.fast_ingest import RawMessageIngest
+from utils.level_stats import LevelStats, compute_level_stats
+from utils.rank_sketch import RankSketch
+from utils.util import calculation_level, calculation_next_level_exp, get_level
+from utils.voice_sessions import VoiceSessions
+from utils.xp_pipeline import (
+    LevelChange,
+    MemberDispatcher,
+    XpEvent,
+    detect_level_change,
+)
 
 
-class RankingPagination(discord.ui.View):
+PAGE_SIZE = 10
+
+# ページのスコープ
+SCOPE_TOP_MEMBERS = "m"
+SCOPE_TOP_MEMBERS_IN_CHANNEL = "mc"
+SCOPE_TOP_CHANNELS = "c"
+SCOPE_RANK_STATS = "s"
+SCOPE_RANK_CHANNELS = "ch"
+TOP_SCOPES = (SCOPE_TOP_MEMBERS, SCOPE_TOP_MEMBERS_IN_CHANNEL, SCOPE_TOP_CHANNELS)
+
+
+class RankingPageButton(
+    discord.ui.DynamicItem[discord.ui.Button],
+    template=r"lv:(?P<scope>[a-z]+):(?P<guild>\d+):(?P<target>\d+):(?P<page>\d+):(?P<owner>\d+):(?P<slot>[a-z])",
+):
+    """
+    表示するページをcustom_idに持つボタン
+    targetはスコープによってチャンネルIDかユーザーIDになります
+    slotは同じページを指すボタンを区別するためのものです
+    """
+
     def __init__(
         self,
-        bot: DiscordLevelBot,
-        user: discord.User,
-        top_members_pages: list[discord.Embed],
-        top_channels_pages: list[discord.Embed],
+        scope: str,
+        guild_id: int,
+        target_id: int,
+        page: int,
+        owner_id: int,
+        slot: str,
+        **kwargs,
     ):
-        super().__init__()
-        self.bot = bot
-        self.user = user
-        self.pages = top_members_pages
-        self.top_members_pages = top_members_pages
-        self.top_channels_pages = top_channels_pages
-        self.current_page = 0
-        self.dropdown = discord.ui.Select(
-            placeholder="Select a page",
-            options=[
-                discord.SelectOption(label=f"Top Members", value="top_members"),
-                discord.SelectOption(
-                    label=f"Top Members in Channel",
-                    value="top_members_in_channel",
-                ),
-                discord.SelectOption(
-                    label=f"Top Channels",
-                    value="top_channels",
-                ),
-            ],
-        )
-        self.channel_select = discord.ui.ChannelSelect(
-            placeholder="Select a channel",
-            channel_types=[discord.ChannelType.text],
-        )
-        self.prev_button = discord.ui.Button(
-            label="⬅", style=discord.ButtonStyle.primary, disabled=True
-        )
-        self.next_button = discord.ui.Button(
-            label="➡",
-            style=discord.ButtonStyle.primary,
-            disabled=(len(self.pages) == 1),
-        )
-        self.page_label = discord.ui.Button(
-            label=f"{self.current_page + 1}/{len(self.pages)}",
-            style=discord.ButtonStyle.secondary,
-            disabled=True,
-        )
-        self.dropdown.callback = self.dropdown_callback
-        self.channel_select.callback = self.channel_select_callback
-        self.prev_button.callback = self.prev_button_callback
-        self.next_button.callback = self.next_button_callback
-        self.add_item(self.dropdown)
-        self.add_item(self.prev_button)
-        self.add_item(self.page_label)
-        self.add_item(self.next_button)
-
-    async def interaction_check(self, interaction: discord.Interaction):
-        return interaction.user.id == self.user.id
-
-    async def update_page(self, interaction: discord.Interaction) -> None:
-        if self.current_page == 0:
-            self.prev_button.disabled = True
-        else:
-            self.prev_button.disabled = False
-        if self.current_page == len(self.pages) - 1:
-            self.next_button.disabled = True
-        else:
-            self.next_button.disabled = False
-        self.page_label.label = f"{self.current_page + 1}/{len(self.pages)}"
-        await interaction.response.edit_message(
-            embed=self.pages[self.current_page], view=self
-        )
-
-    async def dropdown_callback(self, interaction: discord.Interaction):
-        selected = self.dropdown.values[0]
-        if selected == "top_members":
-            self.pages = self.top_members_pages
-            self.current_page = 0
-        elif selected == "top_members_in_channel":
-            self.pages = [discord.Embed(description="チャンネルを選択してください")]
-            self.current_page = 0
-            self.add_item(self.channel_select)
-            self.remove_item(self.prev_button)
-            self.remove_item(self.page_label)
-            self.remove_item(self.next_button)
-        elif selected == "top_channels":
-            self.pages = self.top_channels_pages
-            self.current_page = 0
-
-        await self.update_page(interaction)
-
-    async def channel_select_callback(self, interaction: discord.Interaction):
-        selected_channel = self.channel_select.values[0]
-        top_members_in_channel = await self.bot.db.get_user_level_ranking(
-            interaction.guild.id, selected_channel.id
-        )
-        top_members_in_channel_pages = []
-        for i in range(0, len(top_members_in_channel), 10):
-            page = discord.Embed(
-                title=f"チャンネルランキング {selected_channel.name}",
-                description="\n".join(
-                    [
-                        f"{ranking}位 <@{user_id}> Exp. {exp}"
-                        for user_id, exp, ranking in top_members_in_channel[i : i + 10]
-                    ]
-                ),
+        super().__init__(
+            discord.ui.Button(
+                custom_id=f"lv:{scope}:{guild_id}:{target_id}:{page}:{owner_id}:{slot}",
+                **kwargs,
             )
-            top_members_in_channel_pages.append(page)
+        )
+        self.scope = scope
+        self.guild_id = guild_id
+        self.target_id = target_id
+        self.page = page
+        self.owner_id = owner_id
 
-        if len(top_members_in_channel_pages) == 0:
-            top_members_in_channel_pages = [discord.Embed(description="No Data")]
+    @classmethod
+    async def from_custom_id(
+        cls,
+        interaction: discord.Interaction,
+        item: discord.ui.Button,
+        match: re.Match[str],
+    ):
+        return cls(
+            match["scope"],
+            int(match["guild"]),
+            int(match["target"]),
+            int(match["page"]),
+            int(match["owner"]),
+            match["slot"],
+        )
 
-        self.pages = top_members_in_channel_pages
-        self.current_page = 0
-        self.remove_item(self.channel_select)
-        self.add_item(self.prev_button)
-        self.add_item(self.page_label)
-        self.add_item(self.next_button)
-        await self.update_page(interaction)
+    async def interaction_check(self, interaction: discord.Interaction) -> bool:
+        return (
+            interaction.user.id == self.owner_id
+            and interaction.guild_id == self.guild_id
+        )
 
-    async def prev_button_callback(self, interaction: discord.Interaction):
-        if self.current_page > 0:
-            self.current_page -= 1
-        await self.update_page(interaction)
+    async def callback(self, interaction: discord.Interaction):
+        await edit_page(
+            interaction, self.scope, self.target_id, self.page, self.owner_id
+        )
 
-    async def next_button_callback(self, interaction: discord.Interaction):
-        if self.current_page < len(self.pages) - 1:
-            self.current_page += 1
-        await self.update_page(interaction)
 
+class RankingScopeSelect(
+    discord.ui.DynamicItem[discord.ui.Select],
+    template=r"lvs:(?P<guild>\d+):(?P<owner>\d+)",
+):
+    def __init__(self, guild_id: int, owner_id: int, scope: str | None = None):
+        super().__init__(
+            discord.ui.Select(
+                custom_id=f"lvs:{guild_id}:{owner_id}",
+                placeholder="Select a page",
+                options=[
+                    discord.SelectOption(
+                        label="Top Members",
+                        value=SCOPE_TOP_MEMBERS,
+                        default=scope == SCOPE_TOP_MEMBERS,
+                    ),
+                    discord.SelectOption(
+                        label="Top Members in Channel",
+                        value=SCOPE_TOP_MEMBERS_IN_CHANNEL,
+                        default=scope == SCOPE_TOP_MEMBERS_IN_CHANNEL,
+                    ),
+                    discord.SelectOption(
+                        label="Top Channels",
+                        value=SCOPE_TOP_CHANNELS,
+                        default=scope == SCOPE_TOP_CHANNELS,
+                    ),
+                ],
+            )
+        )
+        self.guild_id = guild_id
+        self.owner_id = owner_id
 
-class RankEmbedPage(discord.ui.View):
-    def __init__(
-        self,
-        user: discord.User,
-        stats_embed: discord.Embed,
-        top_channels_embeds: list[discord.Embed],
+    @classmethod
+    async def from_custom_id(
+        cls,
+        interaction: discord.Interaction,
+        item: discord.ui.Select,
+        match: re.Match[str],
     ):
-        super().__init__()
-        self.user = user
-        self.stats_embed = stats_embed
-        self.top_channels_embed = top_channels_embeds[0]
-        self.top_channels_pages = top_channels_embeds
-        self.top_channels_current_page = 0
-        self.stats_button = discord.ui.Button(
-            label="Stats", style=discord.ButtonStyle.primary, disabled=True
-        )
-        self.top_channels_button = discord.ui.Button(
-            label="Top Channels", style=discord.ButtonStyle.secondary
-        )
-        self.prev_button = discord.ui.Button(
-            label="⬅", style=discord.ButtonStyle.primary, disabled=True, row=1
-        )
-        self.next_button = discord.ui.Button(
-            label="➡",
-            style=discord.ButtonStyle.primary,
-            disabled=(len(self.top_channels_pages) == 1),
-            row=1,
-        )
-        self.page_label = discord.ui.Button(
-            label=f"{self.top_channels_current_page + 1}/{len(self.top_channels_pages)}",
-            style=discord.ButtonStyle.secondary,
-            disabled=True,
-            row=1,
-        )
-        self.stats_button.callback = self.stats_button_callback
-        self.top_channels_button.callback = self.top_channels_button_callback
-        self.prev_button.callback = self.top_channels_prev_button_callback
-        self.next_button.callback = self.top_channels_next_button_callback
-        self.add_item(self.stats_button)
-        self.add_item(self.top_channels_button)
-
-    async def interaction_check(self, interaction: discord.Interaction):
-        return interaction.user.id == self.user.id
-
-    async def stats_button_callback(self, interaction: discord.Interaction):
-        self.stats_button.disabled = True
-        self.stats_button.style = discord.ButtonStyle.primary
-        self.top_channels_button.disabled = False
-        self.top_channels_button.style = discord.ButtonStyle.secondary
-        self.remove_item(self.prev_button)
-        self.remove_item(self.page_label)
-        self.remove_item(self.next_button)
-        await interaction.response.edit_message(embed=self.stats_embed, view=self)
-
-    async def top_channels_button_callback(self, interaction: discord.Interaction):
-        self.stats_button.disabled = False
-        self.stats_button.style = discord.ButtonStyle.secondary
-        self.top_channels_button.disabled = True
-        self.top_channels_button.style = discord.ButtonStyle.primary
-        self.add_item(self.prev_button)
-        self.add_item(self.page_label)
-        self.add_item(self.next_button)
-        await interaction.response.edit_message(
-            embed=self.top_channels_embed, view=self
-        )
-
-    async def top_channels_update_page(self, interaction: discord.Interaction) -> None:
-        if self.top_channels_current_page == 0:
-            self.prev_button.disabled = True
-        else:
-            self.prev_button.disabled = False
-        if self.top_channels_current_page == len(self.top_channels_pages) - 1:
-            self.next_button.disabled = True
+        return cls(int(match["guild"]), int(match["owner"]))
+
+    async def interaction_check(self, interaction: discord.Interaction) -> bool:
+        return (
+            interaction.user.id == self.owner_id
+            and interaction.guild_id == self.guild_id
+        )
+
+    async def callback(self, interaction: discord.Interaction):
+        await edit_page(interaction, self.item.values[0], 0, 0, self.owner_id)
+
+
+class RankingChannelSelect(
+    discord.ui.DynamicItem[discord.ui.ChannelSelect],
+    template=r"lvc:(?P<guild>\d+):(?P<owner>\d+)",
+):
+    def __init__(self, guild_id: int, owner_id: int):
+        super().__init__(
+            discord.ui.ChannelSelect(
+                custom_id=f"lvc:{guild_id}:{owner_id}",
+                placeholder="Select a channel",
+                channel_types=[discord.ChannelType.text],
+            )
+        )
+        self.guild_id = guild_id
+        self.owner_id = owner_id
+
+    @classmethod
+    async def from_custom_id(
+        cls,
+        interaction: discord.Interaction,
+        item: discord.ui.ChannelSelect,
+        match: re.Match[str],
+    ):
+        return cls(int(match["guild"]), int(match["owner"]))
+
+    async def interaction_check(self, interaction: discord.Interaction) -> bool:
+        return (
+            interaction.user.id == self.owner_id
+            and interaction.guild_id == self.guild_id
+        )
+
+    async def callback(self, interaction: discord.Interaction):
+        await edit_page(
+            interaction,
+            SCOPE_TOP_MEMBERS_IN_CHANNEL,
+            self.item.values[0].id,
+            0,
+            self.owner_id,
+        )
+
+
+def build_page_view(
+    scope: str, guild_id: int, target_id: int, page: int, pages: int, owner_id: int
+) -> discord.ui.View:
+    """
+    ページ操作用のViewを組み立てます
+    """
+
+    view = discord.ui.View(timeout=None)
+    paginate = True
+    if scope in TOP_SCOPES:
+        view.add_item(RankingScopeSelect(guild_id, owner_id, scope))
+        if scope == SCOPE_TOP_MEMBERS_IN_CHANNEL and target_id == 0:
+            view.add_item(RankingChannelSelect(guild_id, owner_id))
+            paginate = False
+    else:
+        for tab_scope, label in (
+            (SCOPE_RANK_STATS, "Stats"),
+            (SCOPE_RANK_CHANNELS, "Top Channels"),
+        ):
+            view.add_item(
+                RankingPageButton(
+                    tab_scope,
+                    guild_id,
+                    target_id,
+                    0,
+                    owner_id,
+                    "t",
+                    label=label,
+                    style=discord.ButtonStyle.primary
+                    if scope == tab_scope
+                    else discord.ButtonStyle.secondary,
+                    disabled=scope == tab_scope,
+                )
+            )
+        paginate = scope == SCOPE_RANK_CHANNELS
+
+    if paginate:
+        view.add_item(
+            RankingPageButton(
+                scope,
+                guild_id,
+                target_id,
+                max(page - 1, 0),
+                owner_id,
+                "p",
+                label="⬅",
+                style=discord.ButtonStyle.primary,
+                disabled=page == 0,
+                row=1,
+            )
+        )
+        view.add_item(
+            discord.ui.Button(
+                label=f"{page + 1}/{pages}",
+                style=discord.ButtonStyle.secondary,
+                disabled=True,
+                row=1,
+            )
+        )
+        view.add_item(
+            RankingPageButton(
+                scope,
+                guild_id,
+                target_id,
+                min(page + 1, pages - 1),
+                owner_id,
+                "n",
+                label="➡",
+                style=discord.ButtonStyle.primary,
+                disabled=page >= pages - 1,
+                row=1,
+            )
+        )
+
+    # 状態は全てcustom_idにあるので、ViewStoreに保持させないよう送信前に止めておく
+    # ボタンはLeveling.cog_loadで登録したDynamicItemが処理する
+    view.stop()
+    return view
+
+
+async def rank_card_file(
+    bot: DiscordLevelBot,
+    user: discord.abc.User,
+    rank: str,
+    level: int,
+    exp: int,
+    next_exp: int,
+) -> discord.File | None:
+    try:
+        avatar = await bot.renderer.avatar(user.display_avatar)
+        data = await bot.renderer.rank_card(
+            RankCardSpec(user.display_name, avatar, rank, level, exp, next_exp)
+        )
+    except TimeoutError:
+        # 画像を作れなくてもテキストのEmbedは表示する
+        logging.getLogger("leveling").warning("Timed out rendering rank card")
+        return None
+    except Exception:
+        logging.getLogger("leveling").exception("Failed to render rank card")
+        return None
+    return discord.File(io.BytesIO(data), "rank.png")
+
+
+async def leaderboard_file(
+    bot: DiscordLevelBot, guild: discord.Guild, title: str, rows: list[tuple]
+) -> discord.File | None:
+    members = [guild.get_member(user_id) for user_id, _, _ in rows]
+    try:
+        avatars = await asyncio.gather(
+            *(
+                bot.renderer.avatar(member.display_avatar if member else None)
+                for member in members
+            )
+        )
+        spec = LeaderboardSpec(
+            title,
+            tuple(
+                LeaderboardRow(
+                    ranking,
+                    member.display_name if member else str(user_id),
+                    avatar,
+                    *calculation_level(exp),
+                )
+                for (user_id, exp, ranking), member, avatar in zip(
+                    rows, members, avatars
+                )
+            ),
+        )
+        data = await bot.renderer.leaderboard(spec)
+    except TimeoutError:
+        logging.getLogger("leveling").warning("Timed out rendering leaderboard")
+        return None
+    except Exception:
+        logging.getLogger("leveling").exception("Failed to render leaderboard")
+        return None
+    return discord.File(io.BytesIO(data), "leaderboard.png")
+
+
+async def edit_page(
+    interaction: discord.Interaction,
+    scope: str,
+    target_id: int,
+    page: int,
+    owner_id: int,
+) -> None:
+    # 集計と画像の描画は3秒の応答期限を超えることがあるので、先に応答してから編集する
+    await interaction.response.defer()
+    embed, view, files = await render_page(
+        interaction, scope, target_id, page, owner_id
+    )
+    await interaction.edit_original_response(
+        embed=embed or discord.Embed(description="No Data"),
+        view=view,
+        attachments=files,
+    )
+
+
+async def render_page(
+    interaction: discord.Interaction,
+    scope: str,
+    target_id: int,
+    page: int,
+    owner_id: int,
+    user: discord.abc.User | None = None,
+) -> tuple[discord.Embed | None, discord.ui.View, list[discord.File]]:
+    """
+    指定したページだけをDBから取得してEmbedとViewを作ります
+    データがない場合のEmbedはNoneになります
+    ランクカードとメンバーのランキングは画像も作り、添付するファイルとして返します
+    """
+
+    bot = interaction.client
+    guild = interaction.guild
+    offset = page * PAGE_SIZE
+    count = 1
+    files = []
+    if scope == SCOPE_TOP_MEMBERS:
+        rows, count = await bot.db.get_user_level_ranking_total_page(
+            guild.id, offset, PAGE_SIZE
+        )
+        embed = discord.Embed(
+            title="ランキング",
+            description="\n".join(
+                [
+                    f"{ranking}位 <@{user_id}>\nLv. {calculation_level(exp)[0]} Exp. {calculation_level(exp)[1]}"
+                    for user_id, exp, ranking in rows
+                ]
+            ),
+        )
+        if rows:
+            file = await leaderboard_file(bot, guild, "Ranking", rows)
+            if file is not None:
+                files.append(file)
+                embed.set_image(url=f"attachment://{file.filename}")
+    elif scope == SCOPE_TOP_MEMBERS_IN_CHANNEL and target_id == 0:
+        embed = discord.Embed(description="チャンネルを選択してください")
+        rows = [None]
+    elif scope == SCOPE_TOP_MEMBERS_IN_CHANNEL:
+        rows, count = await bot.db.get_user_level_ranking_page(
+            guild.id, target_id, offset, PAGE_SIZE
+        )
+        channel = guild.get_channel(target_id)
+        embed = discord.Embed(
+            title=f"チャンネルランキング {channel.name if channel else target_id}",
+            description="\n".join(
+                [
+                    f"{ranking}位 <@{user_id}> Exp. {exp}"
+                    for user_id, exp, ranking in rows
+                ]
+            ),
+        )
+    elif scope == SCOPE_TOP_CHANNELS:
+        rows, count = await bot.db.get_user_level_ranking_total_channel_page(
+            guild.id, offset, PAGE_SIZE
+        )
+        embed = discord.Embed(
+            title="チャンネルランキング",
+            description="\n".join(
+                [
+                    f"{ranking}位 <#{channel_id}> Exp. {exp}"
+                    for channel_id, exp, ranking in rows
+                ]
+            ),
+        )
+    elif scope == SCOPE_RANK_CHANNELS:
+        rows, count = await bot.db.get_user_level_ranking_channel_page(
+            target_id, guild.id, offset, PAGE_SIZE
+        )
+        embed = discord.Embed(
+            title="チャンネルランキング",
+            description="\n".join(
+                [
+                    f"{ranking}位 <#{channel_id}> Exp. {exp}"
+                    for channel_id, exp, ranking in rows
+                ]
+            ),
+        )
+    else:
+        leveling = bot.get_cog("Leveling")
+        # 概算順位モードではRANK()を使わずにスケッチから順位を求める
+        approximate = (
+            await leveling.approximate_rank(guild.id, target_id)
+            if leveling is not None
+            else None
+        )
+        if approximate is not None:
+            exp, ranking, detail = approximate
+            ranking_text = f"約**{ranking}位** {detail}"
+            rank_label = f"~#{ranking}"
         else:
-            self.next_button.disabled = False
-        self.page_label.label = (
-            f"{self.top_channels_current_page + 1}/{len(self.top_channels_pages)}"
+            exp, ranking = await bot.db.get_user_profile(target_id, guild.id)
+            if leveling is not None:
+                exp += leveling._buffer.pending_total(guild.id, target_id)
+            # まだフラッシュされていないEXPしかないメンバーはDBに順位がない
+            ranking_text = f"**{ranking if ranking is not None else '-'}位**"
+            rank_label = f"#{ranking if ranking is not None else '-'}"
+        rows = [exp] if exp else []
+        level, exp = calculation_level(exp)
+        next_exp = calculation_next_level_exp(level)
+        embed = discord.Embed(
+            description=f"現在{ranking_text}\nLevel: `{level}`\nExp: `{exp}/{next_exp}`"
         )
-        await interaction.response.edit_message(
-            embed=self.top_channels_pages[self.top_channels_current_page], view=self
+        user = user or guild.get_member(target_id) or bot.get_user(target_id)
+        if user is None:
+            user = await bot.fetch_user(target_id)
+        embed.set_author(
+            name=f"{user.display_name}のランクカード", icon_url=user.display_avatar.url
         )
+        if rows:
+            file = await rank_card_file(bot, user, rank_label, level, exp, next_exp)
+            if file is not None:
+                files.append(file)
+                embed.set_image(url=f"attachment://{file.filename}")
+
+    if len(rows) == 0:
+        embed = None
+    pages = max((count + PAGE_SIZE - 1) // PAGE_SIZE, 1)
+    return (
+        embed,
+        build_page_view(scope, guild.id, target_id, page, pages, owner_id),
+        files,
+    )
+
 
-    async def top_channels_prev_button_callback(self, interaction: discord.Interaction):
-        if self.top_channels_current_page > 0:
-            self.top_channels_current_page -= 1
-        await self.top_channels_update_page(interaction)
+def move_in_sketch(sketch: RankSketch, old: int, new: int) -> None:
+    """
+    1人の合計EXPがoldからnewに変わったことをスケッチに反映します
+    """
 
-    async def top_channels_next_button_callback(self, interaction: discord.Interaction):
-        if self.top_channels_current_page < len(self.top_channels_pages) - 1:
-            self.top_channels_current_page += 1
-        await self.top_channels_update_page(interaction)
+    if old <= 0:
+        # DBにもバッファにも加算がないメンバーはスケッチに含まれていないので新しく数える
+        sketch.add(new)
+    else:
+        sketch.move(old, new)
 
 
 class Leveling(commands.Cog):
     def __init__(self, bot: DiscordLevelBot):
         self.bot = bot
-        self._locks: [int, asyncio.Lock] = {}
+        self.logger = logging.getLogger("leveling")
+        self._guild_settings: dict[int, tuple[int, int, bool]] = {}
+        self._level_roles: dict[int, list[tuple[int, int]]] = {}
+        self._exp_rules: dict[int, ExpRules] = {}
+        # (guild_id, user_id) -> バッファ分を含む合計EXP
+        self._totals: dict[tuple[int, int], int] = {}
+        self._buffer = ExpBuffer()
+        self.flush_interval = float(os.environ.get("EXP_FLUSH_INTERVAL", 5))
+        self._last_flush = time.monotonic()
+        # DBが遅い時にon_messageのタスクが際限なく溜まらないよう、XP処理の数を制限する
+        self.admission = AdmissionController(
+            int(os.environ.get("XP_MAX_CONCURRENCY", 5)),
+            int(os.environ.get("XP_MAX_QUEUE", 256)),
+        )
+        # 制限を超えたメッセージ (guild_id, user_id, channel_id) -> メッセージ数をまとめたイベント
+        self._deferred: dict[tuple[int, int, int], XpEvent] = {}
+        # レベルアップの通知とロール付与はロックの外でメンバーごとに順番に行う
+        self.dispatcher = MemberDispatcher(
+            int(os.environ.get("LEVEL_UP_CONCURRENCY", 50))
+        )
+        self.voice_sessions = VoiceSessions()
+        # guild_id -> (集計した時刻, 統計)
+        self._stats: dict[int, tuple[float, LevelStats]] = {}
+        # 同じギルドの集計が同時に走らないよう、実行中の集計を共有する
+        self._stats_tasks: dict[int, asyncio.Task] = {}
+        self.stats_ttl = float(os.environ.get("LEVEL_STATS_TTL", 300))
+        # 概算順位モード guild_id -> 正確な順位を使う範囲 (無効ならNone)
+        self._rank_modes: dict[int, int | None] = {}
+        # guild_id -> (作成した時刻, スケッチ)
+        self._rank_sketches: dict[int, tuple[float, RankSketch]] = {}
+        self._sketch_tasks: dict[int, asyncio.Task] = {}
+        # 作成中のスケッチに後から反映する合計EXPの変化 guild_id -> [(変更前, 変更後)]
+        self._sketch_updates: dict[int, list[tuple[int, int]]] = {}
+        # 合計EXPのキャッシュにないユーザーの加算は反映されないので、一定時間で作り直す
+        self.rank_sketch_ttl = float(os.environ.get("RANK_SKETCH_TTL", 3600))
+        self.rank_accuracy = float(os.environ.get("RANK_SKETCH_ACCURACY", 0.01))
+        self.voice_interval = float(os.environ.get("VOICE_EXP_INTERVAL", 60))
+        # 有効にするとdiscord.Messageを作らずに生のMESSAGE_CREATEからEXPを加算する
+        self.raw_ingest = (
+            RawMessageIngest(bot, self.ingest, self.on_message)
+            if os.environ.get("XP_FAST_PATH", "").lower() in ("1", "true", "yes")
+            else None
+        )
+
+    async def cog_load(self) -> None:
+        state = self.bot.cog_states.pop(self.qualified_name, None)
+        if state is not None:
+            self.import_state(state)
+        self.bot.shared.subscribe("leveling", self.on_invalidate)
+        self.bot.add_dynamic_items(
+            RankingPageButton, RankingScopeSelect, RankingChannelSelect
+        )
+        if self.bot.is_ready() and state is None:
+            self.voice_sessions.rebuild(self.bot.guilds)
+        if self.raw_ingest is not None:
+            self.raw_ingest.install()
+        self.flush_loop.start()
+        self.drain_loop.start()
+        self.voice_loop.change_interval(seconds=self.voice_interval)
+        self.voice_loop.start()
+
+    async def cog_unload(self) -> None:
+        self.bot.shared.unsubscribe("leveling", self.on_invalidate)
+        self.bot.remove_dynamic_items(
+            RankingPageButton, RankingScopeSelect, RankingChannelSelect
+        )
+        if self.raw_ingest is not None:
+            self.raw_ingest.uninstall()
+        # 実行中のフラッシュは最後まで行わせる
+        self.flush_loop.stop()
+        self.drain_loop.stop()
+        self.voice_loop.stop()
+
+    def export_state(self) -> dict:
+        """
+        リロード時に新しいインスタンスへ引き継ぐ状態を返します
+        """
+
+        # バッファも同じオブジェクトを渡すので、書き込み待ちのEXPが失われたり二重に加算されたりしない
+        return {
+            "guild_settings": self._guild_settings,
+            "level_roles": self._level_roles,
+            "exp_rules": self._exp_rules,
+            "totals": self._totals,
+            "buffer": self._buffer,
+            "admission": self.admission,
+            "deferred": self._deferred,
+            "dispatcher": self.dispatcher,
+            "voice_sessions": self.voice_sessions,
+            "rank_modes": self._rank_modes,
+            "rank_sketches": self._rank_sketches,
+        }
+
+    def import_state(self, state: dict) -> None:
+        """
+        export_stateで退避された状態を引き継ぎます
+        """
+
+        self._guild_settings = state.get("guild_settings", self._guild_settings)
+        self._level_roles = state.get("level_roles", self._level_roles)
+        self._exp_rules = state.get("exp_rules", self._exp_rules)
+        self._totals = state.get("totals", self._totals)
+        self._buffer = state.get("buffer", self._buffer)
+        self.admission = state.get("admission", self.admission)
+        self._deferred = state.get("deferred", self._deferred)
+        self.dispatcher = state.get("dispatcher", self.dispatcher)
+        self.voice_sessions = state.get("voice_sessions", self.voice_sessions)
+        self._rank_modes = state.get("rank_modes", self._rank_modes)
+        self._rank_sketches = state.get("rank_sketches", self._rank_sketches)
+
+    def on_invalidate(self, message: str) -> None:
+        # 他のプロセスを含む管理者コマンドからのキャッシュ無効化通知
+        payload = json.loads(message)
+        if payload["scope"] == "guild":
+            self.invalidate_guild(payload["guild_id"])
+        elif payload["scope"] == "member":
+            self.invalidate_member(payload["guild_id"], payload.get("user_id"))
+
+    def invalidate_guild(self, guild_id: int) -> None:
+        """
+        ギルドの設定キャッシュを破棄します
+        """
+
+        self._guild_settings.pop(guild_id, None)
+        self._level_roles.pop(guild_id, None)
+        self._exp_rules.pop(guild_id, None)
+        self._rank_modes.pop(guild_id, None)
+
+    def invalidate_member(self, guild_id: int, user_id: int | None = None) -> None:
+        """
+        ユーザーの合計EXPのキャッシュを破棄します
+        user_idを指定しない場合はギルド全体を破棄します
+        """
+
+        # 管理者による変更は前後の合計EXPが分からないのでスケッチも作り直す
+        # 作成中のスケッチは変更前の値を読んでいるかもしれないので保存させない
+        self._rank_sketches.pop(guild_id, None)
+        self._sketch_updates.pop(guild_id, None)
+        if user_id is not None:
+            self._totals.pop((guild_id, user_id), None)
+            return
+        for key in [key for key in self._totals if key[0] == guild_id]:
+            del self._totals[key]
+
+    async def get_guild_setting(self, guild_id: int) -> tuple[int, int, bool]:
+        guild_setting = self._guild_settings.get(guild_id)
+        if guild_setting is None:
+            guild_setting = await self.bot.db.get_guild_setting(guild_id)
+            self._guild_settings[guild_id] = guild_setting
+        return guild_setting
+
+    async def get_guild_level_roles(self, guild_id: int) -> list[tuple[int, int]]:
+        level_roles = self._level_roles.get(guild_id)
+        if level_roles is None:
+            level_roles = await self.bot.db.get_guild_level_roles(guild_id)
+            self._level_roles[guild_id] = level_roles
+        return level_roles
+
+    async def get_exp_rules(self, guild_id: int) -> ExpRules:
+        exp_rules = self._exp_rules.get(guild_id)
+        if exp_rules is None:
+            exp_rules = compile_exp_rules(await self.bot.db.get_exp_rules(guild_id))
+            self._exp_rules[guild_id] = exp_rules
+        return exp_rules
+
+    async def get_user_total(self, guild_id: int, user_id: int) -> int:
+        key = (guild_id, user_id)
+        total = self._totals.get(key)
+        if total is None:
+            # フラッシュ中はDBとバッファのどちらにも含まれない加算があるので待つ
+            async with self._buffer.flush_lock:
+                total = await self.bot.db.get_user_level_total(user_id, guild_id) or 0
+                total += self._buffer.pending_total(guild_id, user_id)
+            self._totals[key] = total
+        return total
+
+    async def load_user_totals(self, guild_id: int, user_ids: list[int]) -> None:
+        """
+        キャッシュにない合計EXPを1回のクエリでまとめて読み込みます
+        """
+
+        missing = [
+            user_id for user_id in user_ids if (guild_id, user_id) not in self._totals
+        ]
+        if not missing:
+            return
+        async with self._buffer.flush_lock:
+            totals = await self.bot.db.get_user_level_totals(guild_id, missing)
+            for user_id in missing:
+                self._totals.setdefault(
+                    (guild_id, user_id),
+                    totals.get(user_id, 0)
+                    + self._buffer.pending_total(guild_id, user_id),
+                )
+
+    def add_exp(self, user_id: int, guild_id: int, channel_id: int, exp: int) -> None:
+        """
+        EXPをジャーナルに記録してバッファに加算します
+        DBへの書き込みはflushでまとめて行います
+        """
+
+        self.bot.journal.append(user_id, guild_id, channel_id, exp)
+        self._buffer.add(user_id, guild_id, channel_id, exp)
+        key = (guild_id, user_id)
+        if key in self._totals:
+            total = self._totals[key]
+            self._totals[key] = total + exp
+            sketch = self._rank_sketches.get(guild_id)
+            if sketch is not None:
+                move_in_sketch(sketch[1], total, total + exp)
+            updates = self._sketch_updates.get(guild_id)
+            if updates is not None:
+                updates.append((total, total + exp))
+
+    async def flush(self) -> None:
+        """
+        バッファされたEXPをDBに書き込みます
+        """
+
+        async with self._buffer.flush_lock:
+            self._last_flush = time.monotonic()
+            if len(self._buffer) == 0:
+                return
+
+            # セグメントの切り替えとバッファの取り出しの間にawaitを挟まないので、
+            # 閉じたセグメントのレコードと取り出した加算は一致する
+            segments = self.bot.journal.rotate()
+            journal_seq = self.bot.journal.seq
+            pending = self._buffer.take()
+            rows = [
+                (user_id, guild_id, channel_id, exp)
+                for (user_id, guild_id, channel_id), exp in pending.items()
+            ]
+            try:
+                await self.bot.db.apply_exp_batch(
+                    rows, self.bot.journal.journal_id, journal_seq
+                )
+            except Exception:
+                # コミット後に接続が切れた場合は適用済みなので戻さない
+                try:
+                    applied = (
+                        await self.bot.db.get_journal_seq(self.bot.journal.journal_id)
+                        >= journal_seq
+                    )
+                except Exception:
+                    applied = False
+                if not applied:
+                    self._buffer.restore(pending)
+                    raise
+
+            self.bot.journal.remove(segments)
+
+    @tasks.loop(seconds=1)
+    async def flush_loop(self):
+        # fsyncはメッセージごとではなく1秒ごとにまとめて行う
+        self.bot.journal.sync()
+        if time.monotonic() - self._last_flush >= self.flush_interval:
+            try:
+                await self.flush()
+            except Exception:
+                self.logger.exception("Failed to flush buffered exp")
+
+    @flush_loop.before_loop
+    async def before_flush_loop(self):
+        await self.bot.wait_until_ready()
+
+    def defer(self, event: XpEvent) -> None:
+        """
+        処理しきれないメッセージをまとめておき、後で1回の加算とレベルアップ判定で処理します
+        """
+
+        key = (event.guild_id, event.user_id, event.channel_id)
+        deferred = self._deferred.get(key)
+        if deferred is None:
+            self._deferred[key] = event
+        else:
+            deferred.count += event.count
+        self.admission.deferred += 1
+
+    @tasks.loop(seconds=1)
+    async def drain_loop(self):
+        # 空いている枠の分だけ後回しにしたメッセージを処理する
+        while self._deferred and self.admission.available() > 0:
+            batch = []
+            for _ in range(min(self.admission.available(), len(self._deferred))):
+                key = next(iter(self._deferred))
+                batch.append(self._deferred.pop(key))
+            await asyncio.gather(*(self.accrue_admitted(event) for event in batch))
+
+    @drain_loop.before_loop
+    async def before_drain_loop(self):
+        await self.bot.wait_until_ready()
+
+    async def accrue_admitted(self, event: XpEvent) -> None:
+        slot = self.admission.try_acquire()
+        if slot is None:
+            key = (event.guild_id, event.user_id, event.channel_id)
+            deferred = self._deferred.setdefault(key, event)
+            if deferred is not event:
+                deferred.count += event.count
+            return
+        async with slot:
+            try:
+                await self.accrue(event)
+            except Exception:
+                self.logger.exception("Failed to process deferred messages")
 
     @commands.Cog.listener()
     async def on_message(self, message: discord.Message):
+        if self.raw_ingest is not None:
+            # 生のペイロードから処理済み
+            return
         if message.author.bot or not message.guild or message.is_system():
             return
+        await self.ingest(XpEvent.from_message(message))
 
-        lock = self._locks.get(message.author.id)
-        if not lock:
-            self._locks[message.author.id] = lock = asyncio.Lock()
+    async def ingest(self, event: XpEvent) -> None:
+        slot = self.admission.try_acquire()
+        if slot is None:
+            self.defer(event)
+            return
+        async with slot:
+            await self.accrue(event)
 
-        async with lock:
-            guild_setting = await self.bot.db.get_guild_setting(message.guild.id)
-            min_exp, max_exp, stack_level_roles = guild_setting
+    async def accrue(self, event: XpEvent) -> None:
+        """
+        event.count件のメッセージ分のEXPを加算し、レベルアップしていれば通知とロール付与を予約します
 
-            exp = await self.bot.db.get_user_level_total(
-                message.author.id, message.guild.id
-            )
-            level, _ = calculation_level(exp)
-            increase_exp = random.randint(min_exp, max_exp)
-            increased_exp = exp + increase_exp
-            increased_level, _ = calculation_level(increased_exp)
-            await self.bot.db.add_user_level(
-                message.author.id, message.guild.id, message.channel.id, increase_exp
-            )
+        1. 設定とルールから加算するEXPを決める (ロックなし)
+        2. 合計EXPの読み込みと加算 (メンバーのロック内、awaitを挟まない)
+        3. レベルの変化を判定し、副作用はdispatcherでロックの外で実行する
+        """
 
-            if level < increased_level:
-                await message.channel.send(
-                    f"{message.author.mention} LEVEL UP! `{level}` -> `{increased_level}`"
-                )
+        increase_exp, stack_level_roles = await self.draw_exp(event)
+        if increase_exp <= 0:
+            return
+        exp = await self.transition(event, increase_exp)
+        change = detect_level_change(event, exp, exp + increase_exp, stack_level_roles)
+        if change is not None:
+            self.dispatch_level_up(change)
+
+    async def draw_exp(self, event: XpEvent) -> tuple[int, bool]:
+        """
+        加算するEXPとレベルロールを複数保持するかを返します
+        """
+
+        exp_rules = await self.get_exp_rules(event.guild_id)
+        multiplier = exp_rules.multiplier(
+            event.channel_id, event.parent_id, event.role_ids
+        )
+        if multiplier <= 0:
+            return 0, False
+        min_exp, max_exp, stack_level_roles = await self.get_guild_setting(
+            event.guild_id
+        )
+        increase_exp = round(
+            sum(random.randint(min_exp, max_exp) for _ in range(event.count))
+            * multiplier
+        )
+        return increase_exp, stack_level_roles
+
+    async def transition(self, event: XpEvent, increase_exp: int) -> int:
+        """
+        合計EXPにincrease_expを加算し、加算前の合計EXPを返します
+        """
+
+        # DBからの読み込みはロックの前に済ませておく
+        await self.get_user_total(event.guild_id, event.user_id)
+        async with self.bot.shared.lock(f"member:{event.guild_id}:{event.user_id}"):
+            exp = await self.get_user_total(event.guild_id, event.user_id)
+            self.add_exp(event.user_id, event.guild_id, event.channel_id, increase_exp)
+        return exp
+
+    def dispatch_level_up(self, change: LevelChange) -> None:
+        self.dispatcher.dispatch(
+            (change.guild_id, change.user_id), lambda: self.level_up(change)
+        )
+
+    async def level_up(self, change: LevelChange) -> None:
+        """
+        レベルアップを通知し、レベルロールを付与します
+        """
+
+        channel = self.bot.get_partial_messageable(
+            change.channel_id, guild_id=change.guild_id
+        )
+        await channel.send(
+            f"<@{change.user_id}> LEVEL UP! `{change.level}` -> `{change.increased_level}`"
+        )
+
+        level_roles = await self.get_guild_level_roles(change.guild_id)
+        add_level_roles = [r for r in level_roles if r[1] == change.increased_level]
+        if len(add_level_roles) == 0:
+            return
+
+        for role_id, _ in add_level_roles:
+            await self.bot.http.add_role(change.guild_id, change.user_id, role_id)
+        if not change.stack_level_roles:
+            for role_id, role_level in level_roles:
+                if role_level != change.increased_level:
+                    await self.bot.http.remove_role(
+                        change.guild_id, change.user_id, role_id
+                    )
 
-                level_roles = await self.bot.db.get_guild_level_roles(message.guild.id)
-                add_level_roles = list(
-                    filter(lambda r: r[1] == increased_level, level_roles)
+    @commands.Cog.listener()
+    async def on_ready(self):
+        self.voice_sessions.rebuild(self.bot.guilds)
+
+    @commands.Cog.listener()
+    async def on_guild_remove(self, guild: discord.Guild):
+        self.voice_sessions.remove_guild(guild.id)
+
+    @commands.Cog.listener()
+    async def on_voice_state_update(
+        self,
+        member: discord.Member,
+        before: discord.VoiceState,
+        after: discord.VoiceState,
+    ):
+        self.voice_sessions.update(member, after)
+
+    @tasks.loop(seconds=60)
+    async def voice_loop(self):
+        # 付与するEXPはバッファに加算するだけなので、DBへの書き込みは次のフラッシュで1回にまとまる
+        for guild_id in list(self.voice_sessions.guilds):
+            try:
+                sessions = list(self.voice_sessions.eligible(guild_id))
+                if not sessions:
+                    continue
+                min_exp, max_exp, stack_level_roles = await self.get_guild_setting(
+                    guild_id
+                )
+                exp_rules = await self.get_exp_rules(guild_id)
+                await self.load_user_totals(
+                    guild_id, [session.member.id for session in sessions]
                 )
-                if len(add_level_roles) == 0:
-                    return
-
-                for role in add_level_roles:
-                    await message.author.add_roles(discord.Object(id=role[0]))
-                if not stack_level_roles:
-                    remove_level_roles = list(
-                        filter(lambda r: r[1] != increased_level, level_roles)
+
+                for i, session in enumerate(sessions):
+                    # 数万人分を処理する間もイベントループを止めない
+                    if i % 1000 == 999:
+                        await asyncio.sleep(0)
+                    member, channel = session.member, session.channel
+                    multiplier = exp_rules.multiplier(
+                        channel.id, channel.category_id, member._roles
                     )
-                    for role in remove_level_roles:
-                        await message.author.remove_roles(discord.Object(id=role[0]))
+                    increase_exp = round(random.randint(min_exp, max_exp) * multiplier)
+                    if increase_exp <= 0:
+                        continue
+
+                    # 合計の読み込みから加算までawaitを挟まないので、テキストの処理と競合しない
+                    exp = self._totals.get((guild_id, member.id))
+                    self.add_exp(member.id, guild_id, channel.id, increase_exp)
+                    if exp is None:
+                        # ループの途中でキャッシュが破棄された場合は、加算後の合計を読み直す
+                        exp = (
+                            await self.get_user_total(guild_id, member.id)
+                            - increase_exp
+                        )
+                    level = get_level(exp)
+                    increased_level = get_level(exp + increase_exp)
+                    if level < increased_level:
+                        self.dispatch_level_up(
+                            LevelChange(
+                                guild_id,
+                                member.id,
+                                channel.id,
+                                level,
+                                increased_level,
+                                stack_level_roles,
+                            )
+                        )
+            except Exception:
+                # 1つのギルドで失敗しても他のギルドとループ自体は止めない
+                self.logger.exception(f"Failed to grant voice exp in guild {guild_id}")
+
+    @voice_loop.before_loop
+    async def before_voice_loop(self):
+        await self.bot.wait_until_ready()
 
     @app_commands.command(name="rank", description="現在のレベルを表示します")
     @app_commands.describe(user="表示するメンバー")
@@ -287,85 +974,177 @@ class Leveling(commands.Cog):
         await interaction.response.defer()
 
         user = user or interaction.user
-        exp = await self.bot.db.get_user_level_total(user.id, interaction.guild.id)
-        if not exp:
+        embed, view, files = await render_page(
+            interaction, SCOPE_RANK_STATS, user.id, 0, interaction.user.id, user
+        )
+        if embed is None:
             await interaction.followup.send("No Data")
             return
 
-        level, exp = calculation_level(exp)
-        ranking = await self.bot.db.get_user_level_rank_total(
-            user.id, interaction.guild.id
-        )
-        stats_embed = discord.Embed(
-            description=f"現在**{ranking}位**\nLevel: `{level}`\nExp: `{exp}/{calculation_next_level_exp(level)}`"
-        )
-        stats_embed.set_author(
-            name=f"{user.display_name}のランクカード", icon_url=user.avatar.url
-        )
-        top_channels = await self.bot.db.get_user_level_ranking_channel(
-            user.id, interaction.guild.id
-        )
-        top_channels_pages = []
-        for i in range(0, len(top_channels), 10):
-            page = discord.Embed(
-                title="チャンネルランキング",
-                description="\n".join(
-                    [
-                        f"{ranking}位 <#{channel_id}> Exp. {exp}"
-                        for channel_id, exp, ranking in top_channels[i : i + 10]
-                    ]
-                ),
-            )
-            top_channels_pages.append(page)
-        await interaction.followup.send(
-            embed=stats_embed, view=RankEmbedPage(user, stats_embed, top_channels_pages)
-        )
+        await interaction.followup.send(embed=embed, view=view, files=files)
 
     @app_commands.command(name="top", description="ランキングを表示します")
     async def top(self, interaction: discord.Interaction):
         await interaction.response.defer()
 
-        users = await self.bot.db.get_user_level_ranking_total(interaction.guild.id)
-        if len(users) == 0:
+        embed, view, files = await render_page(
+            interaction, SCOPE_TOP_MEMBERS, 0, 0, interaction.user.id
+        )
+        if embed is None:
             await interaction.followup.send("No Data")
             return
 
-        top_members_pages = []
-        for i in range(0, len(users), 10):
-            page = discord.Embed(
-                title="ランキング",
-                description="\n".join(
-                    [
-                        f"{ranking}位 <@{user_id}>\nLv. {calculation_level(exp)[0]} Exp. {calculation_level(exp)[1]}"
-                        for user_id, exp, ranking in users[i : i + 10]
-                    ]
-                ),
-            )
-            top_members_pages.append(page)
-
-        top_channels = await self.bot.db.get_user_level_ranking_total_channel(
-            interaction.guild.id
-        )
-        top_channels_pages = []
-        for i in range(0, len(top_channels), 10):
-            page = discord.Embed(
-                title="チャンネルランキング",
-                description="\n".join(
-                    [
-                        f"{ranking}位 <#{channel_id}> Exp. {exp}"
-                        for channel_id, exp, ranking in top_channels[i : i + 10]
-                    ]
-                ),
+        await interaction.followup.send(embed=embed, view=view, files=files)
+
+    async def get_rank_mode(self, guild_id: int) -> int | None:
+        if guild_id not in self._rank_modes:
+            self._rank_modes[guild_id] = await self.bot.db.get_guild_rank_mode(guild_id)
+        return self._rank_modes[guild_id]
+
+    async def build_rank_sketch(self, guild_id: int) -> RankSketch:
+        """
+        DBの合計EXPにバッファの書き込み待ちの分を足してスケッチを作ります
+        読み込み中の加算は記録しておき、読み込み後に反映します
+        """
+
+        sketch = RankSketch(self.rank_accuracy)
+        updates: list[tuple[int, int]] = []
+        scan = self.bot.db.scan_user_level_totals_by_user(guild_id)
+        try:
+            # DBの読み出す内容が確定するまでフラッシュさせないので、
+            # 取り出したバッファとDBの両方に含まれる (どちらにも含まれない) 加算はない
+            async with self._buffer.flush_lock:
+                pending = {
+                    user_id: exp
+                    for (pending_guild_id, user_id), exp in (
+                        self._buffer.pending_totals.items()
+                    )
+                    if pending_guild_id == guild_id
+                }
+                self._sketch_updates[guild_id] = updates
+                async for chunk in scan:
+                    # 最初のバッチを受け取った時点でDBの読み出す内容は確定している
+                    sketch.add_many(
+                        [total + pending.pop(user_id, 0) for user_id, total in chunk]
+                    )
+                    break
+            async for chunk in scan:
+                sketch.add_many(
+                    [total + pending.pop(user_id, 0) for user_id, total in chunk]
+                )
+            # DBにまだ行がないメンバー
+            sketch.add_many([exp for exp in pending.values() if exp > 0])
+
+            for old, new in updates:
+                move_in_sketch(sketch, old, new)
+            # 読み込み中にキャッシュが破棄された場合は保存しない
+            if self._sketch_updates.get(guild_id) is updates:
+                self._rank_sketches[guild_id] = (time.time(), sketch)
+            return sketch
+        finally:
+            await scan.aclose()
+            if self._sketch_updates.get(guild_id) is updates:
+                del self._sketch_updates[guild_id]
+
+    async def get_rank_sketch(self, guild_id: int) -> RankSketch:
+        cached = self._rank_sketches.get(guild_id)
+        if cached is not None and time.time() - cached[0] < self.rank_sketch_ttl:
+            return cached[1]
+
+        task = self._sketch_tasks.get(guild_id)
+        if task is None:
+            task = asyncio.create_task(self.build_rank_sketch(guild_id))
+            self._sketch_tasks[guild_id] = task
+            task.add_done_callback(lambda _: self._sketch_tasks.pop(guild_id, None))
+        return await asyncio.shield(task)
+
+    async def approximate_rank(
+        self, guild_id: int, user_id: int
+    ) -> tuple[int, int, str] | None:
+        """
+        概算順位モードのギルドでは、合計EXPと概算の順位、順位の幅の表示を返します
+        概算順位モードでない場合や、正確な順位を使う上位のメンバーの場合はNoneを返します
+        """
+
+        exact_top = await self.get_rank_mode(guild_id)
+        if exact_top is None:
+            return None
+        total = await self.get_user_total(guild_id, user_id)
+        if total <= 0:
+            return None
+        sketch = await self.get_rank_sketch(guild_id)
+        above, same = sketch.rank(total)
+        if above + same <= exact_top:
+            return None
+
+        # 同じバケットにいる人数の分だけ順位に幅がある
+        ranking = above + (same + 1) // 2
+        error = same // 2
+        percent = ranking / max(sketch.total, ranking) * 100
+        return total, ranking, f"(上位{percent:.1f}%、誤差±{error}位)"
+
+    async def get_level_stats(self, guild_id: int) -> tuple[float, LevelStats]:
+        cached = self._stats.get(guild_id)
+        if cached is not None and time.time() - cached[0] < self.stats_ttl:
+            return cached
+
+        task = self._stats_tasks.get(guild_id)
+        if task is None:
+            task = asyncio.create_task(
+                compute_level_stats(self.bot.db.scan_user_level_totals(guild_id))
             )
-            top_channels_pages.append(page)
+            self._stats_tasks[guild_id] = task
+            task.add_done_callback(lambda _: self._stats_tasks.pop(guild_id, None))
+        stats = await asyncio.shield(task)
+        self._stats[guild_id] = (time.time(), stats)
+        return self._stats[guild_id]
 
-        await interaction.followup.send(
-            embed=top_members_pages[0],
-            view=RankingPagination(
-                self.bot, interaction.user, top_members_pages, top_channels_pages
+    @app_commands.command(name="stats", description="レベルの分布を表示します")
+    async def stats(self, interaction: discord.Interaction):
+        await interaction.response.defer()
+
+        computed_at, stats = await self.get_level_stats(interaction.guild.id)
+        if stats.members == 0:
+            await interaction.followup.send("No Data")
+            return
+
+        embed = discord.Embed(title="レベル統計")
+        embed.add_field(name="メンバー数", value=f"{stats.members}人")
+        embed.add_field(name="平均レベル", value=f"{stats.mean_level:.1f}")
+        embed.add_field(name="最高レベル", value=str(stats.max_level))
+        embed.add_field(
+            name="パーセンタイル",
+            value="\n".join(
+                f"{p}%: Level {stats.percentile(p)}" for p in (25, 50, 75, 90, 99)
             ),
         )
 
+        # 最高レベルまでを10区間に分けて表示する
+        width = max((stats.max_level + 10) // 10, 1)
+        lines = []
+        for start in range(0, stats.max_level + 1, width):
+            count = sum(stats.histogram[start : start + width])
+            lines.append(
+                f"`{start:>4}-{start + width - 1:<4}` {count}人 ({count / stats.members:.1%})"
+            )
+        embed.add_field(name="レベル分布", value="\n".join(lines), inline=False)
+
+        level_roles = await self.get_guild_level_roles(interaction.guild.id)
+        if level_roles:
+            embed.add_field(
+                name="レベルロール到達者数",
+                value="\n".join(
+                    f"<@&{role_id}> (Level {level}): {stats.reach(level)}人 ({stats.reach(level) / stats.members:.1%})"
+                    for role_id, level in level_roles[:15]
+                ),
+                inline=False,
+            )
+        embed.set_footer(text="集計日時")
+        embed.timestamp = datetime.datetime.fromtimestamp(
+            computed_at, datetime.timezone.utc
+        )
+        await interaction.followup.send(embed=embed)
+
     @app_commands.command(name="rewards", description="レベルロールを表示します")
     async def rewards(self, interaction: discord.Interaction):
         await interaction.response.defer()
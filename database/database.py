@@ -1,11 +1,47 @@
 import asyncio
+import contextlib
+import datetime
 import logging
 import os
-from typing import Any
+import time
+from typing import Any, AsyncIterator
 
 import aiomysql
 
 
+class Transaction:
+    """
+    Database.transactionで固定された接続に対してクエリを実行します
+    """
+
+    def __init__(self, conn: aiomysql.Connection, db: "Database"):
+        self.conn = conn
+        self.db = db
+
+    async def fetchrow(self, query: str, *args: Any) -> Any:
+        started = time.perf_counter()
+        async with self.conn.cursor() as cur:
+            await cur.execute(query, *args)
+            row = await cur.fetchone()
+        self.db.observe_query(query, started)
+        return row
+
+    async def fetch(self, query: str, *args: Any) -> Any:
+        started = time.perf_counter()
+        async with self.conn.cursor() as cur:
+            await cur.execute(query, *args)
+            rows = await cur.fetchall()
+        self.db.observe_query(query, started)
+        return rows
+
+    async def execute(self, query: str, *args: Any) -> Any:
+        started = time.perf_counter()
+        async with self.conn.cursor() as cur:
+            result = await cur.execute(query, *args)
+        self.db.observe_query(query, started)
+        return result
+
+
 class Database:
     """
     データベース操作系クラス
@@ -15,33 +51,71 @@ class Database:
         self.initialized: bool = False
         self.pool: aiomysql.Pool | None = None
         self.logger = logging.getLogger("database")
+        # 発行したクエリの数 (負荷計測用)
+        self.query_count = 0
+        # この秒数以上かかったクエリだけをログに出す
+        self.slow_query_threshold = float(os.environ.get("SLOW_QUERY_MS", 100)) / 1000
+        self.slow_query_logger = logging.getLogger("database.slow_query")
+
+    def observe_query(self, query: str, started: float) -> None:
+        """
+        クエリの実行時間を記録し、遅いクエリをログに出します
+        """
+
+        self.query_count += 1
+        elapsed = time.perf_counter() - started
+        if elapsed >= self.slow_query_threshold:
+            self.slow_query_logger.warning(
+                "Slow query",
+                extra={"query": query[:500], "elapsed_ms": round(elapsed * 1000, 2)},
+            )
 
     async def fetchrow(self, query: str, *args: Any) -> Any:
+        # 接続はautocommitなので、トランザクション外のクエリではコミットしない
+        started = time.perf_counter()
         async with self.pool.acquire() as conn:
             async with conn.cursor() as cur:
                 await cur.execute(query, *args)
                 row = await cur.fetchone()
-                await conn.commit()
 
+        self.observe_query(query, started)
         return row
 
     async def fetch(self, query: str, *args: Any) -> Any:
+        started = time.perf_counter()
         async with self.pool.acquire() as conn:
             async with conn.cursor() as cur:
                 await cur.execute(query, *args)
                 rows = await cur.fetchall()
-                await conn.commit()
 
+        self.observe_query(query, started)
         return rows
 
     async def execute(self, query: str, *args: Any) -> Any:
+        started = time.perf_counter()
         async with self.pool.acquire() as conn:
             async with conn.cursor() as cur:
                 result = await cur.execute(query, *args)
-                await conn.commit()
 
+        self.observe_query(query, started)
         return result
 
+    @contextlib.asynccontextmanager
+    async def transaction(self) -> AsyncIterator["Transaction"]:
+        """
+        1つの接続で複数のクエリを実行するトランザクションを開始します
+        ブロックを抜けるとコミットされ、例外が発生した場合はロールバックされます
+        """
+
+        async with self.pool.acquire() as conn:
+            await conn.begin()
+            try:
+                yield Transaction(conn, self)
+            except BaseException:
+                await conn.rollback()
+                raise
+            await conn.commit()
+
     async def connect(self) -> None:
         """
         データベースに接続します
@@ -55,8 +129,7 @@ class Database:
             password=os.environ.get("MYSQL_PASSWORD"),
             db=os.environ.get("MYSQL_DATABASE"),
             loop=loop,
-            autocommit=False,
-            echo=True,
+            autocommit=True,
         )
 
         self.logger.info("Connected to database")
@@ -90,6 +163,57 @@ class Database:
                     "updated_at DATETIME DEFAULT CURRENT_TIMESTAMP on update CURRENT_TIMESTAMP,"
                     "PRIMARY KEY (user_id, guild_id, channel_id))"
                 )
+                # ギルドのEXP倍率ルール
+                # チャンネルとロールのルールは対象ごとに1つ、時間帯のルールはtarget_idがNULLで複数持てる
+                await cur.execute(
+                    "CREATE TABLE IF NOT EXISTS exp_rules (rule_id BIGINT UNSIGNED AUTO_INCREMENT PRIMARY KEY,"
+                    "guild_id BIGINT UNSIGNED NOT NULL, kind VARCHAR(16) NOT NULL, target_id BIGINT UNSIGNED NULL,"
+                    "multiplier DOUBLE NOT NULL, weekdays TINYINT UNSIGNED NOT NULL DEFAULT 0,"
+                    "start_minute SMALLINT UNSIGNED NOT NULL DEFAULT 0, end_minute SMALLINT UNSIGNED NOT NULL DEFAULT 0,"
+                    "starts_at DATETIME NULL, ends_at DATETIME NULL,"
+                    "created_at DATETIME DEFAULT CURRENT_TIMESTAMP,"
+                    "updated_at DATETIME DEFAULT CURRENT_TIMESTAMP on update CURRENT_TIMESTAMP,"
+                    "UNIQUE KEY (guild_id, kind, target_id))"
+                )
+                # レベルロールの設定変更の反映状況
+                await cur.execute(
+                    "CREATE TABLE IF NOT EXISTS level_role_sync_jobs (guild_id BIGINT UNSIGNED PRIMARY KEY,"
+                    "baseline TEXT NOT NULL, target TEXT NOT NULL, cursor_user_id BIGINT UNSIGNED NOT NULL,"
+                    "total INT UNSIGNED NOT NULL, processed INT UNSIGNED NOT NULL, changed INT UNSIGNED NOT NULL,"
+                    "failed INT UNSIGNED NOT NULL DEFAULT 0, created_at DATETIME DEFAULT CURRENT_TIMESTAMP,"
+                    "updated_at DATETIME DEFAULT CURRENT_TIMESTAMP on update CURRENT_TIMESTAMP)"
+                )
+                # failedがない古いテーブルには列を追加する
+                await cur.execute(
+                    "SELECT 1 FROM information_schema.COLUMNS WHERE TABLE_SCHEMA = DATABASE() "
+                    "AND TABLE_NAME = 'level_role_sync_jobs' AND COLUMN_NAME = 'failed'"
+                )
+                if await cur.fetchone() is None:
+                    await cur.execute(
+                        "ALTER TABLE level_role_sync_jobs ADD COLUMN failed INT UNSIGNED NOT NULL DEFAULT 0 AFTER changed"
+                    )
+                # 過去のメッセージからのEXPの取り込みの進捗 (チャンネルごと)
+                # before_message_idより前、last_message_idより後のメッセージが未処理
+                await cur.execute(
+                    "CREATE TABLE IF NOT EXISTS backfill_checkpoints (guild_id BIGINT UNSIGNED,"
+                    "channel_id BIGINT UNSIGNED, before_message_id BIGINT UNSIGNED NOT NULL,"
+                    "last_message_id BIGINT UNSIGNED NOT NULL, messages INT UNSIGNED NOT NULL DEFAULT 0,"
+                    "done BOOLEAN NOT NULL DEFAULT FALSE, created_at DATETIME DEFAULT CURRENT_TIMESTAMP,"
+                    "updated_at DATETIME DEFAULT CURRENT_TIMESTAMP on update CURRENT_TIMESTAMP,"
+                    "PRIMARY KEY (guild_id, channel_id))"
+                )
+                # 概算順位モードを使うギルド (exact_top位以内は正確な順位を使う)
+                await cur.execute(
+                    "CREATE TABLE IF NOT EXISTS guild_rank_modes (guild_id BIGINT UNSIGNED PRIMARY KEY,"
+                    "exact_top INT UNSIGNED NOT NULL, created_at DATETIME DEFAULT CURRENT_TIMESTAMP,"
+                    "updated_at DATETIME DEFAULT CURRENT_TIMESTAMP on update CURRENT_TIMESTAMP)"
+                )
+                # DBに適用済みのEXPジャーナルの連番 (連番はプロセスのジャーナルごとに独立している)
+                await cur.execute(
+                    "CREATE TABLE IF NOT EXISTS exp_journals (journal_id VARCHAR(255) PRIMARY KEY,"
+                    "applied_seq BIGINT UNSIGNED NOT NULL,"
+                    "updated_at DATETIME DEFAULT CURRENT_TIMESTAMP on update CURRENT_TIMESTAMP)"
+                )
                 await conn.commit()
 
         self.logger.info("Initialized database")
@@ -140,6 +264,51 @@ class Database:
             (guild_id, min_exp, max_exp, stack_level_roles),
         )
 
+    async def _update_guild_setting_column(
+        self, guild_id: int, column: str, value: int | bool
+    ) -> None:
+        values = {"min_exp": 15, "max_exp": 25, "stack_level_roles": False}
+        if column not in values:
+            raise ValueError(f"Unknown guild setting {column}")
+        values[column] = value
+
+        # 他の設定を読まずに1つの列だけを1文で更新する
+        await self.execute(
+            "INSERT INTO guild_settings (guild_id, min_exp, max_exp, stack_level_roles) VALUES (%s, %s, %s, %s) "
+            f"AS new ON DUPLICATE KEY UPDATE {column} = new.{column}",
+            (
+                guild_id,
+                values["min_exp"],
+                values["max_exp"],
+                values["stack_level_roles"],
+            ),
+        )
+
+    async def set_guild_min_exp(self, guild_id: int, min_exp: int) -> None:
+        """
+        ギルドの最小獲得経験値を設定します
+        """
+
+        await self._update_guild_setting_column(guild_id, "min_exp", min_exp)
+
+    async def set_guild_max_exp(self, guild_id: int, max_exp: int) -> None:
+        """
+        ギルドの最大獲得経験値を設定します
+        """
+
+        await self._update_guild_setting_column(guild_id, "max_exp", max_exp)
+
+    async def set_guild_stack_level_roles(
+        self, guild_id: int, stack_level_roles: bool
+    ) -> None:
+        """
+        ギルドのレベルロールの複数保持設定をします
+        """
+
+        await self._update_guild_setting_column(
+            guild_id, "stack_level_roles", stack_level_roles
+        )
+
     async def delete_guild_setting(self, guild_id: int) -> None:
         """
         ギルドの設定データを削除します
@@ -149,6 +318,37 @@ class Database:
             "DELETE FROM guild_settings WHERE guild_id = %s", (guild_id,)
         )
 
+    async def get_guild_rank_mode(self, guild_id: int) -> int | None:
+        """
+        概算順位モードの正確な順位を使う範囲を取得します
+        概算順位モードでない場合はNoneを返します
+        """
+
+        row = await self.fetchrow(
+            "SELECT exact_top FROM guild_rank_modes WHERE guild_id = %s", (guild_id,)
+        )
+        return row[0] if row else None
+
+    async def set_guild_rank_mode(self, guild_id: int, exact_top: int) -> None:
+        """
+        概算順位モードを有効にします
+        """
+
+        await self.execute(
+            "INSERT INTO guild_rank_modes (guild_id, exact_top) VALUES (%s, %s) "
+            "AS new ON DUPLICATE KEY UPDATE exact_top = new.exact_top",
+            (guild_id, exact_top),
+        )
+
+    async def delete_guild_rank_mode(self, guild_id: int) -> None:
+        """
+        概算順位モードを無効にします
+        """
+
+        await self.execute(
+            "DELETE FROM guild_rank_modes WHERE guild_id = %s", (guild_id,)
+        )
+
     async def get_guild_level_roles(self, guild_id: int) -> list[tuple[int, int]]:
         """
         ギルドのレベルロールデータを全取得します
@@ -173,25 +373,29 @@ class Database:
 
     async def create_guild_level_role(
         self, guild_id: int, role_id: int, level: int
-    ) -> None:
+    ) -> bool:
         """
         ギルドのレベルロールデータを作成します
+        すでに存在する場合はFalseを返します
         """
 
-        await self.execute(
-            "INSERT INTO guild_level_roles (guild_id, role_id, level) VALUES (%s, %s, %s)",
+        result = await self.execute(
+            "INSERT IGNORE INTO guild_level_roles (guild_id, role_id, level) VALUES (%s, %s, %s)",
             (guild_id, role_id, level),
         )
+        return result > 0
 
-    async def delete_guild_level_role(self, guild_id: int, role_id: int) -> None:
+    async def delete_guild_level_role(self, guild_id: int, role_id: int) -> bool:
         """
         ギルドのレベルロールデータを削除します
+        存在しなかった場合はFalseを返します
         """
 
-        await self.execute(
+        result = await self.execute(
             "DELETE FROM guild_level_roles WHERE guild_id = %s AND role_id = %s",
             (guild_id, role_id),
         )
+        return result > 0
 
     async def delete_all_guild_level_roles(self, guild_id: int) -> None:
         """
@@ -203,6 +407,83 @@ class Database:
             (guild_id,),
         )
 
+    async def get_exp_rules(self, guild_id: int) -> list[tuple]:
+        """
+        ギルドのEXP倍率ルールを全取得します
+        """
+
+        rows = await self.fetch(
+            "SELECT rule_id, kind, target_id, multiplier, weekdays, start_minute, end_minute, starts_at, ends_at "
+            "FROM exp_rules WHERE guild_id = %s ORDER BY rule_id ASC",
+            (guild_id,),
+        )
+        return rows
+
+    async def set_exp_target_rule(
+        self, guild_id: int, kind: str, target_id: int, multiplier: float
+    ) -> None:
+        """
+        チャンネルまたはロールのEXP倍率ルールを設定します
+        すでに存在する場合は倍率を更新します
+        """
+
+        await self.execute(
+            "INSERT INTO exp_rules (guild_id, kind, target_id, multiplier) VALUES (%s, %s, %s, %s) "
+            "AS new ON DUPLICATE KEY UPDATE multiplier = new.multiplier",
+            (guild_id, kind, target_id, multiplier),
+        )
+
+    async def create_exp_time_rule(
+        self,
+        guild_id: int,
+        multiplier: float,
+        weekdays: int,
+        start_minute: int,
+        end_minute: int,
+        starts_at: datetime.datetime | None = None,
+        ends_at: datetime.datetime | None = None,
+    ) -> int:
+        """
+        時間帯のEXP倍率ルールを作成し、ルールIDを返します
+        starts_at, ends_atはUTCで指定します
+        """
+
+        async with self.transaction() as tx:
+            await tx.execute(
+                "INSERT INTO exp_rules (guild_id, kind, multiplier, weekdays, start_minute, end_minute, starts_at, ends_at) "
+                "VALUES (%s, 'time', %s, %s, %s, %s, %s, %s)",
+                (
+                    guild_id,
+                    multiplier,
+                    weekdays,
+                    start_minute,
+                    end_minute,
+                    starts_at,
+                    ends_at,
+                ),
+            )
+            row = await tx.fetchrow("SELECT LAST_INSERT_ID()")
+        return row[0]
+
+    async def delete_exp_rule(self, guild_id: int, rule_id: int) -> bool:
+        """
+        EXP倍率ルールを削除します
+        存在しなかった場合はFalseを返します
+        """
+
+        result = await self.execute(
+            "DELETE FROM exp_rules WHERE guild_id = %s AND rule_id = %s",
+            (guild_id, rule_id),
+        )
+        return result > 0
+
+    async def delete_all_exp_rules(self, guild_id: int) -> None:
+        """
+        ギルドのEXP倍率ルールを全て削除します
+        """
+
+        await self.execute("DELETE FROM exp_rules WHERE guild_id = %s", (guild_id,))
+
     async def get_user_level(self, user_id: int, guild_id: int, channel_id: int) -> int:
         """
         ユーザーのレベルデータを取得します
@@ -223,6 +504,95 @@ class Database:
             "SELECT SUM(exp) FROM user_levels WHERE user_id = %s AND guild_id = %s",
             (user_id, guild_id),
         )
+        # SUMの結果はDecimalなのでintにしておく (スナップショットはstructで書き出す)
+        return int(row[0] or 0) if row else 0
+
+    async def get_user_level_totals(
+        self, guild_id: int, user_ids: list[int]
+    ) -> dict[int, int]:
+        """
+        複数ユーザーのレベルデータの合計をまとめて取得します
+        データがないユーザーは含まれません
+        """
+
+        totals = {}
+        for i in range(0, len(user_ids), 1000):
+            chunk = user_ids[i : i + 1000]
+            rows = await self.fetch(
+                "SELECT user_id, SUM(exp) FROM user_levels WHERE guild_id = %s "
+                f"AND user_id IN ({', '.join(['%s'] * len(chunk))}) GROUP BY user_id",
+                (guild_id, *chunk),
+            )
+            totals.update((user_id, int(total)) for user_id, total in rows)
+        return totals
+
+    async def scan_user_level_totals(
+        self, guild_id: int, batch_size: int = 10000
+    ) -> AsyncIterator[list[int]]:
+        """
+        ギルドの全ユーザーの合計EXPを、サーバー側カーソルでbatch_size件ずつ読み出します
+        結果を一度にメモリに載せないので、メンバーが多いギルドでも使えます
+        """
+
+        started = time.perf_counter()
+        async with self.pool.acquire() as conn:
+            async with conn.cursor(aiomysql.SSCursor) as cur:
+                await cur.execute(
+                    "SELECT SUM(exp) FROM user_levels WHERE guild_id = %s GROUP BY user_id",
+                    (guild_id,),
+                )
+                while True:
+                    rows = await cur.fetchmany(batch_size)
+                    if not rows:
+                        break
+                    yield [int(row[0]) for row in rows]
+        self.observe_query("scan_user_level_totals", started)
+
+    async def scan_user_level_totals_by_user(
+        self, guild_id: int, batch_size: int = 10000
+    ) -> AsyncIterator[list[tuple[int, int]]]:
+        """
+        scan_user_level_totalsと同じく、ギルドの全ユーザーの (user_id, 合計EXP) を読み出します
+        1つのSELECTで読むので、最初のバッチを受け取った時点で読み出す内容は確定しています
+        """
+
+        started = time.perf_counter()
+        async with self.pool.acquire() as conn:
+            async with conn.cursor(aiomysql.SSCursor) as cur:
+                await cur.execute(
+                    "SELECT user_id, SUM(exp) FROM user_levels WHERE guild_id = %s GROUP BY user_id",
+                    (guild_id,),
+                )
+                while True:
+                    rows = await cur.fetchmany(batch_size)
+                    if not rows:
+                        break
+                    yield [(user_id, int(total)) for user_id, total in rows]
+        self.observe_query("scan_user_level_totals_by_user", started)
+
+    async def get_user_level_totals_after(
+        self, guild_id: int, after_user_id: int, limit: int
+    ) -> list[tuple[int, int]]:
+        """
+        ユーザーIDがafter_user_idより大きいユーザーの合計をユーザーIDの昇順でlimit件取得します
+        """
+
+        rows = await self.fetch(
+            "SELECT user_id, SUM(exp) FROM user_levels WHERE guild_id = %s AND user_id > %s "
+            "GROUP BY user_id ORDER BY user_id ASC LIMIT %s",
+            (guild_id, after_user_id, limit),
+        )
+        return [(user_id, int(total)) for user_id, total in rows]
+
+    async def count_guild_level_users(self, guild_id: int) -> int:
+        """
+        ギルドでレベルデータを持つユーザーの数を取得します
+        """
+
+        row = await self.fetchrow(
+            "SELECT COUNT(DISTINCT user_id) FROM user_levels WHERE guild_id = %s",
+            (guild_id,),
+        )
         return row[0] if row else 0
 
     async def get_user_level_rank(
@@ -251,6 +621,25 @@ class Database:
         )
         return row[0] if row else None
 
+    async def get_user_profile(
+        self, user_id: int, guild_id: int
+    ) -> tuple[int, int | None]:
+        """
+        ユーザーの合計経験値とギルド内の順位を1回のクエリで取得します
+        順位はギルド全体に順位を付けず、合計経験値がユーザーより多い人数から求めます
+        """
+
+        row = await self.fetchrow(
+            "WITH me AS (SELECT SUM(exp) AS total FROM user_levels WHERE guild_id = %s AND user_id = %s)"
+            " SELECT me.total, (SELECT COUNT(*) FROM (SELECT user_id FROM user_levels WHERE guild_id = %s"
+            " GROUP BY user_id HAVING SUM(exp) > (SELECT total FROM me)) AS above) + 1"
+            " FROM me WHERE me.total IS NOT NULL",
+            (guild_id, user_id, guild_id),
+        )
+        if row is None:
+            return 0, None
+        return int(row[0]), row[1]
+
     async def get_user_level_ranking(
         self, guild_id: int, channel_id: int
     ) -> list[tuple[int, int, int]]:
@@ -303,6 +692,66 @@ class Database:
         )
         return rows
 
+    @staticmethod
+    def _split_total_count(
+        rows: list[tuple],
+    ) -> tuple[list[tuple[int, int, int]], int]:
+        if not rows:
+            return [], 0
+        return [row[:-1] for row in rows], rows[0][-1]
+
+    async def get_user_level_ranking_page(
+        self, guild_id: int, channel_id: int, offset: int, limit: int
+    ) -> tuple[list[tuple[int, int, int]], int]:
+        """
+        チャンネルのランキングの1ページ分と全体の件数を取得します
+        """
+
+        rows = await self.fetch(
+            "SELECT user_id, exp, RANK() OVER (ORDER BY exp DESC) AS ranking, COUNT(*) OVER () AS total_count FROM user_levels WHERE guild_id = %s AND channel_id = %s ORDER BY exp DESC LIMIT %s OFFSET %s",
+            (guild_id, channel_id, limit, offset),
+        )
+        return self._split_total_count(rows)
+
+    async def get_user_level_ranking_total_page(
+        self, guild_id: int, offset: int, limit: int
+    ) -> tuple[list[tuple[int, int, int]], int]:
+        """
+        ギルドのランキングの1ページ分と全体の件数を取得します
+        """
+
+        rows = await self.fetch(
+            "SELECT user_id, SUM(exp) AS total_exp, RANK() OVER (ORDER BY SUM(exp) DESC) AS ranking, COUNT(*) OVER () AS total_count FROM user_levels WHERE guild_id = %s GROUP BY user_id ORDER BY total_exp DESC LIMIT %s OFFSET %s",
+            (guild_id, limit, offset),
+        )
+        return self._split_total_count(rows)
+
+    async def get_user_level_ranking_channel_page(
+        self, user_id: int, guild_id: int, offset: int, limit: int
+    ) -> tuple[list[tuple[int, int, int]], int]:
+        """
+        ユーザーのチャンネルランキングの1ページ分と全体の件数を取得します
+        """
+
+        rows = await self.fetch(
+            "SELECT channel_id, exp, RANK() OVER (ORDER BY exp DESC) AS ranking, COUNT(*) OVER () AS total_count FROM user_levels WHERE user_id = %s AND guild_id = %s ORDER BY exp DESC LIMIT %s OFFSET %s",
+            (user_id, guild_id, limit, offset),
+        )
+        return self._split_total_count(rows)
+
+    async def get_user_level_ranking_total_channel_page(
+        self, guild_id: int, offset: int, limit: int
+    ) -> tuple[list[tuple[int, int, int]], int]:
+        """
+        チャンネルのランキングの1ページ分と全体の件数を取得します
+        """
+
+        rows = await self.fetch(
+            "SELECT channel_id, SUM(exp) AS total_exp, RANK() OVER (ORDER BY SUM(exp) DESC) AS ranking, COUNT(*) OVER () AS total_count FROM user_levels WHERE guild_id = %s GROUP BY channel_id ORDER BY total_exp DESC LIMIT %s OFFSET %s",
+            (guild_id, limit, offset),
+        )
+        return self._split_total_count(rows)
+
     async def add_user_level(
         self, user_id: int, guild_id: int, channel_id: int, exp: int = 0
     ) -> None:
@@ -318,16 +767,24 @@ class Database:
 
     async def remove_user_level_exp(
         self, user_id: int, guild_id: int, channel_id: int, exp: int = 0
-    ) -> None:
-        """
-        ユーザーのレベルデータを作成します
-        すでに存在する場合は更新します
-        """
-
-        await self.execute(
-            "UPDATE user_levels SET exp = GREATEST(user_levels.exp - %s, 0) WHERE user_id = %s AND guild_id = %s AND channel_id = %s",
-            (exp, user_id, guild_id, channel_id),
-        )
+    ) -> int:
+        """
+        ユーザーのレベルデータから経験値を減らします
+        実際に減らした値を返します
+        """
+
+        async with self.transaction() as tx:
+            row = await tx.fetchrow(
+                "SELECT exp FROM user_levels WHERE user_id = %s AND guild_id = %s AND channel_id = %s FOR UPDATE",
+                (user_id, guild_id, channel_id),
+            )
+            removed = min(row[0], exp) if row else 0
+            if removed > 0:
+                await tx.execute(
+                    "UPDATE user_levels SET exp = exp - %s WHERE user_id = %s AND guild_id = %s AND channel_id = %s",
+                    (removed, user_id, guild_id, channel_id),
+                )
+        return removed
 
     async def delete_user_level(
         self, user_id: int, guild_id: int, channel_id: int
@@ -360,3 +817,205 @@ class Database:
             "DELETE FROM user_levels WHERE guild_id = %s",
             (guild_id,),
         )
+
+    async def get_role_sync_jobs(self) -> list[tuple]:
+        """
+        未完了のレベルロール反映ジョブを全取得します
+        """
+
+        rows = await self.fetch(
+            "SELECT guild_id, baseline, target, cursor_user_id, total, processed, changed, failed FROM level_role_sync_jobs"
+        )
+        return rows
+
+    async def save_role_sync_job(
+        self,
+        guild_id: int,
+        baseline: str,
+        target: str,
+        cursor_user_id: int,
+        total: int,
+        processed: int,
+        changed: int,
+        failed: int,
+    ) -> None:
+        """
+        レベルロール反映ジョブの進捗を保存します
+        """
+
+        await self.execute(
+            "INSERT INTO level_role_sync_jobs (guild_id, baseline, target, cursor_user_id, total, processed, changed, failed) "
+            "VALUES (%s, %s, %s, %s, %s, %s, %s, %s) AS new ON DUPLICATE KEY UPDATE baseline = new.baseline, "
+            "target = new.target, cursor_user_id = new.cursor_user_id, total = new.total, "
+            "processed = new.processed, changed = new.changed, failed = new.failed",
+            (
+                guild_id,
+                baseline,
+                target,
+                cursor_user_id,
+                total,
+                processed,
+                changed,
+                failed,
+            ),
+        )
+
+    async def delete_role_sync_job(self, guild_id: int) -> None:
+        """
+        完了したレベルロール反映ジョブを削除します
+        """
+
+        await self.execute(
+            "DELETE FROM level_role_sync_jobs WHERE guild_id = %s", (guild_id,)
+        )
+
+    async def get_guild_first_activity(self, guild_id: int) -> float | None:
+        """
+        ギルドで最初にEXPが記録された時刻 (UNIX時間) を取得します
+        記録がない場合はNoneを返します
+        """
+
+        # created_atはセッションのタイムゾーンで保存されるので、DB側でUNIX時間に変換する
+        row = await self.fetchrow(
+            "SELECT UNIX_TIMESTAMP(MIN(created_at)) FROM user_levels WHERE guild_id = %s",
+            (guild_id,),
+        )
+        if row is None or row[0] is None:
+            return None
+        return float(row[0])
+
+    async def get_backfill_checkpoints(
+        self, guild_id: int | None = None
+    ) -> list[tuple]:
+        """
+        過去のメッセージの取り込みの進捗を取得します
+        guild_idを指定しない場合は全ギルド分を取得します
+        """
+
+        query = "SELECT guild_id, channel_id, before_message_id, last_message_id, messages, done FROM backfill_checkpoints"
+        if guild_id is None:
+            return await self.fetch(query)
+        return await self.fetch(query + " WHERE guild_id = %s", (guild_id,))
+
+    async def create_backfill_checkpoints(
+        self,
+        guild_id: int,
+        channel_ids: list[int],
+        before_message_id: int,
+        after_message_id: int,
+    ) -> None:
+        """
+        チャンネルごとの取り込みの進捗を作成します
+        """
+
+        for i in range(0, len(channel_ids), 1000):
+            chunk = channel_ids[i : i + 1000]
+            await self.execute(
+                "INSERT IGNORE INTO backfill_checkpoints (guild_id, channel_id, before_message_id, last_message_id) VALUES "
+                + ", ".join(["(%s, %s, %s, %s)"] * len(chunk)),
+                [
+                    value
+                    for channel_id in chunk
+                    for value in (
+                        guild_id,
+                        channel_id,
+                        before_message_id,
+                        after_message_id,
+                    )
+                ],
+            )
+
+    async def apply_backfill_batch(
+        self,
+        guild_id: int,
+        channel_id: int,
+        rows: list[tuple[int, int]],
+        last_message_id: int,
+        messages: int,
+        done: bool,
+    ) -> None:
+        """
+        取り込んだEXP (user_id, exp) をまとめて加算し、チャンネルの進捗を更新します
+        同じトランザクションで行うので、中断して再開しても二重に加算されません
+        """
+
+        async with self.transaction() as tx:
+            for i in range(0, len(rows), 1000):
+                chunk = rows[i : i + 1000]
+                await tx.execute(
+                    "INSERT INTO user_levels (user_id, guild_id, channel_id, exp) VALUES "
+                    + ", ".join(["(%s, %s, %s, %s)"] * len(chunk))
+                    + " AS new ON DUPLICATE KEY UPDATE exp = user_levels.exp + new.exp",
+                    [
+                        value
+                        for user_id, exp in chunk
+                        for value in (user_id, guild_id, channel_id, exp)
+                    ],
+                )
+            await tx.execute(
+                "UPDATE backfill_checkpoints SET last_message_id = %s, messages = messages + %s, done = %s "
+                "WHERE guild_id = %s AND channel_id = %s",
+                (last_message_id, messages, done, guild_id, channel_id),
+            )
+
+    async def delete_backfill_checkpoints(self, guild_id: int) -> None:
+        """
+        ギルドの取り込みの進捗を削除します
+        """
+
+        await self.execute(
+            "DELETE FROM backfill_checkpoints WHERE guild_id = %s", (guild_id,)
+        )
+
+    async def get_journal_seq(self, journal_id: str) -> int:
+        """
+        ジャーナルのDBに適用済みの連番を取得します
+        """
+
+        row = await self.fetchrow(
+            "SELECT applied_seq FROM exp_journals WHERE journal_id = %s",
+            (journal_id,),
+        )
+        if row:
+            return row[0]
+        # 全プロセスで1行を共有していた以前のテーブルから移行する
+        # (1プロセスで動かしていた場合はそのジャーナルの連番と一致する)
+        row = await self.fetchrow(
+            "SELECT 1 FROM information_schema.TABLES WHERE TABLE_SCHEMA = DATABASE() "
+            "AND TABLE_NAME = 'exp_journal_state'"
+        )
+        if row is None:
+            return 0
+        row = await self.fetchrow(
+            "SELECT applied_seq FROM exp_journal_state WHERE id = 1"
+        )
+        return row[0] if row else 0
+
+    async def apply_exp_batch(
+        self,
+        rows: list[tuple[int, int, int, int]],
+        journal_id: str | None = None,
+        journal_seq: int = 0,
+    ) -> None:
+        """
+        バッファされたEXP (user_id, guild_id, channel_id, exp) をまとめて加算します
+        適用済みのジャーナルの連番も同じトランザクションで記録するため、
+        ジャーナルを再適用しても二重に加算されません
+        journal_idを指定しない場合は連番を記録しません
+        """
+
+        async with self.transaction() as tx:
+            for i in range(0, len(rows), 1000):
+                chunk = rows[i : i + 1000]
+                await tx.execute(
+                    "INSERT INTO user_levels (user_id, guild_id, channel_id, exp) VALUES "
+                    + ", ".join(["(%s, %s, %s, %s)"] * len(chunk))
+                    + " AS new ON DUPLICATE KEY UPDATE exp = user_levels.exp + new.exp",
+                    [value for row in chunk for value in row],
+                )
+            if journal_id is not None:
+                await tx.execute(
+                    "INSERT INTO exp_journals (journal_id, applied_seq) VALUES (%s, %s) AS new "
+                    "ON DUPLICATE KEY UPDATE applied_seq = GREATEST(exp_journals.applied_seq, new.applied_seq)",
+                    (journal_id, journal_seq),
+                )
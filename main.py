@@ -1,6 +1,8 @@
+import argparse
+import asyncio
 import logging
 import os
-import traceback
+from typing import Any
 
 import discord
 from discord import app_commands
@@ -8,42 +10,165 @@ from discord.ext import commands
 from dotenv import load_dotenv
 
 from database.database import Database
+from utils.backfill import HistoryBackfiller
+from utils.card_renderer import CardRenderer
+from utils.command_sync import CommandSyncState, command_tree_fingerprint
+from utils.journal import ExpJournal
+from utils.log_pipeline import setup_logging_from_env
+from utils.profiler import LoopLagMonitor
+from utils.role_sync import LevelRoleReconciler
+from utils.shared_state import create_shared_state
+from utils.snapshot import load_snapshot, write_snapshot
 from utils.util import NotBotAdmin
 
 
 class DiscordLevelBot(commands.Bot):
-    def __init__(self):
+    def __init__(self, force_sync: bool = False):
         super().__init__(
             command_prefix="", help_command=None, intents=discord.Intents.default()
         )
 
         self.initial_extensions = ["cogs.debug", "cogs.leveling", "cogs.admin"]
+        self.data_dir = os.environ.get("DATA_DIR", "data")
         self.db = Database()
+        self.shared = create_shared_state()
         self.logger = logging.getLogger("bot")
+        self.force_sync = force_sync
+        self.journal = ExpJournal(os.path.join(self.data_dir, "journal"))
+        self.snapshot_path = os.path.join(self.data_dir, "snapshot.bin")
+        # リロード中のCogの状態 (Cog名 -> export_stateの戻り値)
+        self.cog_states: dict[str, dict[str, Any]] = {}
+        self.command_sync_state = CommandSyncState(
+            os.path.join(self.data_dir, "command_sync.json")
+        )
+        self.role_sync = LevelRoleReconciler(self)
+        self.backfill = HistoryBackfiller(self)
+        self.renderer = CardRenderer()
+        self.lag_monitor = LoopLagMonitor(
+            threshold=float(os.environ.get("LOOP_LAG_THRESHOLD", 0.25))
+        )
 
     async def setup_hook(self) -> None:
+        self.lag_monitor.start()
+        self.renderer.start()
+        # Cogの読み込みとDB接続は互いに依存しないので並行して行う
+        await asyncio.gather(
+            self.load_extensions(), self.init_database(), self.shared.connect()
+        )
+        await self.replay_journal()
+        self.load_snapshot()
+        await self.role_sync.resume()
+        await self.backfill.resume()
+        await self.sync_commands(force=self.force_sync)
+
+        self.tree.on_error = self.on_tree_error
+
+    async def load_extensions(self) -> None:
         for extension in self.initial_extensions:
             await self.load_extension(extension)
 
+    async def reload_extension(self, name: str, *, package: str | None = None) -> None:
+        # export_stateを持つCogは、アンロード前に状態を退避しておき
+        # 新しいインスタンスがcog_loadで引き継ぐ
+        # 退避からアンロードまでの間にawaitを挟まないので、状態の受け渡しはアトミックになる
+        name = self._resolve_name(name, package)
+        exported = []
+        for cog in list(self.cogs.values()):
+            if type(cog).__module__ == name and hasattr(cog, "export_state"):
+                self.cog_states[cog.qualified_name] = cog.export_state()
+                exported.append(cog.qualified_name)
+
+        try:
+            await super().reload_extension(name)
+        finally:
+            for cog_name in exported:
+                if cog_name in self.cog_states:
+                    self.logger.warning(f"State of {cog_name} was not adopted")
+
+    async def init_database(self) -> None:
         await self.db.connect()
         await self.db.init()
-        # self.tree.clear_commands(guild=discord.Object(id=os.environ.get("GUILD_ID")))
-        self.tree.copy_global_to(guild=discord.Object(id=os.environ.get("GUILD_ID")))
-        await self.tree.sync(guild=discord.Object(id=os.environ.get("GUILD_ID")))
 
-        self.tree.on_error = self.on_tree_error
+    async def replay_journal(self) -> None:
+        # 前回DBに書き込めなかったEXPをジャーナルから再適用する
+        applied_seq = await self.db.get_journal_seq(self.journal.journal_id)
+        segments = self.journal.segments()
+        pending, journal_seq = self.journal.replay(applied_seq)
+        if pending:
+            rows = [
+                (user_id, guild_id, channel_id, exp)
+                for (user_id, guild_id, channel_id), exp in pending.items()
+            ]
+            await self.db.apply_exp_batch(rows, self.journal.journal_id, journal_seq)
+            self.logger.info(f"Replayed {len(rows)} buffered exp from journal")
+        self.journal.remove(segments)
+        self.journal.open(journal_seq)
+
+    def load_snapshot(self) -> None:
+        snapshot = load_snapshot(self.snapshot_path)
+        if snapshot is None:
+            return
+        # 一度読み込んだスナップショットは、次回異常終了した時に使われないよう削除する
+        os.remove(self.snapshot_path)
+
+        # スナップショット以降にDBが更新されている場合は使えない
+        if snapshot["journal_seq"] != self.journal.seq:
+            self.logger.info("Snapshot is stale, ignoring")
+            return
+        leveling = self.get_cog("Leveling")
+        if leveling is not None:
+            leveling.import_state(snapshot)
+            self.logger.info(
+                f"Loaded snapshot ({len(snapshot['totals'])} totals, {len(snapshot['guild_settings'])} guild settings)"
+            )
+
+    async def sync_commands(self, force: bool = False) -> bool:
+        guild = discord.Object(id=os.environ.get("GUILD_ID"))
+        # self.tree.clear_commands(guild=guild)
+        self.tree.copy_global_to(guild=guild)
+
+        # コマンドツリーに変更がなければレートリミットのあるsyncを呼ばない
+        fingerprint = command_tree_fingerprint(self.tree, guild)
+        if not force and self.command_sync_state.get(guild.id) == fingerprint:
+            self.logger.info("Command tree unchanged, skipping sync")
+            return False
+
+        await self.tree.sync(guild=guild)
+        self.command_sync_state.set(guild.id, fingerprint)
+        self.logger.info(f"Synced command tree ({fingerprint[:12]})")
+        return True
 
     async def on_ready(self):
         self.logger.info(f"Logged in as {self.user}")
 
     async def close(self) -> None:
+        leveling = self.get_cog("Leveling")
+        if leveling is not None and self.db.is_initialized():
+            # cancelすると実行中のフラッシュが途中で止まるので、今回の実行で終わらせる
+            leveling.flush_loop.stop()
+            try:
+                async with leveling._buffer.flush_lock:
+                    pass
+                await leveling.flush()
+                # スナップショットからジャーナルを閉じるまでawaitを挟まないので、
+                # その間の加算がスナップショットにもジャーナルにも含まれないことはない
+                write_snapshot(
+                    self.snapshot_path, self.journal.seq, leveling.export_state()
+                )
+            except Exception:
+                self.logger.exception("Failed to flush buffered exp on shutdown")
+        self.journal.close()
+        self.role_sync.stop()
+        self.backfill.stop()
+        self.renderer.close()
+        self.lag_monitor.stop()
+        await self.shared.close()
         await self.db.close()
         await super().close()
 
     async def on_tree_error(
         self, interaction: discord.Interaction, error: app_commands.AppCommandError
     ):
-        print(traceback.format_exc())
         if isinstance(error, app_commands.CommandOnCooldown):
             msg = f"コマンドはクールダウン中です、**{error.retry_after:.2f}**秒後に再度お試しください"
         elif isinstance(error, app_commands.NoPrivateMessage):
@@ -80,16 +205,18 @@ class DiscordLevelBot(commands.Bot):
             msg = "このコマンドはBotOwnerのみ実行できます"
         elif isinstance(error, app_commands.CheckFailure):
             msg = "このコマンドは実行できません"
-        elif isinstance(error, app_commands.CommandInvokeError):
-            self.logger.error(
-                f"[ERROR] {interaction.command}\n{traceback.format_exc()}\nーーーーーーーーーーーー"
-            )
-            msg = f"エラーが発生しました\n```{traceback.format_exc()}```"
         else:
+            # トレースバックの整形はログの出力スレッドで行う
+            original = getattr(error, "original", error)
             self.logger.error(
-                f"[ERROR] {interaction.command}\n{traceback.format_exc()}\nーーーーーーーーーーーー"
+                f"Command {interaction.command.qualified_name if interaction.command else None} failed",
+                exc_info=original,
+                extra={
+                    "guild_id": interaction.guild_id,
+                    "user_id": interaction.user.id,
+                },
             )
-            msg = f"エラーが発生しました\n```{traceback.format_exc()}```"
+            msg = f"エラーが発生しました\n```{type(original).__name__}: {original}```"
 
         if msg is not None:
             if interaction.response.is_done():
@@ -99,11 +226,22 @@ class DiscordLevelBot(commands.Bot):
 
 
 def main():
-    bot = DiscordLevelBot()
-    bot.run(os.environ.get("DISCORD_TOKEN"))
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        "--force-sync",
+        action="store_true",
+        help="コマンドツリーに変更がなくても同期します",
+    )
+    args = parser.parse_args()
+
+    bot = DiscordLevelBot(force_sync=args.force_sync)
+    bot.run(os.environ.get("DISCORD_TOKEN"), log_handler=None)
 
 
 if __name__ == "__main__":
-    logging.basicConfig(level=logging.INFO)
     load_dotenv()
-    main()
+    listener = setup_logging_from_env(os.environ)
+    try:
+        main()
+    finally:
+        listener.stop()
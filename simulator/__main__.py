@@ -0,0 +1,128 @@
+"""
+DiscordLevelBotの負荷シミュレーター
+
+Discordに接続せず、偽のゲートウェイからメッセージとスラッシュコマンドを流し込み、
+ローカルのMySQL (環境変数MYSQL_*) に対してスループットやレイテンシを計測します
+
+    python -m simulator --guilds 5 --users 2000 --rate 500 --duration 30
+    python -m simulator --record events.jsonl --duration 60
+    python -m simulator --replay events.jsonl --speed 2
+"""
+
+import argparse
+import asyncio
+import json
+import logging
+import os
+import tempfile
+
+from dotenv import load_dotenv
+
+from simulator.runner import Simulation
+from simulator.traffic import TrafficModel, load_events, record_events
+
+
+def parse_args() -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description="DiscordLevelBotの負荷シミュレーター")
+    parser.add_argument("--guilds", type=int, default=3)
+    parser.add_argument(
+        "--channels", type=int, default=5, help="ギルドごとのチャンネル数"
+    )
+    parser.add_argument(
+        "--users", type=int, default=1000, help="ギルドごとのユーザー数"
+    )
+    parser.add_argument(
+        "--user-skew", type=float, default=1.1, help="ユーザーのZipf指数 (0で一様)"
+    )
+    parser.add_argument(
+        "--guild-skew", type=float, default=0.0, help="ギルドのZipf指数 (0で一様)"
+    )
+    parser.add_argument("--rate", type=float, default=200, help="毎秒のメッセージ数")
+    parser.add_argument(
+        "--command-rate", type=float, default=2, help="毎秒のスラッシュコマンド数"
+    )
+    parser.add_argument("--duration", type=float, default=10, help="秒数")
+    parser.add_argument("--level-roles", type=int, default=3)
+    parser.add_argument("--seed", type=int, default=None)
+    parser.add_argument("--speed", type=float, default=1.0, help="再生速度の倍率")
+    parser.add_argument("--record", help="生成したイベントをJSON Linesで保存します")
+    parser.add_argument("--replay", help="保存したイベントを再生します")
+    parser.add_argument("--json", action="store_true", help="結果をJSONで出力します")
+    parser.add_argument(
+        "--fast-path",
+        action="store_true",
+        help="生のMESSAGE_CREATEからEXPを加算するモードで計測します",
+    )
+    return parser.parse_args()
+
+
+async def run(args: argparse.Namespace) -> dict:
+    if args.replay:
+        events = load_events(args.replay)
+        guild_channels: dict[int, set[int]] = {}
+        for event in events:
+            guild_channels.setdefault(event["guild"], set()).add(event["channel"])
+        channels = {guild: sorted(c) for guild, c in guild_channels.items()}
+    else:
+        model = TrafficModel(
+            args.guilds,
+            args.channels,
+            args.users,
+            args.user_skew,
+            args.guild_skew,
+            args.rate,
+            args.command_rate,
+            args.seed,
+        )
+        events = model.events(args.duration)
+        if args.record:
+            events = record_events(args.record, events)
+        channels = model.channel_ids
+
+    os.environ.setdefault("GUILD_ID", str(next(iter(channels))))
+    if args.fast_path:
+        os.environ["XP_FAST_PATH"] = "1"
+    simulation = Simulation(events, channels, args.level_roles, args.speed)
+    return await simulation.run()
+
+
+def print_report(report: dict) -> None:
+    print(f"messages: {report['messages']}  commands: {report['commands']}")
+    print(
+        f"elapsed: {report['elapsed_s']:.2f}s  throughput: {report['throughput_msg_s']:.1f} msg/s"
+    )
+    for name, stats in sorted(report["handlers"].items()):
+        print(
+            f"  {name}: n={stats['count']} p50={stats['p50_ms']:.2f}ms p99={stats['p99_ms']:.2f}ms"
+        )
+    for name, stats in sorted(report["commands_latency"].items()):
+        print(
+            f"  /{name}: n={stats['count']} p50={stats['p50_ms']:.2f}ms p99={stats['p99_ms']:.2f}ms"
+        )
+    print(
+        f"db queries: {report['db_queries']} ({report['db_queries_per_message']:.3f}/message)"
+    )
+    print(
+        f"rest calls: {report['rest_calls']}  level ups: {report['level_ups']}"
+        f" ({report['rest_calls_per_level_up']:.2f}/level up)"
+    )
+    for route, count in sorted(report["rest_calls_by_route"].items()):
+        print(f"  {route}: {count}")
+    print(f"admission: {report['admission']}")
+
+
+def main() -> None:
+    logging.basicConfig(level=logging.WARNING)
+    load_dotenv()
+    # 本番のジャーナルやスナップショットを使わないよう一時ディレクトリに分ける
+    os.environ.setdefault("DATA_DIR", tempfile.mkdtemp(prefix="levelbot-sim-"))
+    args = parse_args()
+    report = asyncio.run(run(args))
+    if args.json:
+        print(json.dumps(report, indent=2, ensure_ascii=False))
+    else:
+        print_report(report)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,87 @@
+"""
+ランクカードの描画のスループットを計測します
+
+    python -m simulator.bench_cards --cards 500 --workers 4 --distinct 100
+
+coldは全て異なるcards枚のカードを描画し、cachedは描画済みのうちdistinct種類のカードを
+cards回要求します
+"""
+
+import argparse
+import asyncio
+import io
+import os
+import random
+import time
+
+from PIL import Image
+
+from utils.card_renderer import CardRenderer, RankCardSpec
+
+
+def avatar_bytes(rng: random.Random) -> bytes:
+    buffer = io.BytesIO()
+    color = (rng.randrange(256), rng.randrange(256), rng.randrange(256))
+    Image.new("RGB", (128, 128), color).save(buffer, "PNG")
+    return buffer.getvalue()
+
+
+async def run(cards: int, distinct: int, seed: int) -> None:
+    rng = random.Random(seed)
+    distinct = min(distinct, cards)
+    avatars = [avatar_bytes(rng) for _ in range(16)]
+    specs = [
+        RankCardSpec(
+            f"user{i}",
+            rng.choice(avatars),
+            f"#{i + 1}",
+            rng.randrange(100),
+            rng.randrange(1000),
+            1000,
+        )
+        for i in range(cards)
+    ]
+    renderer = CardRenderer()
+    renderer.start()
+    # ワーカーの起動を計測に含めない
+    await asyncio.get_running_loop().run_in_executor(
+        renderer.pool(), avatar_bytes, random.Random(0)
+    )
+
+    try:
+        for label, requests in (
+            ("cold", specs),
+            ("cached", [specs[i % distinct] for i in range(cards)]),
+        ):
+            hits, misses = renderer.images.hits, renderer.images.misses
+            started = time.perf_counter()
+            await asyncio.gather(*(renderer.rank_card(spec) for spec in requests))
+            elapsed = time.perf_counter() - started
+            print(
+                f"{label}: {len(requests) / elapsed:.1f} cards/s"
+                f" (hits {renderer.images.hits - hits},"
+                f" misses {renderer.images.misses - misses})"
+            )
+    finally:
+        renderer.close()
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--cards", type=int, default=500)
+    parser.add_argument(
+        "--distinct", type=int, default=100, help="cachedで要求する異なるカードの数"
+    )
+    parser.add_argument("--workers", type=int, default=2)
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+    os.environ["CARD_RENDER_WORKERS"] = str(args.workers)
+    # 全てのカードをまとめて要求するので、待ち時間の上限で打ち切らない
+    os.environ["CARD_RENDER_TIMEOUT"] = "3600"
+    # キャッシュから溢れるとcachedの計測にならない
+    os.environ.setdefault("CARD_CACHE_SIZE", str(max(args.cards, 128)))
+    asyncio.run(run(args.cards, args.distinct, args.seed))
+
+
+if __name__ == "__main__":
+    main()
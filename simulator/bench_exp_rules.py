@@ -0,0 +1,134 @@
+"""
+EXP倍率ルールの評価がメッセージごとのXP処理に与える負荷を計測します
+Leveling.accrueをキャッシュが温まった状態で呼び、ルールなしとルールありの1メッセージあたりの時間を比べます
+(DBへの書き込みはフラッシュでまとめて行うので含まず、ジャーナルへの追記は一時ディレクトリに行います)
+
+    python -m simulator.bench_exp_rules --rules 200 --member-roles 20
+"""
+
+import argparse
+import asyncio
+import random
+import tempfile
+import time
+from types import SimpleNamespace
+
+from cogs.leveling import Leveling
+from utils.exp_rules import (
+    RULE_CHANNEL,
+    RULE_ROLE,
+    RULE_TIME,
+    compile_exp_rules,
+    parse_minute,
+    parse_weekdays,
+)
+from utils.journal import ExpJournal
+from utils.shared_state import InProcessSharedState
+from utils.xp_pipeline import XpEvent
+
+GUILD_ID = 1
+
+
+def build_rows(rules: int, seed: int) -> list[tuple]:
+    rng = random.Random(seed)
+    rows = []
+    for rule_id in range(rules):
+        kind = rng.choice([RULE_CHANNEL, RULE_ROLE, RULE_ROLE, RULE_TIME])
+        if kind == RULE_TIME:
+            rows.append(
+                (
+                    rule_id,
+                    kind,
+                    None,
+                    rng.choice([1.5, 2.0]),
+                    parse_weekdays("土日"),
+                    parse_minute("20:00"),
+                    parse_minute("02:00"),
+                    None,
+                    None,
+                )
+            )
+        else:
+            # 倍率0のルールは加算自体を省いて速くなるので、比較のために含めない
+            rows.append(
+                (rule_id, kind, rule_id, rng.choice([0.5, 2.0]), 0, 0, 0, None, None)
+            )
+    return rows
+
+
+async def measure(leveling: Leveling, events: list[XpEvent], number: int) -> float:
+    """
+    number件のイベントをaccrueで処理し、1メッセージあたりの秒数を返します
+    """
+
+    # バッファとジャーナルが前の計測の分だけ大きくならないようにする
+    leveling._buffer.take()
+    leveling.bot.journal.remove(leveling.bot.journal.rotate())
+    started = time.perf_counter()
+    for i in range(number):
+        await leveling.accrue(events[i % len(events)])
+    return (time.perf_counter() - started) / number
+
+
+async def run(args: argparse.Namespace) -> None:
+    rng = random.Random(args.seed)
+    rules = compile_exp_rules(build_rows(args.rules, args.seed))
+    # ルールに含まれるロールと含まれないロールを混ぜる
+    events = [
+        XpEvent(
+            GUILD_ID,
+            user_id,
+            rng.randrange(args.rules * 2),
+            None,
+            [rng.randrange(args.rules * 2) for _ in range(args.member_roles)],
+        )
+        for user_id in range(1, 1001)
+    ]
+
+    with tempfile.TemporaryDirectory(prefix="levelbot-bench-") as directory:
+        journal = ExpJournal(directory, "bench")
+        journal.open(0)
+        bot = SimpleNamespace(shared=InProcessSharedState(), journal=journal)
+        leveling = Leveling(bot)
+        # 設定と合計EXPはキャッシュ済みの状態で計測する
+        leveling._guild_settings[GUILD_ID] = (15, 25, False)
+        for event in events:
+            leveling._totals[(GUILD_ID, event.user_id)] = rng.randint(0, 1000000)
+        # レベルアップの通知とロール付与はdispatcherでバックグラウンドに回すので含めない
+        leveling.dispatch_level_up = lambda change: None
+
+        cases = {"without rules": compile_exp_rules([]), "with rules": rules}
+        results = {label: float("inf") for label in cases}
+        # マシンの負荷の揺らぎが片方に偏らないよう交互に計測し、それぞれの最小値を使う
+        for i in range(args.repeat + 1):
+            for label, exp_rules in cases.items():
+                leveling._exp_rules[GUILD_ID] = exp_rules
+                seconds = await measure(leveling, events, args.number)
+                # 1回目は温めるだけで計測しない
+                if i > 0:
+                    results[label] = min(results[label], seconds)
+        journal.close()
+
+    print(f"rules: {len(rules)}  member roles: {args.member_roles}")
+    for label, seconds in results.items():
+        print(f"accrue {label}: {seconds * 1e6:.2f}us/message")
+    base, with_rules = results["without rules"], results["with rules"]
+    print(
+        f"overhead: {(with_rules - base) * 1e6:.2f}us/message"
+        f" ({(with_rules - base) / base * 100:.1f}%)"
+    )
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--rules", type=int, default=100)
+    parser.add_argument("--member-roles", type=int, default=10)
+    parser.add_argument("--number", type=int, default=50000)
+    parser.add_argument("--repeat", type=int, default=5)
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+    asyncio.run(run(args))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,61 @@
+"""
+メンバーごとのロックのテーブルが、見たことのあるユーザー数によらず一定のメモリで動くかを計測します
+
+    python -m simulator.bench_locks --authors 3000000 --concurrency 500
+"""
+
+import argparse
+import asyncio
+import os
+import time
+
+from utils.shared_state import InProcessSharedState
+
+
+def rss_mb() -> float:
+    # 現在の常駐メモリ (Linux)
+    with open("/proc/self/statm") as f:
+        pages = int(f.read().split()[1])
+    return pages * os.sysconf("SC_PAGE_SIZE") / 1024 / 1024
+
+
+async def run(authors: int, concurrency: int, report_every: int) -> None:
+    shared = InProcessSharedState()
+    semaphore = asyncio.Semaphore(concurrency)
+
+    async def message(user_id: int) -> None:
+        try:
+            # on_messageと同じ形式のキーで、ロック内で1回処理を譲る
+            async with shared.lock(f"member:1:{user_id}"):
+                await asyncio.sleep(0)
+        finally:
+            semaphore.release()
+
+    started = time.perf_counter()
+    print(f"{'authors':>10} {'rss MB':>8} {'locks':>6} {'msg/s':>9}")
+    for user_id in range(authors):
+        await semaphore.acquire()
+        asyncio.create_task(message(user_id))
+        if (user_id + 1) % report_every == 0:
+            elapsed = time.perf_counter() - started
+            print(
+                f"{user_id + 1:>10} {rss_mb():>8.1f} {len(shared._locks):>6}"
+                f" {(user_id + 1) / elapsed:>9.0f}"
+            )
+    # 残りのタスクの終了を待つ
+    for _ in range(concurrency):
+        await semaphore.acquire()
+    print(f"locks left: {len(shared._locks)}")
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--authors", type=int, default=1000000)
+    parser.add_argument("--concurrency", type=int, default=500)
+    parser.add_argument("--report-every", type=int, default=250000)
+    args = parser.parse_args()
+    asyncio.run(run(args.authors, args.concurrency, args.report_every))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,93 @@
+"""
+/rankのDBの取得にかかる時間を、3回のクエリ (変更前) と1回のクエリ (変更後) で比較します
+DBは環境変数MYSQL_*で指定したローカルのMySQLを使い、計測用のギルドのデータは最後に削除します
+
+    python -m simulator.bench_rank --users 20000 --channels 20 --samples 500
+"""
+
+import argparse
+import asyncio
+import random
+import time
+
+from dotenv import load_dotenv
+
+from database.database import Database
+from simulator.runner import percentile
+
+# 本物のギルドと重ならないID
+BENCH_GUILD_ID = 1
+
+
+async def before(db: Database, user_id: int, guild_id: int) -> None:
+    # 変更前の/rankは合計、順位、チャンネルごとの順位を順番に取得していた
+    await db.get_user_level_total(user_id, guild_id)
+    await db.get_user_level_rank_total(user_id, guild_id)
+    await db.get_user_level_ranking_channel(user_id, guild_id)
+
+
+async def after(db: Database, user_id: int, guild_id: int) -> None:
+    await db.get_user_profile(user_id, guild_id)
+
+
+async def seed(db: Database, users: int, channels: int, rng: random.Random) -> None:
+    rows = [
+        (user_id, BENCH_GUILD_ID, channel_id, rng.randint(1, 10000))
+        for user_id in range(1, users + 1)
+        for channel_id in rng.sample(range(1, channels + 1), rng.randint(1, channels))
+    ]
+    # ジャーナルの適用済みの連番は記録しない
+    await db.apply_exp_batch(rows)
+
+
+async def run(args: argparse.Namespace) -> None:
+    rng = random.Random(args.seed)
+    db = Database()
+    await db.connect()
+    await db.init()
+    try:
+        await db.delete_all_user_levels(BENCH_GUILD_ID)
+        await seed(db, args.users, args.channels, rng)
+        user_ids = [rng.randint(1, args.users) for _ in range(args.samples)]
+
+        print(f"{'':>7} {'p50 ms':>8} {'p99 ms':>8} {'queries':>8}")
+        for label, fetch in (("before", before), ("after", after)):
+            # 1回目はバッファプールの読み込みを含むので計測しない
+            await fetch(db, user_ids[0], BENCH_GUILD_ID)
+            queries = db.query_count
+            latencies = []
+            semaphore = asyncio.Semaphore(args.concurrency)
+
+            async def sample(user_id: int) -> None:
+                async with semaphore:
+                    started = time.perf_counter()
+                    await fetch(db, user_id, BENCH_GUILD_ID)
+                    latencies.append(time.perf_counter() - started)
+
+            await asyncio.gather(*(sample(user_id) for user_id in user_ids))
+            print(
+                f"{label:>7} {percentile(latencies, 50) * 1000:>8.2f}"
+                f" {percentile(latencies, 99) * 1000:>8.2f}"
+                f" {(db.query_count - queries) / len(user_ids):>8.1f}"
+            )
+    finally:
+        await db.delete_all_user_levels(BENCH_GUILD_ID)
+        await db.close()
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--users", type=int, default=20000)
+    parser.add_argument("--channels", type=int, default=20)
+    parser.add_argument("--samples", type=int, default=500)
+    parser.add_argument(
+        "--concurrency", type=int, default=1, help="同時に実行する/rankの数"
+    )
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+    load_dotenv()
+    asyncio.run(run(args))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,256 @@
+import asyncio
+import datetime
+import itertools
+import json
+import time
+from collections import Counter
+from typing import Any, AsyncIterator
+
+import discord
+from discord.webhook.async_ import AsyncWebhookAdapter
+
+from utils.backfill import HistoryMessage
+
+BOT_USER_ID = 100000000000000001
+APPLICATION_ID = 100000000000000002
+# 管理者権限
+ADMIN_PERMISSIONS = 1 << 3
+
+_snowflakes = itertools.count(200000000000000000)
+
+
+def snowflake() -> str:
+    return str(next(_snowflakes))
+
+
+def timestamp() -> str:
+    return discord.utils.utcnow().isoformat()
+
+
+def user_payload(user_id: int, bot: bool = False) -> dict[str, Any]:
+    return {
+        "id": str(user_id),
+        "username": f"user{user_id}",
+        "global_name": None,
+        "discriminator": "0",
+        "avatar": None,
+        "bot": bot,
+    }
+
+
+def channel_payload(guild_id: int, channel_id: int, channel_type: int = 0) -> dict:
+    return {
+        "id": str(channel_id),
+        "guild_id": str(guild_id),
+        "type": channel_type,
+        "name": f"channel{channel_id}",
+        "position": 0,
+        "permission_overwrites": [],
+        "nsfw": False,
+        "parent_id": None,
+    }
+
+
+def guild_payload(guild_id: int, channel_ids: list[int]) -> dict[str, Any]:
+    return {
+        "id": str(guild_id),
+        "name": f"guild{guild_id}",
+        "owner_id": str(BOT_USER_ID),
+        "roles": [
+            {
+                "id": str(guild_id),
+                "name": "@everyone",
+                "permissions": "0",
+                "position": 0,
+                "color": 0,
+                "hoist": False,
+                "managed": False,
+                "mentionable": False,
+            }
+        ],
+        "channels": [channel_payload(guild_id, c) for c in channel_ids],
+        "members": [],
+        "voice_states": [],
+        "emojis": [],
+        "stickers": [],
+        "features": [],
+        "member_count": 0,
+        "unavailable": False,
+    }
+
+
+def member_payload(roles: list[int] | None = None) -> dict[str, Any]:
+    return {
+        "roles": [str(r) for r in roles or []],
+        "joined_at": timestamp(),
+        "deaf": False,
+        "mute": False,
+        "flags": 0,
+    }
+
+
+def message_payload(
+    guild_id: int | None,
+    channel_id: int,
+    author_id: int,
+    content: str = "",
+    bot: bool = False,
+) -> dict[str, Any]:
+    payload = {
+        "id": snowflake(),
+        "channel_id": str(channel_id),
+        "author": user_payload(author_id, bot),
+        "content": content,
+        "timestamp": timestamp(),
+        "edited_timestamp": None,
+        "tts": False,
+        "mention_everyone": False,
+        "mentions": [],
+        "mention_roles": [],
+        "attachments": [],
+        "embeds": [],
+        "pinned": False,
+        "type": 0,
+    }
+    if guild_id is not None:
+        payload["guild_id"] = str(guild_id)
+        payload["member"] = member_payload()
+    return payload
+
+
+def command_payload(name: str) -> dict[str, Any]:
+    """
+    "settings show"のようにスペース区切りでサブコマンドを指定します
+    """
+
+    root, *subcommands = name.split()
+    options: list[dict[str, Any]] = []
+    for subcommand in reversed(subcommands):
+        options = [{"name": subcommand, "type": 1, "options": options}]
+    return {"id": snowflake(), "name": root, "type": 1, "options": options}
+
+
+def interaction_payload(
+    guild_id: int, channel_id: int, user_id: int, command: str, token: str
+) -> dict[str, Any]:
+    return {
+        "id": snowflake(),
+        "application_id": str(APPLICATION_ID),
+        "type": 2,
+        "token": token,
+        "version": 1,
+        "guild_id": str(guild_id),
+        "channel_id": str(channel_id),
+        "channel": channel_payload(guild_id, channel_id),
+        "member": {
+            **member_payload(),
+            "user": user_payload(user_id),
+            "permissions": str(ADMIN_PERMISSIONS),
+        },
+        "app_permissions": str(ADMIN_PERMISSIONS),
+        "locale": "ja",
+        "guild_locale": "ja",
+        "data": command_payload(command),
+    }
+
+
+class FakeRest:
+    """
+    discord.pyのHTTPClient.requestを置き換えて、REST APIの呼び出しを記録します
+    """
+
+    def __init__(self, latency: float = 0.0):
+        self.calls: Counter[str] = Counter()
+        self.level_ups = 0
+        # 1回の呼び出しにかかる秒数
+        self.latency = latency
+
+    async def request(self, route: discord.http.Route, **kwargs: Any) -> Any:
+        key = f"{route.method} {route.path}"
+        self.calls[key] += 1
+        if self.latency > 0:
+            await asyncio.sleep(self.latency)
+        if key == "POST /channels/{channel_id}/messages":
+            content = (kwargs.get("json") or {}).get("content") or ""
+            if "LEVEL UP" in content:
+                self.level_ups += 1
+            return message_payload(None, route.channel_id, BOT_USER_ID, content, True)
+        if key == "GET /users/{user_id}":
+            return user_payload(int(route.url.rsplit("/", 1)[-1]))
+        if key == "GET /users/@me":
+            return user_payload(BOT_USER_ID, True)
+        if route.method == "PUT" and route.path.endswith("/commands"):
+            return []
+        return None
+
+    def total(self) -> int:
+        return sum(self.calls.values())
+
+
+class FakeWebhookAdapter(AsyncWebhookAdapter):
+    """
+    インタラクションへの応答とフォローアップを記録します
+    """
+
+    def __init__(self):
+        super().__init__()
+        self.calls: Counter[str] = Counter()
+        # token -> 応答した時刻のリスト
+        self.responses: dict[str, list[float]] = {}
+
+    async def request(self, route: discord.http.Route, session: Any, **kwargs: Any):
+        self.calls[f"{route.method} {route.path}"] += 1
+        token = route.url.split("/")[-2] if "/callback" in route.url else None
+        if token is None:
+            token = route.url.rsplit("/", 1)[-1].split("?")[0]
+            if token == "@original":
+                token = route.url.rsplit("/", 3)[-3]
+        self.responses.setdefault(token, []).append(time.perf_counter())
+
+        if route.method == "POST" and "/callback" in route.url:
+            return None
+        payload = kwargs.get("payload") or {}
+        if isinstance(payload, (bytes, str)):
+            payload = json.loads(payload)
+        return message_payload(
+            None, 0, BOT_USER_ID, payload.get("content") or "", bot=True
+        )
+
+
+class FakeHistorySource:
+    """
+    HistoryBackfillerに渡すメッセージ履歴の取得元
+    guild_id -> channel_id -> 古い順のメッセージのリストを持ち、ページの取得ごとにlatency秒待ちます
+    """
+
+    def __init__(
+        self,
+        messages: dict[int, dict[int, list[HistoryMessage]]],
+        page_size: int = 100,
+        latency: float = 0.0,
+        joined_at: datetime.datetime | None = None,
+    ):
+        self.messages = messages
+        self.page_size = page_size
+        self.latency = latency
+        self._joined_at = joined_at
+        self.pages = 0
+
+    def channels(self, guild_id: int) -> dict[int, int | None]:
+        return {channel_id: None for channel_id in self.messages.get(guild_id, {})}
+
+    def joined_at(self, guild_id: int) -> datetime.datetime | None:
+        return self._joined_at
+
+    async def history(
+        self, guild_id: int, channel_id: int, after: int, before: int
+    ) -> AsyncIterator[list[HistoryMessage]]:
+        messages = [
+            message
+            for message in self.messages.get(guild_id, {}).get(channel_id, [])
+            if after < message.message_id < before
+        ]
+        for i in range(0, len(messages), self.page_size):
+            await asyncio.sleep(self.latency)
+            self.pages += 1
+            yield messages[i : i + self.page_size]
@@ -0,0 +1,220 @@
+import asyncio
+import logging
+import time
+from collections import defaultdict
+from typing import Any, Iterable
+
+import discord
+from discord.webhook.async_ import async_context
+
+from main import DiscordLevelBot
+from simulator.fake_discord import (
+    APPLICATION_ID,
+    BOT_USER_ID,
+    FakeRest,
+    FakeWebhookAdapter,
+    guild_payload,
+    interaction_payload,
+    message_payload,
+    user_payload,
+)
+from simulator.traffic import Event
+
+LEVEL_ROLE_ID_BASE = 600000000000000000
+LEVEL_ROLE_LEVELS = [1, 5, 10, 20, 30]
+
+
+def percentile(values: list[float], p: float) -> float:
+    if not values:
+        return 0.0
+    values = sorted(values)
+    index = min(int(len(values) * p / 100), len(values) - 1)
+    return values[index]
+
+
+class Simulation:
+    """
+    偽のゲートウェイとREST層でDiscordLevelBotにイベントを流し込み、負荷を計測します
+    DBは環境変数MYSQL_*で指定したローカルのMySQLを使います
+    """
+
+    def __init__(
+        self,
+        events: Iterable[Event],
+        guild_channels: dict[int, list[int]],
+        level_roles: int = 3,
+        speed: float = 1.0,
+        bot: DiscordLevelBot | None = None,
+    ):
+        self.events = events
+        self.guild_channels = guild_channels
+        self.level_roles = level_roles
+        self.speed = speed
+        self.bot = bot or DiscordLevelBot()
+        self.rest = FakeRest()
+        self.webhook = FakeWebhookAdapter()
+        self.logger = logging.getLogger("simulator")
+        # ハンドラ名 -> 処理時間のリスト
+        self.latencies: dict[str, list[float]] = defaultdict(list)
+        self.in_flight = 0
+        # token -> インタラクションを流した時刻
+        self.command_started: dict[str, tuple[str, float]] = {}
+        self.messages = 0
+        self.commands = 0
+
+    def _patch_bot(self) -> None:
+        bot = self.bot
+        bot.http.request = self.rest.request
+        async_context.set(self.webhook)
+
+        run_event = bot._run_event
+
+        def timed_run_event(coro, event_name, *args, **kwargs):
+            name = getattr(coro, "__qualname__", event_name)
+            self.in_flight += 1
+            return self._timed(name, run_event(coro, event_name, *args, **kwargs))
+
+        bot._run_event = timed_run_event
+
+    async def _timed(self, name: str, coro) -> None:
+        start = time.perf_counter()
+        try:
+            await coro
+        finally:
+            self.latencies[name].append(time.perf_counter() - start)
+            self.in_flight -= 1
+
+    async def start(self) -> None:
+        self._patch_bot()
+        bot = self.bot
+        await bot._async_setup_hook()
+        bot._connection.user = discord.ClientUser(
+            state=bot._connection, data=user_payload(BOT_USER_ID, bot=True)
+        )
+        bot._connection.application_id = APPLICATION_ID
+        await bot.setup_hook()
+
+        for guild_id, channel_ids in self.guild_channels.items():
+            bot._connection._add_guild_from_data(guild_payload(guild_id, channel_ids))
+            for i, level in enumerate(LEVEL_ROLE_LEVELS[: self.level_roles]):
+                await bot.db.create_guild_level_role(
+                    guild_id, LEVEL_ROLE_ID_BASE + i, level
+                )
+
+        bot._ready.set()
+
+    def dispatch(self, event: Event) -> None:
+        parsers = self.bot._connection.parsers
+        if event["type"] == "message":
+            self.messages += 1
+            parsers["MESSAGE_CREATE"](
+                message_payload(event["guild"], event["channel"], event["user"])
+            )
+        elif event["type"] == "command":
+            self.commands += 1
+            token = f"sim-{self.commands}"
+            self.command_started[token] = (event["command"], time.perf_counter())
+            parsers["INTERACTION_CREATE"](
+                interaction_payload(
+                    event["guild"],
+                    event["channel"],
+                    event["user"],
+                    event["command"],
+                    token,
+                )
+            )
+
+    async def drain(self, timeout: float = 60) -> None:
+        """
+        流したイベントの処理が全て終わるまで待ちます
+        """
+
+        leveling = self.bot.get_cog("Leveling")
+        deadline = time.monotonic() + timeout
+        while time.monotonic() < deadline:
+            # スラッシュコマンドは_run_eventを経由しないので応答の有無で判断する
+            busy = self.in_flight > 0 or any(
+                token not in self.webhook.responses for token in self.command_started
+            )
+            if leveling is not None:
+                busy = (
+                    busy
+                    or bool(leveling._deferred)
+                    or leveling.admission.pending
+                    or leveling.dispatcher.pending
+                )
+            if not busy:
+                return
+            await asyncio.sleep(0.05)
+        self.logger.warning("Timed out waiting for handlers to finish")
+
+    async def run(self) -> dict[str, Any]:
+        await self.start()
+        bot = self.bot
+        leveling = bot.get_cog("Leveling")
+        queries_before = bot.db.query_count
+        rest_before = self.rest.total()
+
+        started = time.perf_counter()
+        for event in self.events:
+            delay = started + event["t"] / self.speed - time.perf_counter()
+            if delay > 0:
+                await asyncio.sleep(delay)
+            self.dispatch(event)
+        dispatched = time.perf_counter()
+        await self.drain()
+        if leveling is not None:
+            await leveling.flush()
+        finished = time.perf_counter()
+
+        report = self.report(
+            finished - started,
+            dispatched - started,
+            bot.db.query_count - queries_before,
+            self.rest.total() - rest_before,
+        )
+        await bot.close()
+        return report
+
+    def report(
+        self, elapsed: float, dispatch_elapsed: float, queries: int, rest_calls: int
+    ) -> dict[str, Any]:
+        handlers = {
+            name: {
+                "count": len(values),
+                "p50_ms": percentile(values, 50) * 1000,
+                "p99_ms": percentile(values, 99) * 1000,
+            }
+            for name, values in self.latencies.items()
+        }
+        commands: dict[str, list[float]] = defaultdict(list)
+        for token, (command, started) in self.command_started.items():
+            responses = self.webhook.responses.get(token)
+            if responses:
+                commands[command].append(max(responses) - started)
+        leveling = self.bot.get_cog("Leveling")
+        return {
+            "messages": self.messages,
+            "commands": self.commands,
+            "elapsed_s": elapsed,
+            "dispatch_elapsed_s": dispatch_elapsed,
+            "throughput_msg_s": self.messages / elapsed if elapsed else 0.0,
+            "handlers": handlers,
+            "commands_latency": {
+                name: {
+                    "count": len(values),
+                    "p50_ms": percentile(values, 50) * 1000,
+                    "p99_ms": percentile(values, 99) * 1000,
+                }
+                for name, values in commands.items()
+            },
+            "db_queries": queries,
+            "db_queries_per_message": queries / self.messages if self.messages else 0.0,
+            "rest_calls": rest_calls,
+            "rest_calls_by_route": dict(self.rest.calls),
+            "level_ups": self.rest.level_ups,
+            "rest_calls_per_level_up": (
+                rest_calls / self.rest.level_ups if self.rest.level_ups else 0.0
+            ),
+            "admission": leveling.admission.stats() if leveling else {},
+        }
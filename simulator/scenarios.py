@@ -0,0 +1,523 @@
+"""
+障害時の挙動を確認するシナリオ
+条件を満たさなかった場合は理由を表示して終了コード1で終了します
+DBは環境変数MYSQL_*で指定したローカルのMySQLを使います
+
+    python -m simulator.scenarios db-slowdown --delay 0.1 --rate 500
+    python -m simulator.scenarios reload --reloads 3
+    python -m simulator.scenarios backfill --history-days 30
+"""
+
+import argparse
+import asyncio
+import contextlib
+import datetime
+import logging
+import os
+import sys
+import tempfile
+from collections import Counter
+from typing import Any, AsyncIterator
+
+import discord
+from dotenv import load_dotenv
+
+from simulator.__main__ import print_report
+from simulator.fake_discord import FakeHistorySource
+from simulator.runner import Simulation, percentile
+from simulator.traffic import Event, TrafficModel
+from utils.backfill import HistoryBackfiller, HistoryMessage
+
+
+class SlowPool:
+    """
+    接続を渡す前にdelay秒待つaiomysqlのプールのラッパー
+    待つ間も接続を確保したままにするので、遅いクエリで接続が埋まる状況を再現します
+    """
+
+    def __init__(self, pool: Any, delay: float):
+        self._pool = pool
+        self.delay = delay
+
+    @contextlib.asynccontextmanager
+    async def acquire(self) -> AsyncIterator[Any]:
+        async with self._pool.acquire() as conn:
+            await asyncio.sleep(self.delay)
+            yield conn
+
+    def __getattr__(self, name: str) -> Any:
+        return getattr(self._pool, name)
+
+
+class SlowDatabaseSimulation(Simulation):
+    def __init__(self, *args: Any, delay: float, **kwargs: Any):
+        super().__init__(*args, **kwargs)
+        self.delay = delay
+
+    async def start(self) -> None:
+        await super().start()
+        # テーブルの作成やレベルロールの登録は遅くしない
+        self.bot.db.pool = SlowPool(self.bot.db.pool, self.delay)
+
+
+def command_ack_latencies(simulation: Simulation) -> list[float]:
+    """
+    スラッシュコマンドの最初の応答 (3秒以内に必要なもの) までの時間のリストを返します
+    """
+
+    latencies = []
+    for token, (_, started) in simulation.command_started.items():
+        responses = simulation.webhook.responses.get(token)
+        if responses:
+            latencies.append(min(responses) - started)
+    return latencies
+
+
+async def db_slowdown(args: argparse.Namespace) -> list[str]:
+    """
+    全てのクエリが遅くなった状態でメッセージを流し、
+    XP処理が後回しに切り替わることと、スラッシュコマンドが応答し続けることを確認します
+    """
+
+    model = TrafficModel(
+        1,
+        args.channels,
+        args.users,
+        args.user_skew,
+        0.0,
+        args.rate,
+        args.command_rate,
+        args.seed,
+    )
+    os.environ.setdefault("GUILD_ID", str(model.guild_ids[0]))
+    simulation = SlowDatabaseSimulation(
+        model.events(args.duration),
+        model.channel_ids,
+        delay=0.1 if args.delay is None else args.delay,
+    )
+    report = await simulation.run()
+    print_report(report)
+
+    failures = []
+    admission = report["admission"]
+    leveling = simulation.bot.get_cog("Leveling")
+    if admission["shed"] == 0 or admission["deferred"] == 0:
+        failures.append(
+            "DBが遅くても後回しにされたメッセージがありません (--rateか--delayを上げてください)"
+        )
+    if admission["deferred"] > admission["shed"]:
+        failures.append(
+            f"後回しにした数 {admission['deferred']} が溢れた数 {admission['shed']} を超えています"
+        )
+    if admission["pending"] or (leveling is not None and leveling._deferred):
+        failures.append("後回しにしたメッセージが処理しきれていません")
+
+    ack = command_ack_latencies(simulation)
+    if len(ack) < report["commands"]:
+        failures.append(
+            f"応答のないスラッシュコマンドがあります ({len(ack)}/{report['commands']})"
+        )
+    ack_p99 = percentile(ack, 99) * 1000
+    print(f"command ack: p99={ack_p99:.2f}ms")
+    if ack_p99 > args.max_ack_ms:
+        failures.append(
+            f"スラッシュコマンドの最初の応答のp99が {ack_p99:.0f}ms です (上限 {args.max_ack_ms}ms)"
+        )
+    for name, stats in report["commands_latency"].items():
+        if stats["p99_ms"] > args.max_command_ms:
+            failures.append(
+                f"/{name} の完了までのp99が {stats['p99_ms']:.0f}ms です"
+                f" (上限 {args.max_command_ms}ms)"
+            )
+    return failures
+
+
+class ReloadSimulation(SlowDatabaseSimulation):
+    """
+    再生の途中でcogs.levelingをリロードします
+    DBを遅くしておくので、リロード時にバッファ、後回しにしたメッセージ、
+    レベルアップの副作用のどれもが処理待ちの状態で引き継がれます
+    """
+
+    def __init__(
+        self,
+        *args: Any,
+        reload_at: list[float],
+        exp: int,
+        user_ids: list[int],
+        rest_latency: float,
+        **kwargs: Any,
+    ):
+        super().__init__(*args, **kwargs)
+        # レベルアップの通知に時間がかかるようにして、リロード時に実行中の副作用を残す
+        self.rest.latency = rest_latency
+        self.reload_at = sorted(reload_at)
+        self.exp = exp
+        self.user_ids = user_ids
+        # guild_id -> 再生前の合計EXP
+        self.before: dict[int, dict[int, int]] = {}
+        self._reload_tasks: list[asyncio.Task] = []
+        # リロードごとの引き継いだ処理待ちの数と、引き継ぎの失敗
+        self.handoffs: list[dict[str, int]] = []
+        self.handoff_errors: list[str] = []
+
+    async def start(self) -> None:
+        await super().start()
+        leveling = self.bot.get_cog("Leveling")
+        for guild_id in self.guild_channels:
+            # メッセージあたりのEXPを固定して、期待値を計算できるようにする
+            await self.bot.db.update_guild_setting(guild_id, self.exp, self.exp)
+            leveling.invalidate_guild(guild_id)
+            self.before[guild_id] = await self.bot.db.get_user_level_totals(
+                guild_id, self.user_ids
+            )
+
+    def dispatch(self, event: Event) -> None:
+        if self.reload_at and event["t"] >= self.reload_at[0]:
+            self.reload_at.pop(0)
+            self._reload_tasks.append(asyncio.create_task(self.reload()))
+        super().dispatch(event)
+
+    async def reload(self) -> None:
+        old = self.bot.get_cog("Leveling")
+        self.handoffs.append(
+            {
+                "buffer": len(old._buffer),
+                "deferred": len(old._deferred),
+                "dispatcher": old.dispatcher.pending,
+            }
+        )
+        await self.bot.reload_extension("cogs.leveling")
+        new = self.bot.get_cog("Leveling")
+        for name in ("_buffer", "_deferred", "_totals", "dispatcher", "admission"):
+            if getattr(new, name) is not getattr(old, name):
+                self.handoff_errors.append(f"{name} が引き継がれていません")
+        if self.bot.cog_states:
+            self.handoff_errors.append(
+                f"引き継がれなかった状態があります: {list(self.bot.cog_states)}"
+            )
+
+    async def drain(self, timeout: float = 60) -> None:
+        await asyncio.gather(*self._reload_tasks)
+        await super().drain(timeout)
+
+
+async def reload(args: argparse.Namespace) -> list[str]:
+    """
+    再生の途中でLevelingをリロードし、DBに書き込まれたEXPが流したメッセージの分と一致するかを確認します
+    メッセージあたりのEXPを--expに固定するので、メンバーごとの期待値はメッセージ数 x --expになります
+    """
+
+    model = TrafficModel(
+        1,
+        args.channels,
+        args.users,
+        args.user_skew,
+        0.0,
+        args.rate,
+        args.command_rate,
+        args.seed,
+    )
+    guild_id = model.guild_ids[0]
+    os.environ.setdefault("GUILD_ID", str(guild_id))
+    events = list(model.events(args.duration))
+    expected = Counter(event["user"] for event in events if event["type"] == "message")
+    simulation = ReloadSimulation(
+        events,
+        model.channel_ids,
+        # 後回しにしつつレベルアップも起きる程度に遅くする
+        delay=0.02 if args.delay is None else args.delay,
+        reload_at=[
+            args.duration * (i + 1) / (args.reloads + 1) for i in range(args.reloads)
+        ],
+        exp=args.exp,
+        user_ids=list(expected),
+        rest_latency=args.rest_latency,
+    )
+    bot = simulation.bot
+    report = await simulation.run()
+    print_report(report)
+    for i, handoff in enumerate(simulation.handoffs):
+        print(f"reload {i + 1}: {handoff}")
+
+    failures = list(simulation.handoff_errors)
+    if len(simulation.handoffs) < args.reloads:
+        failures.append(
+            f"リロードが {len(simulation.handoffs)}/{args.reloads} 回しか行われていません"
+        )
+    for name in ("buffer", "deferred", "dispatcher"):
+        if not any(handoff[name] for handoff in simulation.handoffs):
+            failures.append(
+                f"{name} が処理待ちの状態でリロードされていません (--rateか--delayを上げてください)"
+            )
+
+    # 計測が終わるとBotは閉じているので、DBだけ接続し直して読む
+    await bot.db.connect()
+    try:
+        after = await bot.db.get_user_level_totals(guild_id, list(expected))
+    finally:
+        await bot.db.close()
+    before = simulation.before[guild_id]
+    mismatched = {
+        user_id: (after.get(user_id, 0) - before.get(user_id, 0), count * args.exp)
+        for user_id, count in expected.items()
+        if after.get(user_id, 0) - before.get(user_id, 0) != count * args.exp
+    }
+    applied = sum(after.values()) - sum(before.values())
+    print(f"exp: applied {applied}, replayed {expected.total() * args.exp}")
+    if mismatched:
+        user_id, (got, want) = next(iter(mismatched.items()))
+        failures.append(
+            f"{len(mismatched)}人のEXPが一致しません (例: {user_id} は {got}、期待値 {want})"
+        )
+
+    leveling = bot.get_cog("Leveling")
+    if leveling is not None:
+        stats = leveling.dispatcher.stats()
+        if stats["failed"] or stats["dispatched"] != simulation.rest.level_ups:
+            failures.append(
+                f"レベルアップの通知 {simulation.rest.level_ups}件が"
+                f"予約した {stats['dispatched']}件と一致しません (失敗 {stats['failed']}件)"
+            )
+    return failures
+
+
+async def wait_backfill(backfiller: HistoryBackfiller, guild_id: int) -> None:
+    task = backfiller._tasks.get(guild_id)
+    if task is not None:
+        await asyncio.gather(task, return_exceptions=True)
+
+
+async def backfill(args: argparse.Namespace) -> list[str]:
+    """
+    同じメッセージ履歴を2つのギルドに取り込み、片方だけ途中のチャンネルで中断して再起動後に再開させます
+    両方のギルドの合計EXPが、Botの参加より前のメッセージ数 x --expと一致することと、
+    中断時にチャンネルの途中の進捗が保存され、再開後に全チャンネルが完了になることを確認します
+    """
+
+    model = TrafficModel(
+        1, args.channels, args.users, args.user_skew, 0.0, args.rate, 0.0, args.seed
+    )
+    uninterrupted = model.guild_ids[0]
+    interrupted = uninterrupted + 1
+    os.environ.setdefault("GUILD_ID", str(uninterrupted))
+    channel_ids = model.channel_ids[uninterrupted]
+    events = [
+        event for event in model.events(args.duration) if event["type"] == "message"
+    ]
+
+    # 再生の秒数を--history-days日分の履歴に引き延ばし、後半はBotの参加後としてon_messageで加算済みとする
+    now = discord.utils.utcnow()
+    started = now - datetime.timedelta(days=args.history_days)
+    joined_at = started + (now - started) * args.joined_at
+    history: dict[int, list[HistoryMessage]] = {
+        channel_id: [] for channel_id in channel_ids
+    }
+    expected: Counter[int] = Counter()
+    for i, event in enumerate(events):
+        created_at = started + (now - started) * (event["t"] / args.duration)
+        history[event["channel"]].append(
+            HistoryMessage(
+                discord.utils.time_snowflake(created_at) + i,
+                event["user"],
+                (),
+                created_at.timestamp(),
+            )
+        )
+        if created_at < joined_at:
+            expected[event["user"]] += 1
+    source = FakeHistorySource(
+        {uninterrupted: history, interrupted: history},
+        page_size=args.page_size,
+        latency=args.page_latency,
+        joined_at=joined_at,
+    )
+
+    simulation = Simulation([], {uninterrupted: channel_ids}, level_roles=0)
+    await simulation.start()
+    bot = simulation.bot
+    failures = []
+    try:
+        # 前回の実行で残った進捗を本物の取得元で再開させない
+        bot.backfill.stop()
+        before = {}
+        for guild_id in (uninterrupted, interrupted):
+            await bot.db.delete_backfill_checkpoints(guild_id)
+            await bot.db.update_guild_setting(guild_id, args.exp, args.exp)
+            before[guild_id] = await bot.db.get_user_level_totals(
+                guild_id, list(expected)
+            )
+
+        def backfiller() -> HistoryBackfiller:
+            backfiller = HistoryBackfiller(bot, source)
+            # 中断がチャンネルの途中になるよう、ページ2枚ごとに書き込む
+            backfiller.flush_size = args.page_size * 2
+            backfiller.rate = 0
+            return backfiller
+
+        first = backfiller()
+        await first.schedule(uninterrupted, None)
+        await wait_backfill(first, uninterrupted)
+
+        await first.schedule(interrupted, None)
+        task = first._tasks[interrupted]
+        half = len(events) // 2
+        while not task.done():
+            progress = first.progress.get(interrupted)
+            if progress is not None and progress.messages >= half:
+                break
+            await asyncio.sleep(0.01)
+        first.stop(interrupted)
+        await asyncio.gather(task, return_exceptions=True)
+
+        stopped = await bot.db.get_backfill_checkpoints(interrupted)
+        print(f"stopped: {first.progress[interrupted]}")
+        if all(done for *_, done in stopped):
+            failures.append(
+                "中断する前に取り込みが終わりました (--page-latencyを上げてください)"
+            )
+        if not any(messages and not done for *_, messages, done in stopped):
+            failures.append("チャンネルの途中の進捗が保存されていません")
+
+        # 再起動後と同じく、新しいインスタンスで未完了のギルドを再開する
+        second = backfiller()
+        await second.resume()
+        await wait_backfill(second, interrupted)
+        print(f"resumed: {second.progress[interrupted]}")
+
+        for guild_id in (uninterrupted, interrupted):
+            checkpoints = await bot.db.get_backfill_checkpoints(guild_id)
+            if len(checkpoints) != len(channel_ids) or not all(
+                done for *_, done in checkpoints
+            ):
+                failures.append(f"{guild_id} の取り込みが完了になっていません")
+            messages = sum(checkpoint[4] for checkpoint in checkpoints)
+            if messages != expected.total():
+                failures.append(
+                    f"{guild_id} の取り込んだメッセージ数 {messages} が"
+                    f"参加前のメッセージ数 {expected.total()} と一致しません"
+                )
+
+        totals = {}
+        for guild_id in (uninterrupted, interrupted):
+            after = await bot.db.get_user_level_totals(guild_id, list(expected))
+            totals[guild_id] = {
+                user_id: after.get(user_id, 0) - before[guild_id].get(user_id, 0)
+                for user_id in expected
+            }
+            mismatched = {
+                user_id: (got, expected[user_id] * args.exp)
+                for user_id, got in totals[guild_id].items()
+                if got != expected[user_id] * args.exp
+            }
+            if mismatched:
+                user_id, (got, want) = next(iter(mismatched.items()))
+                failures.append(
+                    f"{guild_id} の{len(mismatched)}人のEXPが一致しません"
+                    f" (例: {user_id} は {got}、期待値 {want})"
+                )
+        print(
+            f"exp: uninterrupted {sum(totals[uninterrupted].values())},"
+            f" interrupted {sum(totals[interrupted].values())},"
+            f" expected {expected.total() * args.exp}"
+        )
+        if totals[uninterrupted] != totals[interrupted]:
+            failures.append(
+                "中断して再開したギルドのEXPが中断しなかったギルドと一致しません"
+            )
+    finally:
+        for guild_id in (uninterrupted, interrupted):
+            await bot.db.delete_backfill_checkpoints(guild_id)
+        await bot.close()
+    return failures
+
+
+SCENARIOS = {
+    "backfill": backfill,
+    "db-slowdown": db_slowdown,
+    "reload": reload,
+}
+
+
+def parse_args() -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("scenario", choices=sorted(SCENARIOS))
+    parser.add_argument(
+        "--channels", type=int, default=5, help="ギルドごとのチャンネル数"
+    )
+    parser.add_argument("--users", type=int, default=1000)
+    parser.add_argument("--user-skew", type=float, default=1.1)
+    parser.add_argument("--rate", type=float, default=500, help="毎秒のメッセージ数")
+    parser.add_argument(
+        "--command-rate", type=float, default=5, help="毎秒のスラッシュコマンド数"
+    )
+    parser.add_argument("--duration", type=float, default=5, help="秒数")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument(
+        "--delay",
+        type=float,
+        default=None,
+        help="クエリごとの遅延 (秒、省略時はdb-slowdownが0.1、reloadが0.02)",
+    )
+    parser.add_argument(
+        "--max-ack-ms",
+        type=float,
+        default=3000,
+        help="db-slowdown: スラッシュコマンドの最初の応答のp99の上限",
+    )
+    parser.add_argument(
+        "--max-command-ms",
+        type=float,
+        default=10000,
+        help="db-slowdown: スラッシュコマンドの完了までのp99の上限",
+    )
+    parser.add_argument("--reloads", type=int, default=3, help="reload: リロード回数")
+    parser.add_argument(
+        "--exp", type=int, default=10, help="reload, backfill: メッセージあたりのEXP"
+    )
+    parser.add_argument(
+        "--rest-latency",
+        type=float,
+        default=0.2,
+        help="reload: REST APIの呼び出しごとの遅延 (秒)",
+    )
+    parser.add_argument(
+        "--history-days",
+        type=float,
+        default=30,
+        help="backfill: 再生の秒数を引き延ばす履歴の日数",
+    )
+    parser.add_argument(
+        "--joined-at",
+        type=float,
+        default=0.8,
+        help="backfill: Botが参加した時刻 (履歴の期間に対する割合)",
+    )
+    parser.add_argument(
+        "--page-size", type=int, default=50, help="backfill: 履歴の1ページの件数"
+    )
+    parser.add_argument(
+        "--page-latency",
+        type=float,
+        default=0.01,
+        help="backfill: 履歴のページの取得ごとの遅延 (秒)",
+    )
+    return parser.parse_args()
+
+
+def main() -> None:
+    logging.basicConfig(level=logging.WARNING)
+    load_dotenv()
+    # 本番のジャーナルやスナップショットを使わないよう一時ディレクトリに分ける
+    os.environ.setdefault("DATA_DIR", tempfile.mkdtemp(prefix="levelbot-sim-"))
+    args = parse_args()
+    failures = asyncio.run(SCENARIOS[args.scenario](args))
+    if failures:
+        for failure in failures:
+            print(f"FAILED: {failure}")
+        sys.exit(1)
+    print("OK")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,116 @@
+import bisect
+import itertools
+import json
+import random
+from typing import Iterator, TypedDict
+
+GUILD_ID_BASE = 300000000000000000
+CHANNEL_ID_BASE = 400000000000000000
+USER_ID_BASE = 500000000000000000
+
+COMMANDS = ["rank", "top", "rewards", "settings show"]
+
+
+class Event(TypedDict, total=False):
+    # 開始からの秒数
+    t: float
+    type: str
+    guild: int
+    channel: int
+    user: int
+    command: str
+
+
+def zipf_cum_weights(n: int, s: float) -> list[float]:
+    """
+    順位kの重みを1/k^sとした累積重み (s=0で一様分布)
+    """
+
+    return list(itertools.accumulate(1 / (k**s) for k in range(1, n + 1)))
+
+
+class TrafficModel:
+    """
+    ギルド・チャンネル・ユーザーの分布に従って合成イベントを生成します
+    ユーザーはZipf分布で偏らせるので、一部のユーザーが大半のメッセージを送ります
+    """
+
+    def __init__(
+        self,
+        guilds: int,
+        channels: int,
+        users: int,
+        user_skew: float,
+        guild_skew: float,
+        message_rate: float,
+        command_rate: float,
+        seed: int | None = None,
+    ):
+        self.guild_ids = [GUILD_ID_BASE + i for i in range(guilds)]
+        self.channel_ids = {
+            guild_id: [CHANNEL_ID_BASE + g * channels + c for c in range(channels)]
+            for g, guild_id in enumerate(self.guild_ids)
+        }
+        self.users = users
+        self.message_rate = message_rate
+        self.command_rate = command_rate
+        self.rng = random.Random(seed)
+        self._guild_weights = zipf_cum_weights(guilds, guild_skew)
+        self._user_weights = zipf_cum_weights(users, user_skew)
+        # ギルドごとにユーザーの並びを変えて、同じユーザーが全ギルドで上位にならないようにする
+        self._user_offsets = {
+            guild_id: self.rng.randrange(users) for guild_id in self.guild_ids
+        }
+
+    def _pick(self, cum_weights: list[float]) -> int:
+        x = self.rng.random() * cum_weights[-1]
+        return bisect.bisect_left(cum_weights, x)
+
+    def _event(self, t: float, event_type: str) -> Event:
+        guild_id = self.guild_ids[self._pick(self._guild_weights)]
+        user_rank = self._pick(self._user_weights)
+        user_index = (user_rank + self._user_offsets[guild_id]) % self.users
+        event: Event = {
+            "t": t,
+            "type": event_type,
+            "guild": guild_id,
+            "channel": self.rng.choice(self.channel_ids[guild_id]),
+            "user": USER_ID_BASE + user_index,
+        }
+        if event_type == "command":
+            event["command"] = self.rng.choice(COMMANDS)
+        return event
+
+    def events(self, duration: float) -> Iterator[Event]:
+        """
+        ポアソン過程でduration秒分のイベントを時刻順に生成します
+        """
+
+        total_rate = self.message_rate + self.command_rate
+        if total_rate <= 0:
+            return
+        t = 0.0
+        while True:
+            t += self.rng.expovariate(total_rate)
+            if t >= duration:
+                return
+            if self.rng.random() * total_rate < self.message_rate:
+                yield self._event(t, "message")
+            else:
+                yield self._event(t, "command")
+
+
+def record_events(path: str, events: Iterator[Event]) -> Iterator[Event]:
+    """
+    イベントをJSON Linesで書き出しながらそのまま流します
+    """
+
+    with open(path, "w", encoding="utf-8") as f:
+        for event in events:
+            f.write(json.dumps(event) + "\n")
+            yield event
+
+
+def load_events(path: str) -> list[Event]:
+    with open(path, encoding="utf-8") as f:
+        return [json.loads(line) for line in f if line.strip()]
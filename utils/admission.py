@@ -0,0 +1,60 @@
+import asyncio
+import contextlib
+from typing import AsyncIterator
+
+
+class AdmissionController:
+    """
+    XP処理の同時実行数と待ち行列の長さを制限します
+    上限を超えた分は呼び出し側で後回しにします (ロードシェディング)
+    """
+
+    def __init__(self, max_concurrency: int, max_queue: int):
+        self.max_concurrency = max_concurrency
+        self.max_queue = max_queue
+        self._semaphore = asyncio.Semaphore(max_concurrency)
+        # 実行中 + 待機中の数
+        self._pending = 0
+        self.admitted = 0
+        self.shed = 0
+        self.deferred = 0
+
+    @property
+    def pending(self) -> int:
+        return self._pending
+
+    def available(self) -> int:
+        """
+        待たずに実行できる残りの枠の数を返します
+        """
+
+        return max(self.max_concurrency - self._pending, 0)
+
+    def try_acquire(self) -> contextlib.AbstractAsyncContextManager[None] | None:
+        """
+        枠を確保できれば実行用のコンテキストマネージャを、
+        待ち行列も埋まっていればNoneを返します
+        """
+
+        if self._pending >= self.max_concurrency + self.max_queue:
+            self.shed += 1
+            return None
+        self._pending += 1
+        self.admitted += 1
+        return self._slot()
+
+    @contextlib.asynccontextmanager
+    async def _slot(self) -> AsyncIterator[None]:
+        try:
+            async with self._semaphore:
+                yield
+        finally:
+            self._pending -= 1
+
+    def stats(self) -> dict[str, int]:
+        return {
+            "pending": self._pending,
+            "admitted": self.admitted,
+            "shed": self.shed,
+            "deferred": self.deferred,
+        }
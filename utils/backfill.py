@@ -0,0 +1,408 @@
+import asyncio
+import datetime
+import json
+import logging
+import os
+import random
+import time
+from dataclasses import dataclass
+from typing import TYPE_CHECKING, AsyncIterator, Protocol, Sequence
+
+import discord
+
+from utils.exp_rules import ExpRules, compile_exp_rules
+from utils.role_sync import RoleConfig
+
+if TYPE_CHECKING:
+    from main import DiscordLevelBot
+
+
+@dataclass(slots=True)
+class HistoryMessage:
+    message_id: int
+    user_id: int
+    role_ids: Sequence[int]
+    # 送信された時刻 (UNIX時間)
+    created_at: float
+
+
+class HistorySource(Protocol):
+    """
+    過去のメッセージの取得元
+    Botやシステムメッセージなど、EXPの対象にならないメッセージは含めません
+    """
+
+    def channels(self, guild_id: int) -> dict[int, int | None]:
+        """
+        取り込むチャンネルのIDと、その親チャンネルまたはカテゴリのIDを返します
+        """
+        ...
+
+    def joined_at(self, guild_id: int) -> datetime.datetime | None:
+        """
+        Botがギルドに参加した時刻を返します (分からない場合はNone)
+        """
+        ...
+
+    def history(
+        self, guild_id: int, channel_id: int, after: int, before: int
+    ) -> AsyncIterator[list[HistoryMessage]]:
+        """
+        afterより後、beforeより前のメッセージを古い順にページ単位で返します
+        """
+        ...
+
+
+class DiscordHistorySource:
+    """
+    DiscordのAPIからメッセージ履歴を取得します
+    レートリミットはdiscord.pyのHTTPClientが処理します
+    """
+
+    def __init__(self, bot: "DiscordLevelBot", page_size: int = 100):
+        self.bot = bot
+        self.page_size = page_size
+
+    def channels(self, guild_id: int) -> dict[int, int | None]:
+        guild = self.bot.get_guild(guild_id)
+        if guild is None:
+            return {}
+        channels = {}
+        for channel in [*guild.text_channels, *guild.voice_channels, *guild.threads]:
+            if not channel.permissions_for(guild.me).read_message_history:
+                continue
+            channels[channel.id] = getattr(channel, "parent_id", None) or getattr(
+                channel, "category_id", None
+            )
+        return channels
+
+    def joined_at(self, guild_id: int) -> datetime.datetime | None:
+        guild = self.bot.get_guild(guild_id)
+        if guild is None or guild.me is None:
+            return None
+        return guild.me.joined_at
+
+    async def history(
+        self, guild_id: int, channel_id: int, after: int, before: int
+    ) -> AsyncIterator[list[HistoryMessage]]:
+        guild = self.bot.get_guild(guild_id)
+        channel = guild._resolve_channel(channel_id) if guild is not None else None
+        if channel is None:
+            return
+        page = []
+        async for message in channel.history(
+            limit=None,
+            after=discord.Object(id=after),
+            before=discord.Object(id=before),
+            oldest_first=True,
+        ):
+            if not message.author.bot and not message.is_system():
+                page.append(
+                    HistoryMessage(
+                        message.id,
+                        message.author.id,
+                        getattr(message.author, "_roles", ()),
+                        message.created_at.timestamp(),
+                    )
+                )
+            if len(page) >= self.page_size:
+                yield page
+                page = []
+        if page:
+            yield page
+
+
+@dataclass
+class BackfillProgress:
+    guild_id: int
+    channels: int
+    done_channels: int = 0
+    messages: int = 0
+    failed_channels: int = 0
+
+
+class HistoryBackfiller:
+    """
+    過去のメッセージ履歴からEXPを取り込みます
+    チャンネルを上限のある数のワーカーで並行して読み、EXPはメモリ上で集計してまとめて書き込みます
+    進捗はチャンネルごとにEXPと同じトランザクションで保存するので、再起動後も続きから再開します
+    """
+
+    def __init__(
+        self, bot: "DiscordLevelBot", source: HistorySource | None = None
+    ) -> None:
+        self.bot = bot
+        self.source = source or DiscordHistorySource(bot)
+        self.logger = logging.getLogger("backfill")
+        self.workers = int(os.environ.get("BACKFILL_WORKERS", 4))
+        # 何件のメッセージごとにDBへ書き込むか
+        self.flush_size = int(os.environ.get("BACKFILL_FLUSH", 5000))
+        # 全プロセス・全ワーカー合計の1秒あたりのページ取得の上限
+        self.rate = float(os.environ.get("BACKFILL_RATE", 10))
+        self.progress: dict[int, BackfillProgress] = {}
+        self._tasks: dict[int, asyncio.Task] = {}
+        # 合計EXPのキャッシュの破棄を通知していない、EXPを書き込んだギルド
+        self._updated: set[int] = set()
+
+    def running(self, guild_id: int) -> bool:
+        task = self._tasks.get(guild_id)
+        return task is not None and not task.done()
+
+    async def resume(self) -> None:
+        """
+        前回終わらなかった取り込みを再開します
+        """
+
+        guild_ids = {
+            guild_id
+            for guild_id, *_, done in await self.bot.db.get_backfill_checkpoints()
+            if not done
+        }
+        for guild_id in guild_ids:
+            self.start(guild_id)
+
+    async def schedule(self, guild_id: int, days: int | None) -> bool:
+        """
+        ギルドの取り込みを開始します
+        完了済みの場合は二重に加算しないよう開始せずFalseを返します
+        """
+
+        checkpoints = await self.bot.db.get_backfill_checkpoints(guild_id)
+        if not checkpoints:
+            before = discord.utils.time_snowflake(await self.cutoff(guild_id))
+            after = 0
+            if days is not None:
+                after = discord.utils.time_snowflake(
+                    discord.utils.utcnow() - datetime.timedelta(days=days)
+                )
+            channel_ids = list(self.source.channels(guild_id))
+            if not channel_ids:
+                return False
+            await self.bot.db.create_backfill_checkpoints(
+                guild_id, channel_ids, before, after
+            )
+        elif all(done for *_, done in checkpoints):
+            return False
+        self.start(guild_id)
+        return True
+
+    async def cutoff(self, guild_id: int) -> datetime.datetime:
+        """
+        取り込むメッセージの終わりの時刻を返します
+        Botの参加以降か、ギルドで最初にEXPが記録されて以降のメッセージはon_messageで加算されているので、
+        どちらか早い方より前だけを取り込みます
+        """
+
+        candidates = [discord.utils.utcnow()]
+        joined_at = self.source.joined_at(guild_id)
+        if joined_at is not None:
+            candidates.append(joined_at)
+        first_activity = await self.bot.db.get_guild_first_activity(guild_id)
+        if first_activity is not None:
+            candidates.append(
+                datetime.datetime.fromtimestamp(first_activity, datetime.timezone.utc)
+            )
+        return min(candidates)
+
+    def start(self, guild_id: int) -> None:
+        if not self.running(guild_id):
+            self._tasks[guild_id] = asyncio.create_task(
+                self.run(guild_id), name=f"backfill-{guild_id}"
+            )
+
+    def stop(self, guild_id: int | None = None) -> None:
+        """
+        取り込みを中断します (進捗は保存済みなので、もう一度開始すると続きから再開します)
+        """
+
+        for task_guild_id, task in list(self._tasks.items()):
+            if guild_id is None or task_guild_id == guild_id:
+                task.cancel()
+                del self._tasks[task_guild_id]
+
+    async def pace(self) -> None:
+        """
+        ページの取得数を共有のTTL付きカウンターで数え、上限を超えたら次の区間まで待ちます
+        同じBotのトークンを使う全プロセスで上限を共有します
+        """
+
+        if self.rate <= 0:
+            return
+        # 上限が毎秒1ページ未満でも1ページは取得できるよう区間を延ばす
+        period = max(1.0, 1 / self.rate)
+        limit = self.rate * period
+        while True:
+            now = time.time()
+            window = int(now // period)
+            pages = await self.bot.shared.incr(
+                f"backfill:pages:{window}", ttl=period * 2
+            )
+            if pages <= limit:
+                return
+            await asyncio.sleep((window + 1) * period - now)
+
+    async def run(self, guild_id: int) -> None:
+        await self.bot.wait_until_ready()
+        try:
+            checkpoints = await self.bot.db.get_backfill_checkpoints(guild_id)
+            pending = [checkpoint for checkpoint in checkpoints if not checkpoint[5]]
+            progress = BackfillProgress(
+                guild_id,
+                len(checkpoints),
+                len(checkpoints) - len(pending),
+                sum(checkpoint[4] for checkpoint in checkpoints),
+            )
+            self.progress[guild_id] = progress
+            min_exp, max_exp, _ = await self.bot.db.get_guild_setting(guild_id)
+            rules = compile_exp_rules(await self.bot.db.get_exp_rules(guild_id))
+            channels = self.source.channels(guild_id)
+
+            queue: asyncio.Queue[tuple] = asyncio.Queue()
+            for checkpoint in pending:
+                queue.put_nowait(checkpoint)
+
+            async def worker() -> None:
+                while not queue.empty():
+                    checkpoint = queue.get_nowait()
+                    await self.run_channel(
+                        progress,
+                        checkpoint,
+                        channels.get(checkpoint[1]),
+                        rules,
+                        min_exp,
+                        max_exp,
+                    )
+
+            workers = [
+                asyncio.create_task(worker())
+                for _ in range(min(self.workers, len(pending)))
+            ]
+            try:
+                await asyncio.gather(*workers)
+            finally:
+                for task in workers:
+                    task.cancel()
+
+            self.logger.info(
+                f"Backfilled guild {guild_id} "
+                f"({progress.messages} messages, {progress.failed_channels} channels failed)"
+            )
+            await self.reconcile_roles(guild_id)
+        except asyncio.CancelledError:
+            raise
+        except Exception:
+            # 進捗は保存済みなので、次回の起動時か再実行時に続きから再開する
+            self.logger.exception(f"Failed to backfill guild {guild_id}")
+        finally:
+            await self.invalidate(guild_id)
+
+    async def run_channel(
+        self,
+        progress: BackfillProgress,
+        checkpoint: tuple,
+        parent_id: int | None,
+        rules: ExpRules,
+        min_exp: int,
+        max_exp: int,
+    ) -> None:
+        """
+        1チャンネル分のメッセージを取り込みます
+        """
+
+        guild_id, channel_id, before, last_message_id, _, _ = checkpoint
+        # user_id -> 未書き込みのEXP
+        pending: dict[int, int] = {}
+        messages = 0
+        try:
+            async for page in self.source.history(
+                guild_id, channel_id, last_message_id, before
+            ):
+                for message in page:
+                    # 時間帯のルールはメッセージが送信された時刻で判定する
+                    multiplier = rules.multiplier(
+                        channel_id, parent_id, message.role_ids, message.created_at
+                    )
+                    if multiplier > 0:
+                        exp = round(random.randint(min_exp, max_exp) * multiplier)
+                        if exp > 0:
+                            pending[message.user_id] = (
+                                pending.get(message.user_id, 0) + exp
+                            )
+                    last_message_id = message.message_id
+                messages += len(page)
+                progress.messages += len(page)
+                if messages >= self.flush_size:
+                    await self.commit(
+                        guild_id, channel_id, pending, last_message_id, messages
+                    )
+                    pending = {}
+                    messages = 0
+                await self.pace()
+        except (discord.Forbidden, discord.NotFound):
+            # 権限がなくなったり削除されたりしたチャンネルは、取り込めた分までで完了にする
+            progress.failed_channels += 1
+            self.logger.warning(
+                f"Skipping channel {channel_id} of guild {guild_id} during backfill"
+            )
+        except Exception:
+            # 5xxやDBの切断などは一時的なものとして、このチャンネルだけ未完了のまま残す
+            # 書き込んでいない分は進捗も進めていないので、次回の再開時に読み直す
+            progress.failed_channels += 1
+            self.logger.exception(
+                f"Failed to backfill channel {channel_id} of guild {guild_id}"
+            )
+            return
+        try:
+            await self.commit(
+                guild_id, channel_id, pending, last_message_id, messages, True
+            )
+        except Exception:
+            progress.failed_channels += 1
+            self.logger.exception(
+                f"Failed to backfill channel {channel_id} of guild {guild_id}"
+            )
+            return
+        progress.done_channels += 1
+
+    async def commit(
+        self,
+        guild_id: int,
+        channel_id: int,
+        pending: dict[int, int],
+        last_message_id: int,
+        messages: int,
+        done: bool = False,
+    ) -> None:
+        await self.bot.db.apply_backfill_batch(
+            guild_id,
+            channel_id,
+            list(pending.items()),
+            last_message_id,
+            messages,
+            done,
+        )
+        if pending:
+            self._updated.add(guild_id)
+
+    async def invalidate(self, guild_id: int) -> None:
+        # 取り込みの終了時 (中断を含む) に1度だけ、全プロセスのLevelingに合計EXPのキャッシュの破棄を通知する
+        # 取り込み中はキャッシュの合計EXPが取り込んだ分だけ少なく見えるが、DBへの加算は差分なので失われない
+        if guild_id not in self._updated:
+            return
+        self._updated.discard(guild_id)
+        try:
+            await self.bot.shared.publish(
+                "leveling",
+                json.dumps({"scope": "member", "guild_id": guild_id, "user_id": None}),
+            )
+        except Exception:
+            self.logger.exception(f"Failed to invalidate totals of guild {guild_id}")
+
+    async def reconcile_roles(self, guild_id: int) -> None:
+        # 取り込みで上がったレベルのロールを、キャッシュにいるメンバーに付与する
+        level_roles = await self.bot.db.get_guild_level_roles(guild_id)
+        if not level_roles:
+            return
+        _, _, stack_level_roles = await self.bot.db.get_guild_setting(guild_id)
+        config = RoleConfig([tuple(r) for r in level_roles], bool(stack_level_roles))
+        await self.bot.role_sync.schedule(guild_id, config, config)
@@ -0,0 +1,280 @@
+import asyncio
+import concurrent.futures
+import functools
+import hashlib
+import io
+import logging
+import multiprocessing
+import os
+import pickle
+from collections import OrderedDict
+from dataclasses import dataclass
+from typing import Callable
+
+import discord
+from PIL import Image, ImageDraw, ImageFont
+
+BACKGROUND = (35, 39, 42)
+PANEL = (47, 49, 54)
+BAR_BACKGROUND = (72, 75, 78)
+ACCENT = (88, 101, 242)
+TEXT = (255, 255, 255)
+SUBTEXT = (185, 187, 190)
+
+
+@dataclass(frozen=True)
+class RankCardSpec:
+    name: str
+    avatar: bytes | None
+    rank: str
+    level: int
+    exp: int
+    next_exp: int
+
+
+@dataclass(frozen=True)
+class LeaderboardRow:
+    rank: int
+    name: str
+    avatar: bytes | None
+    level: int
+    exp: int
+
+
+@dataclass(frozen=True)
+class LeaderboardSpec:
+    title: str
+    rows: tuple[LeaderboardRow, ...]
+
+
+# 以下の描画関数はProcessPoolExecutorのワーカープロセスで実行します
+
+
+@functools.lru_cache(maxsize=None)
+def load_font(size: int) -> ImageFont.FreeTypeFont | ImageFont.ImageFont:
+    # 日本語の名前を描画する場合はCARD_FONT_PATHに日本語フォントを指定する
+    # ワーカープロセスごとにサイズ別に1回だけディスクから読み込む
+    path = os.environ.get("CARD_FONT_PATH")
+    if path:
+        return ImageFont.truetype(path, size)
+    return ImageFont.load_default(size)
+
+
+def warm_up() -> None:
+    # ワーカーの起動とフォントの読み込みを最初のリクエストの前に済ませておく
+    for size in (24, 32, 40):
+        load_font(size)
+
+
+def circle_avatar(avatar: bytes | None, size: int) -> Image.Image:
+    if avatar is None:
+        image = Image.new("RGBA", (size, size), BAR_BACKGROUND)
+    else:
+        image = Image.open(io.BytesIO(avatar)).convert("RGBA").resize((size, size))
+    mask = Image.new("L", (size, size), 0)
+    ImageDraw.Draw(mask).ellipse((0, 0, size - 1, size - 1), fill=255)
+    image.putalpha(mask)
+    return image
+
+
+def to_png(image: Image.Image) -> bytes:
+    buffer = io.BytesIO()
+    image.save(buffer, "PNG", optimize=False)
+    return buffer.getvalue()
+
+
+def render_rank_card(spec: RankCardSpec) -> bytes:
+    image = Image.new("RGBA", (934, 282), BACKGROUND)
+    draw = ImageDraw.Draw(image)
+    draw.rounded_rectangle((20, 20, 914, 262), radius=24, fill=PANEL)
+    image.alpha_composite(circle_avatar(spec.avatar, 180), (50, 51))
+
+    draw.text((270, 70), spec.name, font=load_font(40), fill=TEXT)
+    draw.text(
+        (880, 70),
+        f"{spec.rank}  LEVEL {spec.level}",
+        font=load_font(32),
+        fill=ACCENT,
+        anchor="ra",
+    )
+    draw.text(
+        (880, 170),
+        f"{spec.exp} / {spec.next_exp} XP",
+        font=load_font(24),
+        fill=SUBTEXT,
+        anchor="rb",
+    )
+
+    bar = (270, 180, 880, 220)
+    draw.rounded_rectangle(bar, radius=20, fill=BAR_BACKGROUND)
+    progress = min(spec.exp / spec.next_exp, 1.0) if spec.next_exp > 0 else 0.0
+    width = int((bar[2] - bar[0]) * progress)
+    if width >= bar[3] - bar[1]:
+        draw.rounded_rectangle(
+            (bar[0], bar[1], bar[0] + width, bar[3]), radius=20, fill=ACCENT
+        )
+    return to_png(image)
+
+
+def render_leaderboard(spec: LeaderboardSpec) -> bytes:
+    row_height = 64
+    image = Image.new("RGBA", (800, 80 + row_height * len(spec.rows)), BACKGROUND)
+    draw = ImageDraw.Draw(image)
+    draw.text((30, 24), spec.title, font=load_font(32), fill=TEXT)
+
+    font = load_font(24)
+    for i, row in enumerate(spec.rows):
+        top = 80 + row_height * i
+        draw.rounded_rectangle(
+            (20, top, 780, top + row_height - 8), radius=12, fill=PANEL
+        )
+        middle = top + (row_height - 8) // 2
+        draw.text((60, middle), f"#{row.rank}", font=font, fill=ACCENT, anchor="mm")
+        image.alpha_composite(circle_avatar(row.avatar, 44), (100, middle - 22))
+        draw.text((160, middle), row.name, font=font, fill=TEXT, anchor="lm")
+        draw.text(
+            (760, middle),
+            f"Lv. {row.level}  Exp. {row.exp}",
+            font=font,
+            fill=SUBTEXT,
+            anchor="rm",
+        )
+    return to_png(image)
+
+
+class LRUCache:
+    def __init__(self, max_size: int):
+        self.max_size = max_size
+        self._items: OrderedDict = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def __len__(self) -> int:
+        return len(self._items)
+
+    def get(self, key):
+        value = self._items.get(key)
+        if value is None:
+            self.misses += 1
+            return None
+        self._items.move_to_end(key)
+        self.hits += 1
+        return value
+
+    def put(self, key, value) -> None:
+        self._items[key] = value
+        self._items.move_to_end(key)
+        while len(self._items) > self.max_size:
+            self._items.popitem(last=False)
+
+
+class CardRenderer:
+    """
+    ランクカードとランキングの画像をプロセスプールで描画します
+    アバターの画像はURLごとに、描画した画像は内容のハッシュごとにLRUキャッシュに保持するので、
+    同じ内容の画像は描画し直しません
+    """
+
+    def __init__(self):
+        self.logger = logging.getLogger("card_renderer")
+        self.workers = int(os.environ.get("CARD_RENDER_WORKERS", 2))
+        self.avatars = LRUCache(int(os.environ.get("AVATAR_CACHE_SIZE", 512)))
+        self.images = LRUCache(int(os.environ.get("CARD_CACHE_SIZE", 128)))
+        # 待つ時間の上限 (秒)。超えた場合もバックグラウンドで続け、終わればキャッシュする
+        self.avatar_timeout = float(os.environ.get("AVATAR_FETCH_TIMEOUT", 3))
+        self.render_timeout = float(os.environ.get("CARD_RENDER_TIMEOUT", 5))
+        self._pool: concurrent.futures.ProcessPoolExecutor | None = None
+        # 同じアバター・画像を同時に取得/描画しないよう、実行中の処理を共有する
+        self._avatar_tasks: dict[str, asyncio.Task] = {}
+        self._render_tasks: dict[str, asyncio.Future] = {}
+
+    def pool(self) -> concurrent.futures.ProcessPoolExecutor:
+        if self._pool is None:
+            # イベントループやログのスレッドを持つプロセスをforkしないようspawnで起動する
+            self._pool = concurrent.futures.ProcessPoolExecutor(
+                self.workers, mp_context=multiprocessing.get_context("spawn")
+            )
+        return self._pool
+
+    def start(self) -> None:
+        pool = self.pool()
+        for _ in range(self.workers):
+            pool.submit(warm_up)
+
+    def close(self) -> None:
+        if self._pool is not None:
+            self._pool.shutdown(wait=False, cancel_futures=True)
+            self._pool = None
+
+    async def avatar(self, asset: discord.Asset | None) -> bytes | None:
+        """
+        アバターの画像を返します
+        取得に失敗した場合や時間がかかる場合はNoneを返し、アバターなしで描画します
+        """
+
+        if asset is None:
+            return None
+        asset = asset.with_size(128)
+        data = self.avatars.get(asset.url)
+        if data is not None:
+            return data
+
+        task = self._avatar_tasks.get(asset.url)
+        if task is None:
+            task = asyncio.create_task(asset.read())
+            self._avatar_tasks[asset.url] = task
+            task.add_done_callback(
+                lambda task: self._finish(
+                    self._avatar_tasks, self.avatars, asset.url, task
+                )
+            )
+        try:
+            return await asyncio.wait_for(asyncio.shield(task), self.avatar_timeout)
+        except TimeoutError:
+            self.logger.warning(f"Timed out fetching avatar {asset.url}")
+            return None
+        except Exception as e:
+            self.logger.warning(f"Failed to fetch avatar {asset.url}: {e}")
+            return None
+
+    @staticmethod
+    def _finish(
+        running: dict[str, asyncio.Future],
+        cache: LRUCache,
+        key: str,
+        future: asyncio.Future,
+    ) -> None:
+        # 待っていた側がタイムアウトしていても、結果は次のリクエストのためにキャッシュする
+        running.pop(key, None)
+        if not future.cancelled() and future.exception() is None:
+            cache.put(key, future.result())
+
+    async def render(self, func: Callable[[object], bytes], spec: object) -> bytes:
+        """
+        画像を描画します
+        render_timeout秒以内に終わらない場合はTimeoutErrorを送出します
+        """
+
+        key = hashlib.sha256(
+            func.__name__.encode() + pickle.dumps(spec, protocol=5)
+        ).hexdigest()
+        data = self.images.get(key)
+        if data is not None:
+            return data
+
+        future = self._render_tasks.get(key)
+        if future is None:
+            future = asyncio.get_running_loop().run_in_executor(self.pool(), func, spec)
+            self._render_tasks[key] = future
+            future.add_done_callback(
+                lambda future: self._finish(
+                    self._render_tasks, self.images, key, future
+                )
+            )
+        return await asyncio.wait_for(asyncio.shield(future), self.render_timeout)
+
+    async def rank_card(self, spec: RankCardSpec) -> bytes:
+        return await self.render(render_rank_card, spec)
+
+    async def leaderboard(self, spec: LeaderboardSpec) -> bytes:
+        return await self.render(render_leaderboard, spec)
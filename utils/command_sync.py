@@ -0,0 +1,66 @@
+import hashlib
+import json
+import logging
+import os
+
+import discord
+from discord import app_commands
+
+
+class CommandSyncState:
+    """
+    同期済みコマンドツリーのフィンガープリントをギルドごとにローカル保存します
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        self.logger = logging.getLogger("command_sync")
+        self._hashes: dict[str, str] = {}
+        self.load()
+
+    def load(self) -> None:
+        """
+        保存済みのフィンガープリントを読み込みます
+        """
+
+        try:
+            with open(self.path, encoding="utf-8") as f:
+                self._hashes = json.load(f)
+        except FileNotFoundError:
+            self._hashes = {}
+        except (OSError, ValueError):
+            self.logger.warning(f"Failed to load {self.path}, ignoring")
+            self._hashes = {}
+
+    def save(self) -> None:
+        """
+        フィンガープリントを書き込みます
+        """
+
+        os.makedirs(os.path.dirname(self.path) or ".", exist_ok=True)
+        tmp_path = f"{self.path}.tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump(self._hashes, f, indent=2, sort_keys=True)
+        os.replace(tmp_path, self.path)
+
+    def get(self, guild_id: int | None) -> str | None:
+        return self._hashes.get(str(guild_id or "global"))
+
+    def set(self, guild_id: int | None, fingerprint: str) -> None:
+        self._hashes[str(guild_id or "global")] = fingerprint
+        self.save()
+
+
+def command_tree_fingerprint(
+    tree: app_commands.CommandTree, guild: discord.abc.Snowflake | None = None
+) -> str:
+    """
+    同期されるコマンドツリーのペイロードから安定したハッシュを計算します
+    """
+
+    payload = [command.to_dict(tree) for command in tree.get_commands(guild=guild)]
+    payload.sort(key=lambda c: (c.get("type", 1), c["name"]))
+    serialized = json.dumps(
+        payload, sort_keys=True, separators=(",", ":"), ensure_ascii=False
+    )
+    return hashlib.sha256(serialized.encode("utf-8")).hexdigest()
@@ -0,0 +1,44 @@
+import asyncio
+
+
+class ExpBuffer:
+    """
+    DBへの書き込み待ちのEXP加算をまとめて保持します
+    同じ(ユーザー, ギルド, チャンネル)への加算は1つにまとめられます
+    """
+
+    def __init__(self):
+        self.pending: dict[tuple[int, int, int], int] = {}
+        self.pending_totals: dict[tuple[int, int], int] = {}
+        # フラッシュ中はDBの合計値とバッファの内容が食い違うので、合計値の読み込みと排他する
+        self.flush_lock = asyncio.Lock()
+
+    def __len__(self) -> int:
+        return len(self.pending)
+
+    def add(self, user_id: int, guild_id: int, channel_id: int, exp: int) -> None:
+        key = (user_id, guild_id, channel_id)
+        self.pending[key] = self.pending.get(key, 0) + exp
+        total_key = (guild_id, user_id)
+        self.pending_totals[total_key] = self.pending_totals.get(total_key, 0) + exp
+
+    def pending_total(self, guild_id: int, user_id: int) -> int:
+        return self.pending_totals.get((guild_id, user_id), 0)
+
+    def take(self) -> dict[tuple[int, int, int], int]:
+        """
+        保持している加算を全て取り出します
+        """
+
+        pending = self.pending
+        self.pending = {}
+        self.pending_totals = {}
+        return pending
+
+    def restore(self, pending: dict[tuple[int, int, int], int]) -> None:
+        """
+        書き込みに失敗した加算をバッファに戻します
+        """
+
+        for (user_id, guild_id, channel_id), exp in pending.items():
+            self.add(user_id, guild_id, channel_id, exp)
@@ -0,0 +1,238 @@
+import datetime
+import os
+import re
+import time
+from dataclasses import dataclass
+from typing import Iterable
+from zoneinfo import ZoneInfo
+
+RULE_CHANNEL = "channel"
+RULE_ROLE = "role"
+RULE_TIME = "time"
+
+# 時間帯ルールの曜日と時刻はこのタイムゾーンで解釈する
+RULE_TIMEZONE = ZoneInfo(os.environ.get("EXP_RULE_TIMEZONE", "Asia/Tokyo"))
+
+WEEKDAYS = ["月", "火", "水", "木", "金", "土", "日"]
+WEEKDAY_ALIASES = {
+    **{name: i for i, name in enumerate(WEEKDAYS)},
+    **{
+        name: i
+        for i, name in enumerate(["mon", "tue", "wed", "thu", "fri", "sat", "sun"])
+    },
+}
+
+# ロールの組み合わせごとの倍率キャッシュの上限
+MAX_MASK_CACHE = 4096
+
+
+def parse_weekdays(value: str | None) -> int:
+    """
+    "土日"や"sat,sun"を曜日のビットマスク (月曜が1) にします
+    空の場合は毎日を表す0を返します
+    """
+
+    mask = 0
+    for token in re.findall(r"[a-zA-Z]+|[^\sa-zA-Z,、]", value or ""):
+        token = token.lower()[:3]
+        if token not in WEEKDAY_ALIASES:
+            raise ValueError(f"Unknown weekday {token}")
+        mask |= 1 << WEEKDAY_ALIASES[token]
+    return mask
+
+
+def format_weekdays(mask: int) -> str:
+    if mask == 0:
+        return "毎日"
+    return "".join(name for i, name in enumerate(WEEKDAYS) if mask >> i & 1)
+
+
+def parse_minute(value: str) -> int:
+    """
+    "HH:MM"を0時からの分数にします
+    """
+
+    hour, _, minute = value.partition(":")
+    hour, minute = int(hour), int(minute or 0)
+    if not (0 <= hour <= 24 and 0 <= minute < 60) or hour * 60 + minute > 24 * 60:
+        raise ValueError(f"Invalid time {value}")
+    return hour * 60 + minute
+
+
+def format_minute(minute: int) -> str:
+    return f"{minute // 60:02}:{minute % 60:02}"
+
+
+def parse_datetime(value: str) -> datetime.datetime:
+    """
+    "YYYY-MM-DD HH:MM"または"YYYY-MM-DD"をRULE_TIMEZONEの日時にします
+    """
+
+    for fmt in ("%Y-%m-%d %H:%M", "%Y-%m-%d"):
+        try:
+            parsed = datetime.datetime.strptime(value.strip(), fmt)
+        except ValueError:
+            continue
+        return parsed.replace(tzinfo=RULE_TIMEZONE)
+    raise ValueError(f"Invalid datetime {value}")
+
+
+@dataclass(frozen=True)
+class TimeWindow:
+    factor: float
+    # 曜日のビットマスク (0は毎日)
+    weekdays: int
+    # 0時からの分数、start == endは終日、start > endは日付を跨ぐ
+    start_minute: int
+    end_minute: int
+    # UNIX時間、Noneは無期限
+    starts_at: float | None = None
+    ends_at: float | None = None
+
+    def active(self, now: datetime.datetime) -> bool:
+        timestamp = now.timestamp()
+        if self.starts_at is not None and timestamp < self.starts_at:
+            return False
+        if self.ends_at is not None and timestamp >= self.ends_at:
+            return False
+
+        weekday = now.weekday()
+        minute = now.hour * 60 + now.minute
+        if self.start_minute < self.end_minute:
+            if not self.start_minute <= minute < self.end_minute:
+                return False
+        elif self.start_minute > self.end_minute:
+            if minute < self.end_minute:
+                # 日付を跨いだ後半は前日の曜日として扱う
+                weekday = (weekday - 1) % 7
+            elif minute < self.start_minute:
+                return False
+        return self.weekdays == 0 or bool(self.weekdays >> weekday & 1)
+
+
+class ExpRules:
+    """
+    ギルドのEXP倍率ルールをメッセージごとに評価しやすい形にまとめたもの
+    倍率はチャンネル × ロールの最大値 × 有効な時間帯の最大値で、
+    チャンネルの倍率が0の場合はEXPを付与しません
+    """
+
+    __slots__ = (
+        "channels",
+        "role_bits",
+        "role_factors",
+        "windows",
+        "_mask_factors",
+        "_time_key",
+        "_time_factor",
+    )
+
+    def __init__(
+        self,
+        channels: dict[int, float],
+        roles: dict[int, float],
+        windows: list[TimeWindow],
+    ):
+        self.channels = channels
+        # ロールごとにビットを割り当て、メンバーのロールの組み合わせ (ビットマスク) ごとに倍率を求める
+        self.role_bits = {role_id: 1 << i for i, role_id in enumerate(roles)}
+        self.role_factors = list(roles.values())
+        self.windows = windows
+        self._mask_factors: dict[int, float] = {0: 1.0}
+        self._time_key = -1
+        self._time_factor = 1.0
+
+    def __len__(self) -> int:
+        return len(self.channels) + len(self.role_bits) + len(self.windows)
+
+    def channel_factor(self, channel_id: int, parent_id: int | None = None) -> float:
+        factor = self.channels.get(channel_id)
+        if factor is None and parent_id is not None:
+            factor = self.channels.get(parent_id)
+        return 1.0 if factor is None else factor
+
+    def role_factor(self, role_ids: Iterable[int]) -> float:
+        bits = self.role_bits
+        if not bits:
+            return 1.0
+        mask = 0
+        for role_id in role_ids:
+            mask |= bits.get(role_id, 0)
+
+        factor = self._mask_factors.get(mask)
+        if factor is None:
+            factor = max(f for i, f in enumerate(self.role_factors) if mask >> i & 1)
+            if len(self._mask_factors) >= MAX_MASK_CACHE:
+                self._mask_factors = {0: 1.0}
+            self._mask_factors[mask] = factor
+        return factor
+
+    def time_factor(self, now: float) -> float:
+        if not self.windows:
+            return 1.0
+        # 時間帯は分単位なので、同じ分の間は前回の結果を使う
+        key = int(now // 60)
+        if key != self._time_key:
+            current = datetime.datetime.fromtimestamp(now, RULE_TIMEZONE)
+            self._time_factor = max(
+                (w.factor for w in self.windows if w.active(current)), default=1.0
+            )
+            self._time_key = key
+        return self._time_factor
+
+    def multiplier(
+        self,
+        channel_id: int,
+        parent_id: int | None,
+        role_ids: Iterable[int],
+        now: float | None = None,
+    ) -> float:
+        factor = self.channel_factor(channel_id, parent_id)
+        if factor <= 0:
+            return 0.0
+        return (
+            factor
+            * self.role_factor(role_ids)
+            * self.time_factor(time.time() if now is None else now)
+        )
+
+
+def compile_exp_rules(rows: Iterable[tuple]) -> ExpRules:
+    """
+    Database.get_exp_rulesの行からExpRulesを作ります
+    """
+
+    channels: dict[int, float] = {}
+    roles: dict[int, float] = {}
+    windows: list[TimeWindow] = []
+    for (
+        _,
+        kind,
+        target_id,
+        factor,
+        weekdays,
+        start_minute,
+        end_minute,
+        starts_at,
+        ends_at,
+    ) in rows:
+        if kind == RULE_CHANNEL:
+            channels[target_id] = factor
+        elif kind == RULE_ROLE:
+            roles[target_id] = factor
+        elif kind == RULE_TIME:
+            windows.append(
+                TimeWindow(
+                    factor,
+                    weekdays,
+                    start_minute,
+                    end_minute,
+                    starts_at.replace(tzinfo=datetime.timezone.utc).timestamp()
+                    if starts_at
+                    else None,
+                    ends_at.replace(tzinfo=datetime.timezone.utc).timestamp()
+                    if ends_at
+                    else None,
+                )
+            )
+    return ExpRules(channels, roles, windows)
@@ -0,0 +1,94 @@
+from typing import TYPE_CHECKING, Any, Awaitable, Callable
+
+from utils.xp_pipeline import XpEvent
+
+if TYPE_CHECKING:
+    from main import DiscordLevelBot
+
+# Message.is_system()がFalseになるメッセージの種類
+# (通常、返信、スラッシュコマンド、スレッドの最初のメッセージ、コンテキストメニュー)
+XP_MESSAGE_TYPES = frozenset({0, 19, 20, 21, 23})
+
+
+class RawMessageIngest:
+    """
+    MESSAGE_CREATEのパーサーを置き換え、EXPの加算に必要なフィールドだけを生のペイロードから取り出します
+    discord.Message (埋め込み、添付ファイル、メンション、Memberなど) は、
+    他にon_messageのリスナーやプレフィックスコマンドがある場合だけ元のパーサーで作ります
+    """
+
+    def __init__(
+        self,
+        bot: "DiscordLevelBot",
+        handler: Callable[[XpEvent], Awaitable[None]],
+        listener: Callable[..., Any] | None = None,
+    ):
+        self.bot = bot
+        self.handler = handler
+        # handlerと同じ処理をするon_messageのリスナー (Messageが必要かの判定で数えない)
+        self.listener = listener
+        self._original: Callable[[dict], None] | None = None
+        self.events = 0
+        self.messages = 0
+
+    @property
+    def installed(self) -> bool:
+        return self._original is not None
+
+    def install(self) -> None:
+        parsers = self.bot._connection.parsers
+        self._original = parsers["MESSAGE_CREATE"]
+        parsers["MESSAGE_CREATE"] = self.parse
+
+    def uninstall(self) -> None:
+        if self._original is None:
+            return
+        self.bot._connection.parsers["MESSAGE_CREATE"] = self._original
+        self._original = None
+
+    def needs_message(self) -> bool:
+        bot = self.bot
+        if bot.all_commands or bot._listeners.get("message"):
+            return True
+        return any(
+            listener != self.listener
+            for listener in bot.extra_events.get("on_message", [])
+        )
+
+    def parse(self, data: dict[str, Any]) -> None:
+        event = self.extract(data)
+        if event is not None:
+            self.events += 1
+            self.bot._schedule_event(self.handler, "xp_message", event)
+        if self.needs_message():
+            self.messages += 1
+            self._original(data)
+
+    def extract(self, data: dict[str, Any]) -> XpEvent | None:
+        """
+        EXPの対象になるメッセージならXpEventを、そうでなければNoneを返します
+        """
+
+        guild_id = data.get("guild_id")
+        if guild_id is None:
+            return None
+        if data["author"].get("bot") or data.get("type", 0) not in XP_MESSAGE_TYPES:
+            return None
+        guild = self.bot._connection._get_guild(int(guild_id))
+        if guild is None:
+            return None
+
+        channel_id = int(data["channel_id"])
+        channel = guild._resolve_channel(channel_id)
+        if channel is not None and hasattr(channel, "last_message_id"):
+            # 元のパーサーと同じくチャンネルの最後のメッセージを更新する
+            channel.last_message_id = int(data["id"])
+        member = data.get("member")
+        return XpEvent(
+            guild.id,
+            int(data["author"]["id"]),
+            channel_id,
+            getattr(channel, "parent_id", None)
+            or getattr(channel, "category_id", None),
+            list(map(int, member.get("roles", ()))) if member else [],
+        )
@@ -0,0 +1,159 @@
+import logging
+import os
+import socket
+import struct
+from typing import BinaryIO, Iterator
+
+# seq, user_id, guild_id, channel_id, exp
+RECORD = struct.Struct("<QQQQI")
+
+
+class ExpJournal:
+    """
+    バッファされたEXP加算を追記していくローカルジャーナル
+    DBへ書き込む前にクラッシュしても、次回起動時に再適用できます
+
+    ジャーナルは複数のセグメントファイルに分かれており、
+    DBへ書き込むたびにセグメントを切り替えて、書き込み済みのセグメントを削除します
+    各レコードには連番が振られており、DB側に記録した適用済みの連番以下のレコードは再適用しません
+
+    連番はジャーナルごとに独立しているので、適用済みの連番もjournal_idごとにDBに記録します
+    journal_idは環境変数JOURNAL_IDか、なければホスト名とディレクトリの絶対パスです
+    (再起動のたびにホスト名が変わる環境ではJOURNAL_IDを固定してください)
+    """
+
+    def __init__(self, directory: str, journal_id: str | None = None):
+        self.directory = directory
+        self.journal_id = (
+            journal_id
+            or os.environ.get("JOURNAL_ID")
+            or f"{socket.gethostname()}:{os.path.abspath(directory)}"
+        )
+        self.logger = logging.getLogger("journal")
+        self.seq = 0
+        self._file: BinaryIO | None = None
+        self._segment = 0
+        self._dirty = False
+
+    def segments(self) -> list[str]:
+        """
+        セグメントファイルを古い順に返します
+        """
+
+        try:
+            names = os.listdir(self.directory)
+        except FileNotFoundError:
+            return []
+        return [
+            os.path.join(self.directory, name)
+            for name in sorted(names)
+            if name.startswith("journal-") and name.endswith(".log")
+        ]
+
+    def read(self, path: str) -> Iterator[tuple[int, int, int, int, int]]:
+        """
+        セグメントファイルのレコードを読み込みます
+        書き込み途中で途切れた末尾のレコードは無視します
+        """
+
+        with open(path, "rb") as f:
+            data = f.read()
+        end = len(data) - len(data) % RECORD.size
+        if end != len(data):
+            self.logger.warning(f"Ignoring truncated record at the end of {path}")
+        yield from RECORD.iter_unpack(memoryview(data)[:end])
+
+    def replay(self, applied_seq: int) -> tuple[dict[tuple[int, int, int], int], int]:
+        """
+        未適用のレコードを集計して返します
+        """
+
+        pending: dict[tuple[int, int, int], int] = {}
+        last_seq = applied_seq
+        for path in self.segments():
+            for seq, user_id, guild_id, channel_id, exp in self.read(path):
+                if seq <= applied_seq:
+                    continue
+                key = (user_id, guild_id, channel_id)
+                pending[key] = pending.get(key, 0) + exp
+                last_seq = max(last_seq, seq)
+
+        return pending, last_seq
+
+    def open(self, seq: int) -> None:
+        """
+        新しいセグメントを開いて追記を開始します
+        """
+
+        os.makedirs(self.directory, exist_ok=True)
+        self.seq = seq
+        segments = self.segments()
+        if segments:
+            last = os.path.basename(segments[-1])
+            self._segment = int(last[len("journal-") : -len(".log")])
+        self._open_segment()
+
+    def _open_segment(self) -> None:
+        self._segment += 1
+        path = os.path.join(self.directory, f"journal-{self._segment:010d}.log")
+        self._file = open(path, "ab")
+
+    def append(self, user_id: int, guild_id: int, channel_id: int, exp: int) -> int:
+        """
+        加算を1件追記して連番を返します
+        ディスクへの書き出しはsyncでまとめて行います
+        """
+
+        self.seq += 1
+        if self._file is not None:
+            self._file.write(RECORD.pack(self.seq, user_id, guild_id, channel_id, exp))
+            self._dirty = True
+        else:
+            # 終了処理でジャーナルを閉じた後の加算は再起動後に復元できない
+            self.logger.warning(
+                f"Journal is closed, exp {exp} of user {user_id} in guild {guild_id} is not journaled"
+            )
+        return self.seq
+
+    def sync(self) -> None:
+        """
+        追記したレコードをディスクに書き出します
+        """
+
+        if self._file is None or not self._dirty:
+            return
+        self._file.flush()
+        os.fsync(self._file.fileno())
+        self._dirty = False
+
+    def rotate(self) -> list[str]:
+        """
+        現在のセグメントを閉じて新しいセグメントに切り替え、
+        閉じた全てのセグメントを返します
+        """
+
+        if self._file is None:
+            return []
+        self.sync()
+        self._file.close()
+        self._open_segment()
+        current = self._file.name
+        return [path for path in self.segments() if path != current]
+
+    def remove(self, paths: list[str]) -> None:
+        """
+        DBへの書き込みが完了したセグメントを削除します
+        """
+
+        for path in paths:
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+
+    def close(self) -> None:
+        if self._file is None:
+            return
+        self.sync()
+        self._file.close()
+        self._file = None
@@ -0,0 +1,85 @@
+import bisect
+import collections
+import functools
+from dataclasses import dataclass
+from typing import AsyncIterable
+
+from utils.util import LEVEL_EXP_TABLE, get_level
+
+
+@dataclass
+class LevelStats:
+    members: int
+    total_exp: int
+    # histogram[n]はレベルnのメンバー数
+    histogram: list[int]
+
+    @functools.cached_property
+    def reach_counts(self) -> list[int]:
+        # reach_counts[n]はレベルn以上のメンバー数
+        counts = list(self.histogram) + [0]
+        for level in range(len(self.histogram) - 1, -1, -1):
+            counts[level] += counts[level + 1]
+        return counts
+
+    @property
+    def max_level(self) -> int:
+        return len(self.histogram) - 1
+
+    @property
+    def mean_level(self) -> float:
+        if self.members == 0:
+            return 0.0
+        return sum(level * count for level, count in enumerate(self.histogram)) / (
+            self.members
+        )
+
+    def reach(self, level: int) -> int:
+        """
+        レベルlevel以上のメンバー数を返します
+        """
+
+        if level >= len(self.reach_counts):
+            return 0
+        return self.reach_counts[max(level, 0)]
+
+    def percentile(self, p: float) -> int:
+        """
+        下からp%の位置のメンバーのレベルを返します
+        """
+
+        if self.members == 0:
+            return 0
+        rank = min(int(self.members * p / 100), self.members - 1)
+        seen = 0
+        for level, count in enumerate(self.histogram):
+            seen += count
+            if seen > rank:
+                return level
+        return self.max_level
+
+
+async def compute_level_stats(chunks: AsyncIterable[list[int]]) -> LevelStats:
+    """
+    ユーザーごとの合計EXPのチャンクをレベルごとの人数に集計します
+    レベルは累計経験値の表の二分探索で求めるので、calculation_levelを1人ずつ呼ぶより速くなります
+    """
+
+    counter: collections.Counter[int] = collections.Counter()
+    members = 0
+    total_exp = 0
+    for_level = functools.partial(bisect.bisect_right, LEVEL_EXP_TABLE)
+    async for chunk in chunks:
+        if not chunk:
+            continue
+        # 表が足りない場合は先に伸ばしておく
+        get_level(max(chunk))
+        counter.update(map(for_level, chunk))
+        members += len(chunk)
+        total_exp += sum(chunk)
+
+    # bisect_rightの戻り値はレベル + 1
+    histogram = [0] * (max(counter, default=1))
+    for index, count in counter.items():
+        histogram[index - 1] = count
+    return LevelStats(members, total_exp, histogram)
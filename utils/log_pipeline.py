@@ -0,0 +1,192 @@
+import json
+import logging
+import logging.handlers
+import queue
+import random
+import sys
+import threading
+import time
+
+# LogRecordが標準で持つ属性 (これ以外はextraで渡された値としてJSONに含める)
+RESERVED_ATTRS = frozenset(
+    vars(logging.LogRecord("", 0, "", 0, "", (), None)).keys()
+    | {"message", "asctime", "dropped"}
+)
+
+
+def parse_limits(value: str | None) -> dict[str, str]:
+    """
+    "database.slow_query=5:20,leveling=1"のような指定をロガー名ごとに分けます
+    """
+
+    limits = {}
+    for item in (value or "").split(","):
+        name, sep, limit = item.strip().partition("=")
+        if sep:
+            limits[name.strip()] = limit.strip()
+    return limits
+
+
+class JsonFormatter(logging.Formatter):
+    """
+    1レコードを1行のJSONにします
+    """
+
+    def format(self, record: logging.LogRecord) -> str:
+        payload = {
+            "ts": round(record.created, 6),
+            "level": record.levelname,
+            "logger": record.name,
+            "msg": record.getMessage(),
+        }
+        for key, value in vars(record).items():
+            if key not in RESERVED_ATTRS and not key.startswith("_"):
+                payload[key] = value
+        dropped = getattr(record, "dropped", 0)
+        if dropped:
+            payload["dropped"] = dropped
+        if record.exc_info:
+            payload["exc"] = self.formatException(record.exc_info)
+        if record.stack_info:
+            payload["stack"] = self.formatStack(record.stack_info)
+        return json.dumps(payload, ensure_ascii=False, default=str)
+
+
+class _Bucket:
+    def __init__(self, rate: float, burst: int, sample: float):
+        self.rate = rate
+        self.burst = burst
+        self.sample = sample
+        self.tokens = float(burst)
+        self.updated = time.monotonic()
+        self.dropped = 0
+
+    def allow(self) -> bool:
+        if self.sample < 1 and random.random() >= self.sample:
+            self.dropped += 1
+            return False
+        if self.rate > 0:
+            now = time.monotonic()
+            self.tokens = min(
+                self.burst, self.tokens + (now - self.updated) * self.rate
+            )
+            self.updated = now
+            if self.tokens < 1:
+                self.dropped += 1
+                return False
+            self.tokens -= 1
+        return True
+
+
+class RateLimitFilter(logging.Filter):
+    """
+    ロガーごとにトークンバケットでの流量制限とサンプリングを行います
+    設定はロガー名の前方一致で最も長いものが使われ、WARNINGより上は常に通します
+    捨てた件数は次に通したレコードのdroppedに記録します
+    """
+
+    def __init__(
+        self,
+        rate_limits: dict[str, tuple[float, int]] | None = None,
+        sampling: dict[str, float] | None = None,
+    ):
+        super().__init__()
+        self.rate_limits = rate_limits or {}
+        self.sampling = sampling or {}
+        self._buckets: dict[str, _Bucket | None] = {}
+        self._lock = threading.Lock()
+
+    def _lookup(self, name: str, table: dict):
+        while True:
+            if name in table:
+                return table[name]
+            if "." not in name:
+                return table.get("")
+            name = name.rsplit(".", 1)[0]
+
+    def _bucket(self, name: str) -> _Bucket | None:
+        try:
+            return self._buckets[name]
+        except KeyError:
+            pass
+        rate, burst = self._lookup(name, self.rate_limits) or (0, 0)
+        sample = self._lookup(name, self.sampling)
+        bucket = None
+        if rate > 0 or sample is not None:
+            bucket = _Bucket(rate, burst, 1.0 if sample is None else sample)
+        self._buckets[name] = bucket
+        return bucket
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        if record.levelno > logging.WARNING:
+            return True
+        with self._lock:
+            bucket = self._bucket(record.name)
+            if bucket is None:
+                return True
+            if not bucket.allow():
+                return False
+            record.dropped, bucket.dropped = bucket.dropped, 0
+        return True
+
+
+class _QueueHandler(logging.handlers.QueueHandler):
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        # 標準のprepareはここでトレースバックまで整形してしまうので、
+        # 整形はバックグラウンドスレッドのハンドラに任せる
+        return record
+
+
+def setup_logging(
+    level: int = logging.INFO,
+    rate_limits: dict[str, tuple[float, int]] | None = None,
+    sampling: dict[str, float] | None = None,
+    stream=None,
+) -> logging.handlers.QueueListener:
+    """
+    ルートロガーをキュー経由にし、出力はバックグラウンドスレッドで行います
+    戻り値のQueueListenerは終了時にstopして、残りのログを書き出してください
+    """
+
+    log_queue: queue.SimpleQueue = queue.SimpleQueue()
+    output = logging.StreamHandler(stream or sys.stderr)
+    output.setFormatter(JsonFormatter())
+    listener = logging.handlers.QueueListener(
+        log_queue, output, respect_handler_level=True
+    )
+
+    handler = _QueueHandler(log_queue)
+    handler.addFilter(RateLimitFilter(rate_limits, sampling))
+    root = logging.getLogger()
+    for old in root.handlers[:]:
+        root.removeHandler(old)
+    root.addHandler(handler)
+    root.setLevel(level)
+
+    listener.start()
+    return listener
+
+
+def setup_logging_from_env(environ) -> logging.handlers.QueueListener:
+    """
+    LOG_LEVEL, LOG_RATE_LIMIT ("logger=件数/秒:バースト,..."),
+    LOG_SAMPLE_RATE ("logger=割合,...") からsetup_loggingします
+    """
+
+    rate_limits = {"database.slow_query": (5.0, 20), "bot.lag": (1.0, 10)}
+    for name, limit in parse_limits(environ.get("LOG_RATE_LIMIT")).items():
+        rate, _, burst = limit.partition(":")
+        rate_limits[name] = (float(rate), int(burst or max(float(rate), 1)))
+    sampling = {
+        name: float(rate)
+        for name, rate in parse_limits(environ.get("LOG_SAMPLE_RATE")).items()
+    }
+    name = environ.get("LOG_LEVEL", "INFO").upper()
+    level = logging.getLevelNamesMapping().get(name)
+    listener = setup_logging(
+        logging.INFO if level is None else level, rate_limits, sampling
+    )
+    if level is None:
+        # ログの出力先ができてから警告する
+        logging.getLogger("bot").warning(f"Unknown LOG_LEVEL {name}, using INFO")
+    return listener
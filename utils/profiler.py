@@ -0,0 +1,210 @@
+import asyncio
+import collections
+import inspect
+import logging
+import os
+import sys
+import threading
+import time
+import traceback
+from dataclasses import dataclass, field
+from types import FrameType
+
+PROJECT_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def frame_label(frame: FrameType) -> str:
+    code = frame.f_code
+    filename = code.co_filename
+    if filename.startswith(PROJECT_ROOT):
+        filename = os.path.relpath(filename, PROJECT_ROOT)
+    else:
+        filename = os.path.basename(filename)
+    # 行番号は関数の先頭にして、同じ関数のサンプルを1つにまとめる
+    return f"{getattr(code, 'co_qualname', code.co_name)} ({filename}:{code.co_firstlineno})"
+
+
+def collapse_stack(frame: FrameType | None) -> str:
+    """
+    フレームを根元から順に;で繋いだ文字列 (collapsed stack) にします
+    """
+
+    labels = []
+    while frame is not None:
+        labels.append(frame_label(frame))
+        frame = frame.f_back
+    return ";".join(reversed(labels))
+
+
+def coroutine_chain(coro) -> list[str]:
+    """
+    コルーチンがawaitしている先を辿って、実行中のハンドラ名を並べます
+    """
+
+    names = []
+    while coro is not None and len(names) < 32:
+        name = getattr(coro, "__qualname__", None)
+        if name is not None:
+            names.append(name)
+        coro = getattr(coro, "cr_await", None) or getattr(coro, "gi_yieldfrom", None)
+    return names
+
+
+def running_handlers(
+    loop: asyncio.AbstractEventLoop, frame: FrameType | None
+) -> list[str]:
+    """
+    ループのスレッドで実行中のコルーチンを根元から順に並べます
+    """
+
+    names = []
+    while frame is not None:
+        if frame.f_code.co_flags & inspect.CO_COROUTINE:
+            names.append(getattr(frame.f_code, "co_qualname", frame.f_code.co_name))
+        frame = frame.f_back
+    if names:
+        return list(reversed(names))
+
+    # コールバックの実行中などコルーチンの外で止まっている時は、現在のタスクから辿る
+    # 別スレッドから読むのでasyncio.current_taskは使えない
+    task = asyncio.tasks._current_tasks.get(loop)
+    if task is None:
+        return []
+    return coroutine_chain(task.get_coro())
+
+
+class SamplingProfiler:
+    """
+    別スレッドから対象スレッドのスタックを一定間隔で取得します
+    結果はflamegraph.plやspeedscopeで読めるcollapsed stack形式で返します
+    """
+
+    def __init__(self, thread_id: int, interval: float = 0.005):
+        self.thread_id = thread_id
+        self.interval = interval
+        self.samples: collections.Counter[str] = collections.Counter()
+        self.sample_count = 0
+
+    def run(self, duration: float) -> str:
+        deadline = time.monotonic() + duration
+        while time.monotonic() < deadline:
+            frame = sys._current_frames().get(self.thread_id)
+            if frame is not None:
+                self.samples[collapse_stack(frame)] += 1
+                self.sample_count += 1
+            del frame
+            time.sleep(self.interval)
+        return self.collapsed()
+
+    def collapsed(self) -> str:
+        return "".join(
+            f"{stack} {count}\n" for stack, count in self.samples.most_common()
+        )
+
+
+def dump_tasks(loop: asyncio.AbstractEventLoop) -> str:
+    """
+    実行中の全タスクと、それぞれがawaitしている場所を書き出します
+    """
+
+    tasks = sorted(asyncio.all_tasks(loop), key=lambda t: t.get_name())
+    lines = [f"{len(tasks)} tasks"]
+    for task in tasks:
+        coro = task.get_coro()
+        lines.append("")
+        lines.append(
+            f"{task.get_name()}: {' > '.join(coroutine_chain(coro)) or repr(coro)}"
+        )
+        for frame in task.get_stack():
+            summary = traceback.extract_stack(frame, limit=1)[-1]
+            lines.append(f"  {summary.filename}:{summary.lineno} in {summary.name}")
+    return "\n".join(lines) + "\n"
+
+
+@dataclass
+class LagSpike:
+    # UNIX時間
+    timestamp: float
+    lag: float
+    handlers: list[str] = field(default_factory=list)
+    stack: str = ""
+
+
+class LoopLagMonitor:
+    """
+    イベントループの遅延を常時計測し、閾値を超えた時に実行中のハンドラを記録します
+    ループが止まっている間に監視スレッドがスタックを取るので、原因の処理まで分かります
+    """
+
+    def __init__(
+        self, interval: float = 0.1, threshold: float = 0.25, history: int = 100
+    ):
+        self.interval = interval
+        self.threshold = threshold
+        self.spikes: collections.deque[LagSpike] = collections.deque(maxlen=history)
+        self.max_lag = 0.0
+        self.logger = logging.getLogger("bot.lag")
+        self._loop: asyncio.AbstractEventLoop | None = None
+        self._thread_id = 0
+        self._beat = 0.0
+        # 監視スレッドが取得した、ループが止まっている最中の状態
+        self._captured: LagSpike | None = None
+        self._task: asyncio.Task | None = None
+        self._stop = threading.Event()
+        self._watcher: threading.Thread | None = None
+
+    def start(self) -> None:
+        self._loop = asyncio.get_running_loop()
+        self._thread_id = threading.get_ident()
+        self._beat = time.monotonic()
+        self._stop.clear()
+        self._task = asyncio.create_task(self._heartbeat(), name="loop-lag-monitor")
+        self._watcher = threading.Thread(
+            target=self._watch, name="loop-lag-watcher", daemon=True
+        )
+        self._watcher.start()
+
+    def stop(self) -> None:
+        self._stop.set()
+        if self._task is not None:
+            self._task.cancel()
+            self._task = None
+
+    async def _heartbeat(self) -> None:
+        while True:
+            self._beat = time.monotonic()
+            await asyncio.sleep(self.interval)
+            lag = time.monotonic() - self._beat - self.interval
+            self.max_lag = max(self.max_lag, lag)
+            captured, self._captured = self._captured, None
+            if lag < self.threshold:
+                continue
+            spike = captured or LagSpike(time.time(), lag)
+            spike.lag = lag
+            self.spikes.append(spike)
+            self.logger.warning(
+                f"Event loop blocked for {lag * 1000:.0f}ms "
+                f"({' > '.join(spike.handlers) or 'unknown'})"
+            )
+
+    def _watch(self) -> None:
+        while not self._stop.wait(self.interval):
+            if self._captured is not None:
+                continue
+            if time.monotonic() - self._beat < self.interval + self.threshold:
+                continue
+            frame = sys._current_frames().get(self._thread_id)
+            self._captured = LagSpike(
+                time.time(),
+                0.0,
+                running_handlers(self._loop, frame),
+                collapse_stack(frame),
+            )
+            del frame
+
+    def stats(self) -> dict[str, float]:
+        return {
+            "spikes": len(self.spikes),
+            "max_lag_ms": self.max_lag * 1000,
+            "threshold_ms": self.threshold * 1000,
+        }
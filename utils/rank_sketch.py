@@ -0,0 +1,95 @@
+import collections
+import math
+
+
+class RankSketch:
+    """
+    合計EXPの分布を対数スケールのバケットで数えるスケッチ (DDSketchと同じバケットの切り方)
+    同じバケットに入る値の差は相対誤差relative_accuracy以内で、
+    バケットの数は最大値と精度だけで決まるのでメンバー数によらずメモリは一定です
+    バケットごとの人数はFenwick木で持つので、追加・削除・順位の問い合わせはO(log バケット数)です
+    """
+
+    def __init__(self, relative_accuracy: float = 0.01, max_value: int = 2**40):
+        self.relative_accuracy = relative_accuracy
+        gamma = (1 + relative_accuracy) / (1 - relative_accuracy)
+        self._log_gamma = math.log(gamma)
+        # バケット0は0以下の値
+        self.size = self._index(max_value) + 1
+        self.counts = [0] * self.size
+        self._tree = [0] * (self.size + 1)
+        self.total = 0
+
+    @classmethod
+    def from_counts(
+        cls, relative_accuracy: float, counts: list[int] | tuple[int, ...]
+    ) -> "RankSketch":
+        """
+        countsで書き出したバケットごとの人数からスケッチを復元します
+        """
+
+        sketch = cls(relative_accuracy)
+        if len(counts) != sketch.size:
+            raise ValueError("Bucket count mismatch")
+        for index, count in enumerate(counts):
+            if count:
+                sketch._update(index, count)
+        return sketch
+
+    def _index(self, value: int) -> int:
+        if value <= 0:
+            return 0
+        return math.ceil(math.log(value) / self._log_gamma) + 1
+
+    def bucket(self, value: int) -> int:
+        return min(self._index(value), self.size - 1)
+
+    def _update(self, index: int, delta: int) -> None:
+        self.counts[index] += delta
+        self.total += delta
+        i = index + 1
+        while i <= self.size:
+            self._tree[i] += delta
+            i += i & -i
+
+    def _prefix(self, index: int) -> int:
+        # バケット0からindexまでの人数
+        result = 0
+        i = index + 1
+        while i > 0:
+            result += self._tree[i]
+            i -= i & -i
+        return result
+
+    def add(self, value: int, count: int = 1) -> None:
+        self._update(self.bucket(value), count)
+
+    def add_many(self, values: list[int]) -> None:
+        # バケットごとにまとめてから木を更新する
+        counts = collections.Counter(map(self.bucket, values))
+        for index, count in counts.items():
+            self._update(index, count)
+
+    def remove(self, value: int, count: int = 1) -> None:
+        self._update(self.bucket(value), -count)
+
+    def move(self, old: int, new: int) -> None:
+        """
+        1人の合計EXPがoldからnewに変わったことを反映します
+        """
+
+        old_index, new_index = self.bucket(old), self.bucket(new)
+        if old_index != new_index:
+            self._update(old_index, -1)
+            self._update(new_index, 1)
+
+    def rank(self, value: int) -> tuple[int, int]:
+        """
+        valueより確実に上にいる人数と、valueと同じバケットにいる人数を返します
+        順位はabove + 1からabove + sameの間になります
+        """
+
+        index = self.bucket(value)
+        above = max(self.total - self._prefix(index), 0)
+        same = max(self.counts[index], 1)
+        return above, same
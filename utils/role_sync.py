@@ -0,0 +1,294 @@
+import asyncio
+import json
+import logging
+import os
+from dataclasses import dataclass, field
+from typing import TYPE_CHECKING
+
+import discord
+
+from utils.util import get_level
+
+if TYPE_CHECKING:
+    from main import DiscordLevelBot
+
+# ユーザーIDの上限 (最後の区間の終端)
+MAX_USER_ID = 2**64 - 1
+
+
+def desired_level_roles(
+    level_roles: list[tuple[int, int]], stack_level_roles: bool, level: int
+) -> set[int]:
+    """
+    そのレベルのメンバーが持つべきレベルロールを返します
+    複数保持しない場合は、到達した中で最も高いレベルのロールだけを持ちます
+    """
+
+    reached = [
+        (role_id, role_level)
+        for role_id, role_level in level_roles
+        if role_level <= level
+    ]
+    if stack_level_roles or not reached:
+        return {role_id for role_id, _ in reached}
+    top = max(role_level for _, role_level in reached)
+    return {role_id for role_id, role_level in reached if role_level == top}
+
+
+@dataclass
+class RoleConfig:
+    level_roles: list[tuple[int, int]]
+    stack_level_roles: bool
+
+    def to_json(self) -> list:
+        return [self.stack_level_roles, [list(r) for r in self.level_roles]]
+
+    @classmethod
+    def from_json(cls, value: list) -> "RoleConfig":
+        return cls([tuple(r) for r in value[1]], bool(value[0]))
+
+
+@dataclass
+class RoleSyncJob:
+    """
+    ギルドのレベルロールの反映状況
+
+    baselineは「メンバーが今持っているはずの設定」をユーザーIDの区間ごとに持ちます
+    反映の途中で設定が変わると、処理済みの区間は前回の目標、未処理の区間は元の設定になるためです
+    """
+
+    guild_id: int
+    # (区間の終端のユーザーID, 設定) のリスト、終端の昇順
+    baseline: list[tuple[int, RoleConfig]]
+    target: RoleConfig
+    cursor: int = 0
+    total: int = 0
+    processed: int = 0
+    changed: int = 0
+    failed: int = 0
+    # retargetするたびに増え、処理中のチャンクが古い目標で進まないようにする
+    generation: int = 0
+    managed_role_ids: set[int] = field(default_factory=set)
+
+    def __post_init__(self):
+        self.managed_role_ids = {
+            role_id for _, config in self.baseline for role_id, _ in config.level_roles
+        } | {role_id for role_id, _ in self.target.level_roles}
+
+    def baseline_at(self, user_id: int) -> RoleConfig:
+        for upper, config in self.baseline:
+            if user_id <= upper:
+                return config
+        return self.baseline[-1][1]
+
+    def retarget(self, target: RoleConfig, total: int) -> None:
+        """
+        反映中に設定が変わった場合に、処理済みの区間を引き継いで最初からやり直します
+        """
+
+        self.baseline = [(self.cursor, self.target)] + [
+            (upper, config) for upper, config in self.baseline if upper > self.cursor
+        ]
+        self.target = target
+        self.cursor = 0
+        self.total = total
+        self.processed = 0
+        self.changed = 0
+        self.failed = 0
+        self.generation += 1
+        self.__post_init__()
+
+
+class LevelRoleReconciler:
+    """
+    レベルロールの設定変更を既存のメンバーに反映します
+    設定変更前後で持つべきロールが変わるメンバーだけにAPIを呼び、
+    進捗はユーザーIDのカーソルとしてDBに保存するので再起動後も続きから再開します
+    """
+
+    def __init__(self, bot: "DiscordLevelBot"):
+        self.bot = bot
+        self.logger = logging.getLogger("role_sync")
+        self.chunk_size = int(os.environ.get("ROLE_SYNC_CHUNK", 500))
+        # 1秒あたりのロール変更の上限
+        self.rate = float(os.environ.get("ROLE_SYNC_RATE", 5))
+        self.jobs: dict[int, RoleSyncJob] = {}
+        self._tasks: dict[int, asyncio.Task] = {}
+
+    async def resume(self) -> None:
+        """
+        前回終わらなかったジョブを再開します
+        """
+
+        for (
+            guild_id,
+            baseline,
+            target,
+            cursor,
+            total,
+            processed,
+            changed,
+            failed,
+        ) in await self.bot.db.get_role_sync_jobs():
+            if guild_id in self.jobs:
+                continue
+            self.jobs[guild_id] = RoleSyncJob(
+                guild_id,
+                [(upper, RoleConfig.from_json(c)) for upper, c in json.loads(baseline)],
+                RoleConfig.from_json(json.loads(target)),
+                cursor,
+                total,
+                processed,
+                changed,
+                failed,
+            )
+            self.start(guild_id)
+
+    async def schedule(
+        self,
+        guild_id: int,
+        previous: RoleConfig,
+        current: RoleConfig,
+    ) -> RoleSyncJob:
+        """
+        previousからcurrentへの設定変更を反映するジョブを開始します
+        """
+
+        total = await self.bot.db.count_guild_level_users(guild_id)
+        job = self.jobs.get(guild_id)
+        if job is None:
+            job = RoleSyncJob(guild_id, [(MAX_USER_ID, previous)], current, total=total)
+            self.jobs[guild_id] = job
+        else:
+            job.retarget(current, total)
+        await self.save(job)
+        self.start(guild_id)
+        return job
+
+    def start(self, guild_id: int) -> None:
+        task = self._tasks.get(guild_id)
+        if task is None or task.done():
+            self._tasks[guild_id] = asyncio.create_task(
+                self.run(guild_id), name=f"role-sync-{guild_id}"
+            )
+
+    def stop(self) -> None:
+        for task in self._tasks.values():
+            task.cancel()
+        self._tasks.clear()
+
+    async def save(self, job: RoleSyncJob) -> None:
+        await self.bot.db.save_role_sync_job(
+            job.guild_id,
+            json.dumps([[upper, config.to_json()] for upper, config in job.baseline]),
+            json.dumps(job.target.to_json()),
+            job.cursor,
+            job.total,
+            job.processed,
+            job.changed,
+            job.failed,
+        )
+
+    async def run(self, guild_id: int) -> None:
+        # キャッシュされたメンバーのロールと比べるため、ギルドの読み込みを待つ
+        await self.bot.wait_until_ready()
+        try:
+            while True:
+                job = self.jobs[guild_id]
+                generation = job.generation
+                done = await self.run_chunk(job)
+                if job.generation != generation:
+                    # 途中で設定が変わったので最初からやり直す
+                    continue
+                if done:
+                    await self.bot.db.delete_role_sync_job(guild_id)
+                    del self.jobs[guild_id]
+                    self.logger.info(
+                        f"Level roles of guild {guild_id} reconciled "
+                        f"({job.changed} changed, {job.failed} failed)"
+                    )
+                    return
+                await self.save(job)
+                self.logger.info(
+                    f"Reconciling level roles of guild {guild_id}: "
+                    f"{job.processed}/{job.total} ({job.changed} changed, {job.failed} failed)"
+                )
+        except asyncio.CancelledError:
+            raise
+        except Exception:
+            # 進捗は保存済みなので、次回の起動時か設定変更時に続きから再開する
+            self.logger.exception(
+                f"Failed to reconcile level roles of guild {guild_id}"
+            )
+
+    async def run_chunk(self, job: RoleSyncJob) -> bool:
+        """
+        カーソルの次からchunk_size人分を処理し、全員終わったらTrueを返します
+        """
+
+        generation = job.generation
+        rows = await self.bot.db.get_user_level_totals_after(
+            job.guild_id, job.cursor, self.chunk_size
+        )
+        if job.generation != generation:
+            return False
+        if not rows:
+            return True
+
+        guild = self.bot.get_guild(job.guild_id)
+        for user_id, total in rows:
+            level = get_level(total)
+            baseline = job.baseline_at(user_id)
+            desired = desired_level_roles(
+                job.target.level_roles, job.target.stack_level_roles, level
+            )
+            member = guild.get_member(user_id) if guild is not None else None
+            if member is not None:
+                # キャッシュにいるメンバーは実際のロールと比べる
+                current = set(member._roles) & job.managed_role_ids
+            else:
+                current = desired_level_roles(
+                    baseline.level_roles, baseline.stack_level_roles, level
+                )
+
+            for role_id in desired - current:
+                await self.apply(job, user_id, role_id, add=True)
+            for role_id in current - desired:
+                await self.apply(job, user_id, role_id, add=False)
+            if job.generation != generation:
+                return False
+            job.cursor = user_id
+            job.processed += 1
+        return len(rows) < self.chunk_size
+
+    async def apply(
+        self, job: RoleSyncJob, user_id: int, role_id: int, add: bool
+    ) -> None:
+        reason = "Level role settings changed"
+        try:
+            if add:
+                await self.bot.http.add_role(
+                    job.guild_id, user_id, role_id, reason=reason
+                )
+            else:
+                await self.bot.http.remove_role(
+                    job.guild_id, user_id, role_id, reason=reason
+                )
+            job.changed += 1
+        except discord.NotFound:
+            # 退出したメンバーや削除されたロール
+            job.failed += 1
+        except discord.Forbidden:
+            job.failed += 1
+            self.logger.warning(
+                f"Missing permissions to update role {role_id} in guild {job.guild_id}"
+            )
+        except discord.HTTPException as e:
+            # 5xxやレートリミットはHTTPClientが再試行済みなので、このメンバーは諦めて次へ進む
+            job.failed += 1
+            self.logger.warning(
+                f"Failed to update role {role_id} of user {user_id} in guild {job.guild_id}: {e}"
+            )
+        # HTTPClientのレートリミット処理に加えて、他の処理の枠を使い切らないよう間隔を空ける
+        if self.rate > 0:
+            await asyncio.sleep(1 / self.rate)
@@ -0,0 +1,444 @@
+import asyncio
+import contextlib
+import itertools
+import json
+import logging
+import os
+import sys
+import time
+from abc import ABC, abstractmethod
+from collections import deque
+from typing import Any, AsyncIterator, Awaitable, Callable
+
+Subscriber = Callable[[str], Awaitable[None] | None]
+
+
+class SharedState(ABC):
+    """
+    複数のプロセス/シャード間で共有する状態のインターフェース
+    キーごとのロック、TTL付きカウンター、キャッシュ無効化用のPub/Subを提供します
+    """
+
+    def __init__(self):
+        self.logger = logging.getLogger("shared_state")
+        self._subscribers: dict[str, list[Subscriber]] = {}
+
+    async def connect(self) -> None:
+        pass
+
+    async def close(self) -> None:
+        pass
+
+    @abstractmethod
+    def lock(self, key: str) -> contextlib.AbstractAsyncContextManager[None]:
+        """
+        キーごとの排他ロックを取得します
+        """
+
+    @abstractmethod
+    async def incr(self, key: str, amount: int = 1, ttl: float | None = None) -> int:
+        """
+        カウンターを加算して加算後の値を返します
+        ttlはカウンターが作成された時点から数えます
+        """
+
+    @abstractmethod
+    async def get(self, key: str) -> int:
+        """
+        カウンターの値を返します
+        """
+
+    @abstractmethod
+    async def publish(self, channel: str, message: str) -> None:
+        """
+        チャンネルの購読者全員にメッセージを送ります
+        """
+
+    def subscribe(self, channel: str, callback: Subscriber) -> None:
+        self._subscribers.setdefault(channel, []).append(callback)
+
+    def unsubscribe(self, channel: str, callback: Subscriber) -> None:
+        callbacks = self._subscribers.get(channel, [])
+        if callback in callbacks:
+            callbacks.remove(callback)
+
+    async def _dispatch(self, channel: str, message: str) -> None:
+        for callback in list(self._subscribers.get(channel, [])):
+            try:
+                result = callback(message)
+                if asyncio.iscoroutine(result):
+                    await result
+            except Exception:
+                self.logger.exception(f"Subscriber of {channel} failed")
+
+
+class _Counters:
+    """
+    TTL付きカウンター (期限切れのキーは参照時と定期的な掃除で削除)
+    """
+
+    def __init__(self):
+        self._values: dict[str, tuple[int, float | None]] = {}
+        self._ops = 0
+
+    def incr(self, key: str, amount: int, ttl: float | None) -> int:
+        now = time.monotonic()
+        self._ops += 1
+        if self._ops % 1024 == 0:
+            self.purge(now)
+        value, expires_at = self._values.get(key, (0, None))
+        if expires_at is not None and expires_at <= now:
+            value, expires_at = 0, None
+        if value == 0 and expires_at is None and ttl is not None:
+            expires_at = now + ttl
+        value += amount
+        self._values[key] = (value, expires_at)
+        return value
+
+    def get(self, key: str) -> int:
+        value, expires_at = self._values.get(key, (0, None))
+        if expires_at is not None and expires_at <= time.monotonic():
+            del self._values[key]
+            return 0
+        return value
+
+    def purge(self, now: float) -> None:
+        for key in [
+            key
+            for key, (_, expires_at) in self._values.items()
+            if expires_at is not None and expires_at <= now
+        ]:
+            del self._values[key]
+
+
+class _LockEntry:
+    __slots__ = ("lock", "users")
+
+    def __init__(self):
+        self.lock = asyncio.Lock()
+        # ロックを保持中または待機中のタスクの数
+        self.users = 0
+
+
+class _KeyedLocks:
+    """
+    キーごとのasyncio.Lockを参照カウント付きで管理します
+    保持中・待機中のタスクがいなくなったキーは削除するので、
+    これまでに見たキーの数ではなく同時に使われているキーの数しかメモリを使いません
+    """
+
+    def __init__(self):
+        self._entries: dict[str, _LockEntry] = {}
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    @contextlib.asynccontextmanager
+    async def hold(self, key: str) -> AsyncIterator[None]:
+        entry = self._entries.get(key)
+        if entry is None:
+            self._entries[key] = entry = _LockEntry()
+        entry.users += 1
+        try:
+            async with entry.lock:
+                yield
+        finally:
+            # 待機中にキャンセルされた場合もここで数を戻す
+            entry.users -= 1
+            if entry.users == 0:
+                del self._entries[key]
+
+
+class InProcessSharedState(SharedState):
+    """
+    1プロセスで動かす場合のバックエンド
+    """
+
+    def __init__(self):
+        super().__init__()
+        self._locks = _KeyedLocks()
+        self._counters = _Counters()
+
+    def lock(self, key: str) -> contextlib.AbstractAsyncContextManager[None]:
+        return self._locks.hold(key)
+
+    async def incr(self, key: str, amount: int = 1, ttl: float | None = None) -> int:
+        return self._counters.incr(key, amount, ttl)
+
+    async def get(self, key: str) -> int:
+        return self._counters.get(key)
+
+    async def publish(self, channel: str, message: str) -> None:
+        await self._dispatch(channel, message)
+
+
+class UnixSocketSharedState(SharedState):
+    """
+    SharedStateServerにUnixソケットで接続するバックエンド
+    Redisの代わりに、同じマシン上の複数プロセスで状態を共有します
+    切断されると処理中のリクエストは失敗させ、再接続するまでのリクエストはすぐにConnectionErrorになります
+    """
+
+    def __init__(self, path: str):
+        super().__init__()
+        self.path = path
+        # 応答を待つ秒数 (サーバーが応答しなくなってもXPの処理を止めない)
+        self.timeout = float(os.environ.get("SHARED_STATE_TIMEOUT", 10))
+        # 再接続の間隔の上限 (秒)
+        self.max_backoff = float(os.environ.get("SHARED_STATE_MAX_BACKOFF", 30))
+        self._writer: asyncio.StreamWriter | None = None
+        self._read_task: asyncio.Task | None = None
+        self._reconnect_task: asyncio.Task | None = None
+        self._closed = False
+        self._ids = itertools.count(1)
+        self._waiters: dict[int, asyncio.Future] = {}
+
+    async def connect(self) -> None:
+        self._closed = False
+        reader, self._writer = await asyncio.open_unix_connection(self.path)
+        self._read_task = asyncio.create_task(self._read_loop(reader, self._writer))
+        for channel in self._subscribers:
+            self._write({"op": "subscribe", "channel": channel})
+        self.logger.info(f"Connected to shared state server {self.path}")
+
+    async def close(self) -> None:
+        self._closed = True
+        if self._reconnect_task is not None:
+            self._reconnect_task.cancel()
+            self._reconnect_task = None
+        if self._read_task is not None:
+            self._read_task.cancel()
+            self._read_task = None
+        writer, self._writer = self._writer, None
+        if writer is None:
+            return
+        writer.close()
+        with contextlib.suppress(Exception):
+            await writer.wait_closed()
+
+    async def _reconnect(self) -> None:
+        delay = 0.5
+        while not self._closed:
+            await asyncio.sleep(delay)
+            try:
+                await self.connect()
+                return
+            except OSError as e:
+                self.logger.warning(
+                    f"Failed to reconnect to shared state server {self.path}: {e}"
+                )
+                delay = min(delay * 2, self.max_backoff)
+
+    def _write(self, payload: dict[str, Any]) -> None:
+        if self._writer is None:
+            raise ConnectionError("Shared state server is not connected")
+        self._writer.write(json.dumps(payload).encode() + b"\n")
+
+    def _request(self, payload: dict[str, Any]) -> asyncio.Future:
+        request_id = next(self._ids)
+        self._write({"id": request_id, **payload})
+        future = asyncio.get_running_loop().create_future()
+        self._waiters[request_id] = future
+        # タイムアウトやキャンセルで応答を待たなくなったリクエストも削除する
+        future.add_done_callback(lambda _: self._waiters.pop(request_id, None))
+        return future
+
+    async def _call(self, payload: dict[str, Any]) -> Any:
+        return await asyncio.wait_for(self._request(payload), self.timeout)
+
+    async def _read_loop(
+        self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter
+    ) -> None:
+        try:
+            while line := await reader.readline():
+                payload = json.loads(line)
+                if "event" in payload:
+                    await self._dispatch(payload["channel"], payload["message"])
+                    continue
+                future = self._waiters.pop(payload["id"], None)
+                if future is None or future.done():
+                    continue
+                if "error" in payload:
+                    future.set_exception(RuntimeError(payload["error"]))
+                else:
+                    future.set_result(payload.get("result"))
+        except (ConnectionError, json.JSONDecodeError):
+            pass
+        finally:
+            # 以降の_writeがすぐに失敗するよう、切断された接続は使わない
+            if self._writer is writer:
+                self._writer = None
+            writer.close()
+            error = ConnectionError("Shared state server disconnected")
+            for future in list(self._waiters.values()):
+                if not future.done():
+                    future.set_exception(error)
+            self._waiters.clear()
+        if not self._closed:
+            self.logger.warning(f"Disconnected from shared state server {self.path}")
+            self._reconnect_task = asyncio.create_task(self._reconnect())
+
+    @contextlib.asynccontextmanager
+    async def lock(self, key: str) -> AsyncIterator[None]:
+        future = self._request({"op": "lock", "key": key})
+        try:
+            token = await asyncio.wait_for(asyncio.shield(future), self.timeout)
+        except (asyncio.CancelledError, TimeoutError):
+            # 待機中にキャンセルされたりタイムアウトしても、後からロックが渡されたら解放する
+            def release(f: asyncio.Future) -> None:
+                if f.cancelled() or f.exception() is not None:
+                    return
+                with contextlib.suppress(ConnectionError):
+                    self._write({"op": "unlock", "key": key, "token": f.result()})
+
+            future.add_done_callback(release)
+            raise
+        try:
+            yield
+        finally:
+            # 解放は応答を待たない (同じ接続内の順序はサーバー側で保たれる)
+            # 切断された場合はサーバーがその接続のロックを解放済み
+            with contextlib.suppress(ConnectionError):
+                self._write({"op": "unlock", "key": key, "token": token})
+
+    async def incr(self, key: str, amount: int = 1, ttl: float | None = None) -> int:
+        return await self._call(
+            {"op": "incr", "key": key, "amount": amount, "ttl": ttl}
+        )
+
+    async def get(self, key: str) -> int:
+        return await self._call({"op": "get", "key": key})
+
+    async def publish(self, channel: str, message: str) -> None:
+        await self._call({"op": "publish", "channel": channel, "message": message})
+
+    def subscribe(self, channel: str, callback: Subscriber) -> None:
+        new_channel = channel not in self._subscribers
+        super().subscribe(channel, callback)
+        if new_channel and self._writer is not None:
+            self._write({"op": "subscribe", "channel": channel})
+
+
+class SharedStateServer:
+    """
+    UnixSocketSharedStateの接続先になるスタンドアロンサーバー
+    python -m utils.shared_state <socket path> で起動します
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        self.logger = logging.getLogger("shared_state.server")
+        self._server: asyncio.AbstractServer | None = None
+        self._counters = _Counters()
+        self._tokens = itertools.count(1)
+        # key -> (保持している接続, トークン)
+        self._owners: dict[str, tuple[asyncio.StreamWriter, int]] = {}
+        # key -> ロック待ちの (接続, リクエストID)
+        self._lock_waiters: dict[str, deque[tuple[asyncio.StreamWriter, int]]] = {}
+        self._channels: dict[str, set[asyncio.StreamWriter]] = {}
+
+    async def start(self) -> None:
+        with contextlib.suppress(FileNotFoundError):
+            os.remove(self.path)
+        self._server = await asyncio.start_unix_server(self._handle, path=self.path)
+        self.logger.info(f"Listening on {self.path}")
+
+    async def serve_forever(self) -> None:
+        await self.start()
+        async with self._server:
+            await self._server.serve_forever()
+
+    async def close(self) -> None:
+        if self._server is not None:
+            self._server.close()
+            await self._server.wait_closed()
+
+    @staticmethod
+    def _send(writer: asyncio.StreamWriter, payload: dict[str, Any]) -> None:
+        if not writer.is_closing():
+            writer.write(json.dumps(payload).encode() + b"\n")
+
+    def _grant(self, key: str) -> None:
+        waiters = self._lock_waiters.get(key)
+        while waiters:
+            writer, request_id = waiters.popleft()
+            if writer.is_closing():
+                continue
+            token = next(self._tokens)
+            self._owners[key] = (writer, token)
+            self._send(writer, {"id": request_id, "result": token})
+            return
+        self._lock_waiters.pop(key, None)
+        self._owners.pop(key, None)
+
+    def _release(self, key: str, writer: asyncio.StreamWriter, token: int) -> None:
+        owner = self._owners.get(key)
+        if owner is None or owner != (writer, token):
+            return
+        self._grant(key)
+
+    async def _handle(
+        self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter
+    ) -> None:
+        try:
+            while line := await reader.readline():
+                request = json.loads(line)
+                op = request.get("op")
+                request_id = request.get("id")
+                if op == "lock":
+                    key = request["key"]
+                    self._lock_waiters.setdefault(key, deque()).append(
+                        (writer, request_id)
+                    )
+                    if key not in self._owners:
+                        self._grant(key)
+                elif op == "unlock":
+                    self._release(request["key"], writer, request["token"])
+                elif op == "incr":
+                    value = self._counters.incr(
+                        request["key"], request.get("amount", 1), request.get("ttl")
+                    )
+                    self._send(writer, {"id": request_id, "result": value})
+                elif op == "get":
+                    value = self._counters.get(request["key"])
+                    self._send(writer, {"id": request_id, "result": value})
+                elif op == "subscribe":
+                    self._channels.setdefault(request["channel"], set()).add(writer)
+                elif op == "publish":
+                    event = {
+                        "event": "message",
+                        "channel": request["channel"],
+                        "message": request["message"],
+                    }
+                    for subscriber in self._channels.get(request["channel"], ()):
+                        self._send(subscriber, event)
+                    self._send(writer, {"id": request_id, "result": None})
+                else:
+                    self._send(writer, {"id": request_id, "error": f"unknown op {op}"})
+        except (ConnectionError, json.JSONDecodeError):
+            pass
+        finally:
+            # 切断された接続が保持していたロックと購読を解放する
+            for key, (owner, token) in list(self._owners.items()):
+                if owner is writer:
+                    self._release(key, writer, token)
+            for subscribers in self._channels.values():
+                subscribers.discard(writer)
+            writer.close()
+
+
+def create_shared_state() -> SharedState:
+    """
+    環境変数SHARED_STATE_SOCKETが設定されていればUnixソケットのバックエンドを、
+    設定されていなければプロセス内のバックエンドを返します
+    """
+
+    path = os.environ.get("SHARED_STATE_SOCKET")
+    if path:
+        return UnixSocketSharedState(path)
+    return InProcessSharedState()
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO)
+    asyncio.run(SharedStateServer(sys.argv[1]).serve_forever())
@@ -0,0 +1,178 @@
+import logging
+import mmap
+import os
+import struct
+from typing import Any
+
+from utils.rank_sketch import RankSketch
+
+MAGIC = b"DLBS"
+VERSION = 2
+# magic, version, journal_seq, guild_settings数, level_roles数, totals数, rank_modes数, rank_sketches数
+HEADER = struct.Struct("<4sHQIIIII")
+# guild_id, min_exp, max_exp, stack_level_roles
+GUILD_SETTING = struct.Struct("<QII?")
+# guild_id, role_id, level
+LEVEL_ROLE = struct.Struct("<QQI")
+# guild_id, user_id, total_exp
+TOTAL = struct.Struct("<QQQ")
+# guild_id, 概算順位モードが有効か, exact_top
+RANK_MODE = struct.Struct("<Q?I")
+# guild_id, relative_accuracy, 作成した時刻, バケット数 (この後にバケットごとの人数がint64で続く)
+RANK_SKETCH = struct.Struct("<QddI")
+
+logger = logging.getLogger("snapshot")
+
+
+def write_snapshot(path: str, journal_seq: int, state: dict[str, Any]) -> None:
+    """
+    ギルド設定やユーザーの合計EXPなどのキャッシュをバイナリ形式で書き出します
+    """
+
+    guild_settings = state.get("guild_settings", {})
+    level_roles = [
+        (guild_id, role_id, level)
+        for guild_id, roles in state.get("level_roles", {}).items()
+        for role_id, level in roles
+    ]
+    totals = state.get("totals", {})
+    rank_modes = state.get("rank_modes", {})
+    rank_sketches = state.get("rank_sketches", {})
+
+    os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, "wb") as f:
+        f.write(
+            HEADER.pack(
+                MAGIC,
+                VERSION,
+                journal_seq,
+                len(guild_settings),
+                len(level_roles),
+                len(totals),
+                len(rank_modes),
+                len(rank_sketches),
+            )
+        )
+        for guild_id, (min_exp, max_exp, stack_level_roles) in guild_settings.items():
+            f.write(
+                GUILD_SETTING.pack(guild_id, min_exp, max_exp, bool(stack_level_roles))
+            )
+        for row in level_roles:
+            f.write(LEVEL_ROLE.pack(*row))
+        for (guild_id, user_id), total in totals.items():
+            f.write(TOTAL.pack(guild_id, user_id, total))
+        for guild_id, exact_top in rank_modes.items():
+            f.write(RANK_MODE.pack(guild_id, exact_top is not None, exact_top or 0))
+        for guild_id, (built_at, sketch) in rank_sketches.items():
+            f.write(
+                RANK_SKETCH.pack(
+                    guild_id, sketch.relative_accuracy, built_at, len(sketch.counts)
+                )
+            )
+            f.write(struct.pack(f"<{len(sketch.counts)}q", *sketch.counts))
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_path, path)
+
+
+def load_snapshot(path: str) -> dict[str, Any] | None:
+    """
+    write_snapshotで書き出したスナップショットをメモリマップして読み込みます
+    存在しないか壊れている場合はNoneを返します
+    """
+
+    try:
+        with open(path, "rb") as f:
+            if os.fstat(f.fileno()).st_size < HEADER.size:
+                return None
+            with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+                return _parse(mm)
+    except FileNotFoundError:
+        return None
+    except (OSError, struct.error, ValueError):
+        logger.warning(f"Failed to load snapshot {path}, ignoring", exc_info=True)
+        return None
+
+
+def _parse(mm: mmap.mmap) -> dict[str, Any] | None:
+    (
+        magic,
+        version,
+        journal_seq,
+        n_settings,
+        n_roles,
+        n_totals,
+        n_rank_modes,
+        n_sketches,
+    ) = HEADER.unpack_from(mm, 0)
+    if magic != MAGIC or version != VERSION:
+        return None
+    offset = HEADER.size
+    expected = (
+        offset
+        + n_settings * GUILD_SETTING.size
+        + n_roles * LEVEL_ROLE.size
+        + n_totals * TOTAL.size
+        + n_rank_modes * RANK_MODE.size
+        + n_sketches * RANK_SKETCH.size
+    )
+    # スケッチのバケットは可変長なので、固定長の部分より短ければ壊れている
+    if len(mm) < expected:
+        raise ValueError("Snapshot size mismatch")
+
+    view = memoryview(mm)
+    try:
+        guild_settings = {}
+        end = offset + n_settings * GUILD_SETTING.size
+        for guild_id, min_exp, max_exp, stack in GUILD_SETTING.iter_unpack(
+            view[offset:end]
+        ):
+            guild_settings[guild_id] = (min_exp, max_exp, stack)
+        offset = end
+
+        level_roles: dict[int, list[tuple[int, int]]] = {}
+        end = offset + n_roles * LEVEL_ROLE.size
+        for guild_id, role_id, level in LEVEL_ROLE.iter_unpack(view[offset:end]):
+            level_roles.setdefault(guild_id, []).append((role_id, level))
+        offset = end
+
+        end = offset + n_totals * TOTAL.size
+        totals = {
+            (guild_id, user_id): total
+            for guild_id, user_id, total in TOTAL.iter_unpack(view[offset:end])
+        }
+        offset = end
+
+        end = offset + n_rank_modes * RANK_MODE.size
+        rank_modes = {
+            guild_id: exact_top if enabled else None
+            for guild_id, enabled, exact_top in RANK_MODE.iter_unpack(view[offset:end])
+        }
+        offset = end
+
+        rank_sketches = {}
+        for _ in range(n_sketches):
+            guild_id, accuracy, built_at, n_buckets = RANK_SKETCH.unpack_from(
+                view, offset
+            )
+            offset += RANK_SKETCH.size
+            counts = struct.unpack_from(f"<{n_buckets}q", view, offset)
+            offset += n_buckets * 8
+            rank_sketches[guild_id] = (
+                built_at,
+                RankSketch.from_counts(accuracy, counts),
+            )
+        if offset != len(mm):
+            raise ValueError("Snapshot size mismatch")
+    finally:
+        view.release()
+
+    return {
+        "journal_seq": journal_seq,
+        "guild_settings": guild_settings,
+        "level_roles": level_roles,
+        "totals": totals,
+        "rank_modes": rank_modes,
+        "rank_sketches": rank_sketches,
+    }
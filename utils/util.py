@@ -1,4 +1,5 @@
-import math
+import bisect
+import itertools
 
 import discord
 from discord import app_commands
@@ -33,3 +34,23 @@ def calculation_level(exp: int) -> tuple[int, int]:
 
 def calculation_next_level_exp(level: int) -> int:
     return 5 * (level**2) + (50 * level) + 100
+
+
+# LEVEL_EXP_TABLE[n]はレベルnに到達するのに必要な累計経験値
+LEVEL_EXP_TABLE = list(
+    itertools.accumulate(
+        (calculation_next_level_exp(level) for level in range(1000)), initial=0
+    )
+)
+
+
+def get_level(exp: int) -> int:
+    """
+    calculation_levelと同じレベルを、累計経験値の表の二分探索で求めます
+    """
+
+    while exp >= LEVEL_EXP_TABLE[-1]:
+        LEVEL_EXP_TABLE.append(
+            LEVEL_EXP_TABLE[-1] + calculation_next_level_exp(len(LEVEL_EXP_TABLE) - 1)
+        )
+    return bisect.bisect_right(LEVEL_EXP_TABLE, exp) - 1
@@ -0,0 +1,128 @@
+import time
+from dataclasses import dataclass
+from typing import Iterator
+
+import discord
+
+
+@dataclass
+class VoiceSession:
+    member: discord.Member
+    channel: discord.abc.GuildChannel
+    deafened: bool
+    afk: bool
+    # ボイスチャンネルに参加した時刻 (time.monotonic)
+    joined_at: float
+
+    @property
+    def active(self) -> bool:
+        # スピーカーミュートでも放置でもない
+        return not self.deafened and not self.afk
+
+
+class VoiceSessions:
+    """
+    ボイスチャンネルに参加しているメンバーをボイスステートの更新から保持します
+    Botは含めず、チャンネルごとのスピーカーミュートでも放置でもない人数も合わせて管理します
+    """
+
+    def __init__(self):
+        # guild_id -> user_id -> セッション
+        self.guilds: dict[int, dict[int, VoiceSession]] = {}
+        # channel_id -> スピーカーミュートでも放置でもない参加者の人数
+        self.occupancy: dict[int, int] = {}
+
+    def __len__(self) -> int:
+        return sum(len(sessions) for sessions in self.guilds.values())
+
+    def update(self, member: discord.Member, state: discord.VoiceState) -> None:
+        """
+        メンバーのボイスステートを反映します
+        チャンネルから抜けた場合はセッションを削除します
+        """
+
+        if member.bot:
+            return
+        guild = member.guild
+        if state.channel is None:
+            self.remove(guild.id, member.id)
+            return
+
+        sessions = self.guilds.setdefault(guild.id, {})
+        session = sessions.get(member.id)
+        if session is not None and session.channel.id != state.channel.id:
+            self._leave(session)
+            session = None
+        afk = state.afk or (
+            guild.afk_channel is not None and state.channel.id == guild.afk_channel.id
+        )
+        deafened = state.self_deaf or state.deaf
+        if session is None:
+            session = VoiceSession(
+                member, state.channel, deafened, afk, time.monotonic()
+            )
+            sessions[member.id] = session
+        else:
+            # ミュートや放置の状態が変わると人数に数えるかどうかも変わる
+            self._leave(session)
+            session.member = member
+            session.deafened = deafened
+            session.afk = afk
+        self._join(session)
+
+    def remove(self, guild_id: int, user_id: int) -> None:
+        sessions = self.guilds.get(guild_id)
+        if sessions is None:
+            return
+        session = sessions.pop(user_id, None)
+        if session is not None:
+            self._leave(session)
+        if not sessions:
+            del self.guilds[guild_id]
+
+    def remove_guild(self, guild_id: int) -> None:
+        for session in self.guilds.pop(guild_id, {}).values():
+            self._leave(session)
+
+    def _join(self, session: VoiceSession) -> None:
+        if session.active:
+            channel_id = session.channel.id
+            self.occupancy[channel_id] = self.occupancy.get(channel_id, 0) + 1
+
+    def _leave(self, session: VoiceSession) -> None:
+        if not session.active:
+            return
+        channel_id = session.channel.id
+        count = self.occupancy.get(channel_id, 0) - 1
+        if count > 0:
+            self.occupancy[channel_id] = count
+        else:
+            self.occupancy.pop(channel_id, None)
+
+    def rebuild(self, guilds: list[discord.Guild]) -> None:
+        """
+        キャッシュされているボイスステートからセッションを作り直します
+        """
+
+        self.guilds.clear()
+        self.occupancy.clear()
+        for guild in guilds:
+            for channel in [*guild.voice_channels, *guild.stage_channels]:
+                for user_id, state in channel.voice_states.items():
+                    member = guild.get_member(user_id)
+                    if member is not None:
+                        self.update(member, state)
+
+    def eligible(self, guild_id: int) -> Iterator[VoiceSession]:
+        """
+        EXPを付与できるセッション (スピーカーミュートでも放置でもなく、
+        同じチャンネルに同じくスピーカーミュートでも放置でもない人がいる) を返します
+        """
+
+        occupancy = self.occupancy
+        for session in list(self.guilds.get(guild_id, {}).values()):
+            if not session.active:
+                continue
+            if occupancy.get(session.channel.id, 0) < 2:
+                continue
+            yield session
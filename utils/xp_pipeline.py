@@ -0,0 +1,132 @@
+import asyncio
+import logging
+from collections import deque
+from dataclasses import dataclass
+from typing import Awaitable, Callable, Hashable, Sequence
+
+import discord
+
+from utils.util import get_level
+
+SideEffect = Callable[[], Awaitable[None]]
+
+
+@dataclass(slots=True)
+class XpEvent:
+    """
+    EXPの加算に必要なメッセージの情報
+    discord.Messageを持たずIDだけで処理するので、生のゲートウェイイベントからも作れます
+    """
+
+    guild_id: int
+    user_id: int
+    channel_id: int
+    # スレッドは親チャンネル、チャンネルはカテゴリのID
+    parent_id: int | None
+    role_ids: Sequence[int]
+    # まとめて処理するメッセージ数
+    count: int = 1
+
+    @classmethod
+    def from_message(cls, message: discord.Message) -> "XpEvent":
+        channel = message.channel
+        # member._rolesはロールIDの配列で、member.rolesと違いRoleオブジェクトを作らない
+        return cls(
+            message.guild.id,
+            message.author.id,
+            channel.id,
+            getattr(channel, "parent_id", None)
+            or getattr(channel, "category_id", None),
+            getattr(message.author, "_roles", ()),
+        )
+
+
+@dataclass(slots=True)
+class LevelChange:
+    guild_id: int
+    user_id: int
+    channel_id: int
+    level: int
+    increased_level: int
+    stack_level_roles: bool
+
+
+def detect_level_change(
+    event: XpEvent, before: int, after: int, stack_level_roles: bool
+) -> LevelChange | None:
+    """
+    合計EXPがbeforeからafterに変わった時にレベルが上がっていればLevelChangeを返します
+    """
+
+    level = get_level(before)
+    increased_level = get_level(after)
+    if level >= increased_level:
+        return None
+    return LevelChange(
+        event.guild_id,
+        event.user_id,
+        event.channel_id,
+        level,
+        increased_level,
+        stack_level_roles,
+    )
+
+
+class MemberDispatcher:
+    """
+    レベルアップの通知やロール付与などの副作用をバックグラウンドで実行します
+    同じキー (メンバー) の副作用は登録した順に1つずつ、別のキーの副作用は並行して実行し、
+    全体の同時実行数はmax_concurrencyまでに抑えます
+    """
+
+    def __init__(self, max_concurrency: int):
+        self.logger = logging.getLogger("leveling.dispatcher")
+        self._semaphore = asyncio.Semaphore(max_concurrency)
+        # キー -> 未実行の副作用 (先頭は実行中)
+        self._queues: dict[Hashable, deque[SideEffect]] = {}
+        self._tasks: set[asyncio.Task] = set()
+        self._pending = 0
+        self.dispatched = 0
+        self.failed = 0
+
+    @property
+    def pending(self) -> int:
+        return self._pending
+
+    def dispatch(self, key: Hashable, effect: SideEffect) -> None:
+        self._pending += 1
+        self.dispatched += 1
+        queue = self._queues.get(key)
+        if queue is not None:
+            # 実行中のワーカーが順番に処理する
+            queue.append(effect)
+            return
+        self._queues[key] = deque([effect])
+        task = asyncio.create_task(self._run(key))
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+
+    async def _run(self, key: Hashable) -> None:
+        queue = self._queues[key]
+        try:
+            while queue:
+                async with self._semaphore:
+                    try:
+                        await queue[0]()
+                    except Exception:
+                        self.failed += 1
+                        self.logger.exception(f"Side effect for {key} failed")
+                queue.popleft()
+                self._pending -= 1
+        finally:
+            # キャンセルされた場合は残りを捨てる
+            self._pending -= len(queue)
+            del self._queues[key]
+
+    def stats(self) -> dict[str, int]:
+        return {
+            "pending": self._pending,
+            "members": len(self._queues),
+            "dispatched": self.dispatched,
+            "failed": self.failed,
+        }